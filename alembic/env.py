@@ -5,6 +5,7 @@ from sqlalchemy import engine_from_config, pool
 from alembic import context
 from collector.configurations import CONFIG
 from collector.models import Base
+from collector.partitioning import include_object
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -47,6 +48,7 @@ def run_migrations_offline() -> None:
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         render_as_batch=True,  # special option for sqlite alter column migration
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -71,6 +73,7 @@ def run_migrations_online() -> None:
             connection=connection,
             target_metadata=target_metadata,
             render_as_batch=True,  # special option for sqlite alter column migration
+            include_object=include_object,
         )
 
         with context.begin_transaction():
@@ -0,0 +1,44 @@
+"""measurement indexes
+
+Revision ID: 97da8300354a
+Revises: 4b0d8f6c2a17
+Create Date: 2026-10-18 18:41:26.518304
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '97da8300354a'
+down_revision = '4b0d8f6c2a17'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_weather_measurement_city_id_measure_at', 'weather_measurement', ['city_id', 'measure_at']),
+    ('ix_main_weather_measurement_measurement_id', 'main_weather_measurement', ['measurement_id']),
+    ('ix_extra_weather_data_measurement_id', 'extra_weather_data', ['measurement_id']),
+]
+
+
+def concurrently() -> str:
+    # [NOTE]
+    # Postgres builds indexes CONCURRENTLY, so collector keeps writing measurements
+    # while migration is running. That is not allowed inside transaction block.
+    # Raw SQL is used, as `if_not_exists` / `if_exists` is not supported by alembic
+    # `create_index` / `drop_index` of pinned version.
+    return 'CONCURRENTLY ' if op.get_context().dialect.name == 'postgresql' else ''
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(
+                f'CREATE INDEX {concurrently()}IF NOT EXISTS {name} '
+                f'ON {table} ({", ".join(columns)})'
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.execute(f'DROP INDEX {concurrently()}IF EXISTS {name}')
@@ -0,0 +1,69 @@
+"""partition measurements
+
+Revision ID: e81f4c3b6d52
+Revises: c5e2a07d9b41
+Create Date: 2026-10-18 21:14:05.381742
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+from collector.partitioning import convert_tables
+
+# revision identifiers, used by Alembic.
+revision = 'e81f4c3b6d52'
+down_revision = 'c5e2a07d9b41'
+branch_labels = None
+depends_on = None
+
+CHILDREN = ['main_weather_measurement', 'extra_weather_data']
+
+# children foreign keys to measurement id were created without names
+NAMING_CONVENTION = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'
+}
+
+
+def upgrade() -> None:
+    for table in CHILDREN:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('measure_at', sa.DateTime(), nullable=True, comment='The same as measurement has. UTC.'))
+
+        op.execute(
+            f'UPDATE {table} SET measure_at = ('
+            'SELECT measure_at FROM weather_measurement '
+            f'WHERE weather_measurement.id = {table}.measurement_id)'
+        )
+        # rows without measurement are not reachable anyway
+        op.execute(f'DELETE FROM {table} WHERE measure_at IS NULL')
+
+    if op.get_bind().dialect.name == 'postgresql':
+        for table in CHILDREN:
+            op.alter_column(table, 'measure_at', nullable=False)
+
+        # tables are recreated as partitioned by month with all constraints
+        convert_tables(op.get_bind(), partitioned=True)
+        return
+
+    with op.batch_alter_table('weather_measurement', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_weather_measurement_id_measure_at', ['id', 'measure_at'])
+
+    for table in CHILDREN:
+        with op.batch_alter_table(table, schema=None, naming_convention=NAMING_CONVENTION) as batch_op:
+            batch_op.alter_column('measure_at', existing_type=sa.DateTime(), nullable=False)
+            batch_op.drop_constraint(f'fk_{table}_measurement_id_weather_measurement', type_='foreignkey')
+            batch_op.create_foreign_key(f'fk_{table}_measurement', 'weather_measurement', ['measurement_id', 'measure_at'], ['id', 'measure_at'])
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == 'postgresql':
+        convert_tables(op.get_bind(), partitioned=False)
+
+    for table in CHILDREN:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_constraint(f'fk_{table}_measurement', type_='foreignkey')
+            batch_op.create_foreign_key(f'{table}_measurement_id_fkey', 'weather_measurement', ['measurement_id'], ['id'])
+            batch_op.drop_column('measure_at')
+
+    with op.batch_alter_table('weather_measurement', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_weather_measurement_id_measure_at', type_='unique')
@@ -0,0 +1,134 @@
+"""
+Benchmark for `AnalyzeWeather` analytics at seeded database.
+
+    $ python -m benchmarks.analytics [--url postgresql://...]
+        [--cities 50] [--measurements 2000]
+
+Tables are created at separate database (temporary SQLite file by default) and seeded
+the same way as `measurement_queries` benchmark does. All tables at provided database
+are dropped at the end.
+
+`before` is how analytics is made outside of collector: measurements are loaded by ORM
+for every city and computed row by row by Python. `after` is `AnalyzeWeather` service
+(one bulk fetch to NumPy arrays, vectorized computations). Both compute 24 hours
+rolling means, 5/50/95 percentiles, degree-hours above 25 C and anomalies beyond 3
+standard deviations.
+"""
+
+import argparse
+import io
+import math
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import sqlalchemy as db
+import sqlalchemy.orm as orm
+
+import collector.session
+from benchmarks.measurement_queries import seed
+from collector.models import Base, CityModel, MeasurementModel
+from collector.services.analytics import AnalyzeWeather
+
+WINDOW = timedelta(hours=24)
+PERCENTILES = [5, 50, 95]
+THRESHOLD = 25
+ANOMALIES = 3
+
+
+def percentile(values: list[float], q: float) -> float:
+    position = (len(values) - 1) * q / 100
+    low, high = math.floor(position), math.ceil(position)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def analyze_before(engine: db.engine.Engine):
+    report = []
+    with orm.Session(engine) as session:
+        for city in session.query(CityModel).all():
+            measurements: list[MeasurementModel] = (
+                session.query(MeasurementModel)
+                .filter(MeasurementModel.city_id == city.id)
+                .order_by(MeasurementModel.measure_at)
+                .all()
+            )
+            if not measurements:
+                continue
+            times = [m.measure_at for m in measurements]
+            temps = [m.main_data.temp for m in measurements]
+
+            start, total = 0, 0.0
+            for i, temp in enumerate(temps):
+                total += temp
+                while times[start] <= times[i] - WINDOW:
+                    total -= temps[start]
+                    start += 1
+                report.append(total / (i + 1 - start))
+
+            ordered = sorted(temps)
+            report.extend(percentile(ordered, q) for q in PERCENTILES)
+
+            degree_hours = 0.0
+            for i in range(1, len(temps)):
+                hours = (times[i] - times[i - 1]) / timedelta(hours=1)
+                excess = [max(t - THRESHOLD, 0) for t in temps[i - 1 : i + 1]]
+                degree_hours += sum(excess) / 2 * hours
+            report.append(degree_hours)
+
+            mean = sum(temps) / len(temps)
+            std = math.sqrt(sum((t - mean) ** 2 for t in temps) / len(temps))
+            report.extend(t for t in temps if std and abs(t - mean) / std > ANOMALIES)
+    return report
+
+
+def analyze_after():
+    service = AnalyzeWeather(
+        rolling=WINDOW / timedelta(hours=1),
+        percentiles=PERCENTILES,
+        degree_hours=THRESHOLD,
+        anomalies=ANOMALIES,
+    )
+    service.output = io.StringIO()
+    service.execute()
+    return service.output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', type=str, default=None)
+    parser.add_argument('--cities', type=int, default=50)
+    parser.add_argument('--measurements', type=int, default=2000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+    engine = db.create_engine(args.url or f'sqlite:///{path}', future=True)
+    collector.session.engine = engine  # analytics is made by service session
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        seed(engine, args.cities, args.measurements)
+        with engine.begin() as connection:
+            connection.execute(db.text('ANALYZE'))
+        rows = args.cities * args.measurements
+        print(f'{engine.url!r}: {rows} measurements of {args.cities} cities')
+
+        results = {}
+        for label, run in [
+            ('before', lambda: analyze_before(engine)),
+            ('after', analyze_after),
+        ]:
+            start = time.perf_counter()
+            run()
+            results[label] = time.perf_counter() - start
+    finally:
+        Base.metadata.drop_all(engine)
+
+    before, after = results['before'], results['after']
+    print(f'{"before":>12} {"after":>12}')
+    print(f'{before * 1e3:9.1f} ms {after * 1e3:9.1f} ms  x{before / after:.0f}')
+
+
+if __name__ == '__main__':
+    main()
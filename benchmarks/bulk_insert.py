@@ -0,0 +1,100 @@
+"""
+Benchmark for storing one collecting run: measurements with their main and extra data.
+
+    $ python -m benchmarks.bulk_insert [--cities 5000]
+
+Runs against configured database (migrations must be applied). Every run is rolled
+back, so nothing is left at database.
+
+`before` is ORM unit of work: `MeasurementModel` objects with nested children are
+added to session and flushed (INSERT with RETURNING round trip for every row).
+`after` is `BulkInsert`: a few multi-row statements for the whole run. Postgres is
+benchmarked for both ingestion modes: multi-row INSERT and COPY (`bulk_copy` option).
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+import sqlalchemy.orm as orm
+
+from benchmarks.response_decode import SAMPLE_RESPONSE
+from collector.configurations import CONFIG
+from collector.models import (
+    CityModel,
+    ExtraWeatherDataModel,
+    MainWeatherDataModel,
+    MeasurementModel,
+)
+from collector.partitioning import ensure_partitions
+from collector.session import BulkInsert, DBSessionMixin, engine
+
+MEASURE_AT = datetime.utcfromtimestamp(SAMPLE_RESPONSE['dt'])
+EXTRA = {k: v for k, v in SAMPLE_RESPONSE.items() if k not in ('main', 'dt')}
+
+
+def before(session: orm.Session, cities: list[CityModel]):
+    session.add_all(
+        [
+            MeasurementModel(
+                city=city,
+                measure_at=MEASURE_AT,
+                main=MainWeatherDataModel(**SAMPLE_RESPONSE['main']),
+                extra=ExtraWeatherDataModel(data=EXTRA),
+            )
+            for city in cities
+        ]
+    )
+    session.flush()
+
+
+def after(session: orm.Session, cities: list[CityModel]):
+    writer = DBSessionMixin()
+    writer.session = session
+
+    bulk = BulkInsert(
+        MeasurementModel, main=MainWeatherDataModel, extra=ExtraWeatherDataModel
+    )
+    for city in cities:
+        bulk.add(
+            {'city_id': city.id, 'measure_at': MEASURE_AT},
+            main=SAMPLE_RESPONSE['main'],
+            extra={'data': EXTRA},
+        )
+    writer.bulk_create(bulk)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cities', type=int, default=5_000)
+    args = parser.parse_args()
+
+    print(f'{CONFIG.db.url.split("@")[-1]}, {args.cities} measurements per run')
+    runs = [('before', before, False), ('after', after, False)]
+    if engine.dialect.name == 'postgresql':
+        runs.append(('after (copy)', after, True))
+
+    results = {}
+    for name, write, bulk_copy in runs:
+        if hasattr(CONFIG.db, 'bulk_copy'):
+            CONFIG.db.bulk_copy = bulk_copy
+
+        with orm.Session(engine) as session:
+            cities = [CityModel(name=f'City {i}') for i in range(args.cities)]
+            session.add_all(cities)
+            session.flush()
+            # ORM unit of work does not create partitions (see `bulk_create`)
+            ensure_partitions(session.connection(), [MEASURE_AT])
+
+            start = time.perf_counter()
+            write(session, cities)
+            results[name] = time.perf_counter() - start
+            session.rollback()
+
+    baseline = results['before']
+    for name, total in results.items():
+        print(f'{name:<14} {total * 1e3:10.1f} ms/run  x{baseline / total:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark for `export` service throughput at seeded database.
+
+    $ python -m benchmarks.export [--url postgresql://...]
+        [--cities 1000] [--measurements 1000] [--chunk-size 10000]
+
+Tables are created at separate database (temporary SQLite file by default) and seeded
+the same way as `measurement_queries` benchmark does. All tables at provided database
+are dropped at the end. Every format is exported with one extra data field. Memory is
+max resident set size of the process after all exports.
+"""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+import sqlalchemy as db
+
+import collector.session
+from benchmarks.measurement_queries import seed
+from collector.models import Base
+from collector.services.export import ExportWeather
+
+
+def get_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(get_size(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', type=str, default=None)
+    parser.add_argument('--cities', type=int, default=1000)
+    parser.add_argument('--measurements', type=int, default=1000)
+    parser.add_argument('--chunk-size', type=int, default=10_000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'benchmark.sqlite3')
+    engine = db.create_engine(args.url or f'sqlite:///{path}', future=True)
+    collector.session.engine = engine  # export is made by service session
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    results = {}
+    try:
+        seed(engine, args.cities, args.measurements)
+        with engine.begin() as connection:
+            connection.execute(db.text('ANALYZE'))
+        rows = args.cities * args.measurements
+        print(f'{engine.url!r}: {rows} measurements, chunks of {args.chunk_size}')
+
+        for format, writer in ExportWeather.writers.items():
+            output = os.path.join(directory, f'weather.{writer.extension}')
+            start = time.perf_counter()
+            ExportWeather(
+                format=format,
+                output=output,
+                extra_fields=['visibility'],
+                chunk_size=args.chunk_size,
+            ).execute()
+            results[format] = (time.perf_counter() - start, get_size(output))
+    finally:
+        Base.metadata.drop_all(engine)
+
+    for format, (elapsed, size) in results.items():
+        print(
+            f'{format:<8} {elapsed:8.1f} sec {rows / elapsed:10.0f} rows/sec '
+            f'{size / 2**20:8.1f} MB'
+        )
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print(f'max RSS {memory:.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
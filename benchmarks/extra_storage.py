@@ -0,0 +1,93 @@
+"""
+Benchmark for extra weather data storage size: plain JSON against compact mode (static
+fields at city, the rest as JSONB at PostgreSQL or compressed bytes at SQLite).
+
+    $ python -m benchmarks.extra_storage [--cities 5000]
+
+Runs against configured database (migrations must be applied). Every run is rolled
+back, so nothing is left at database. Size is stored size of extra data column values
+(`pg_column_size` at PostgreSQL, `length` at SQLite). City static fields are stored
+once per city, so they are stored before the run (as by previous runs) and reported
+separately.
+"""
+
+import argparse
+import time
+
+import sqlalchemy as db
+import sqlalchemy.orm as orm
+
+from benchmarks.bulk_insert import EXTRA, MEASURE_AT
+from collector.models import (
+    CityModel,
+    ExtraWeatherDataModel,
+    MeasurementModel,
+    split_static,
+)
+from collector.partitioning import ensure_partitions
+from collector.session import BulkInsert, DBSessionMixin, engine
+
+
+def insert(session: orm.Session, cities: list[CityModel], compact: bool):
+    writer = DBSessionMixin()
+    writer.session = session
+
+    bulk = BulkInsert(MeasurementModel, extra=ExtraWeatherDataModel)
+    for city in cities:
+        extra = {'data': EXTRA}
+        if compact:
+            extra = {'packed': split_static(EXTRA)[1]}
+        bulk.add({'city_id': city.id, 'measure_at': MEASURE_AT}, extra=extra)
+    writer.bulk_create(bulk)
+
+
+def get_size(session: orm.Session, column: db.Column) -> float:
+    size = db.func.length
+    if session.bind.dialect.name == 'postgresql':
+        size = db.func.pg_column_size
+    return session.scalar(db.select(db.func.avg(size(column))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cities', type=int, default=5_000)
+    args = parser.parse_args()
+
+    print(f'{engine.url!r}, {args.cities} measurements per run')
+    results: dict[bool, tuple[float, int]] = {}
+    for compact in [False, True]:
+        with orm.Session(engine) as session:
+            static = split_static(EXTRA)[0] if compact else None
+            cities = [
+                CityModel(name=f'City {i}', weather_static=static)
+                for i in range(args.cities)
+            ]
+            session.add_all(cities)
+            session.flush()
+            ensure_partitions(session.connection(), [MEASURE_AT])
+
+            start = time.perf_counter()
+            insert(session, cities, compact)
+            elapsed = time.perf_counter() - start
+
+            if compact:
+                static_size = get_size(
+                    session, db.cast(CityModel.weather_static, db.Text)
+                )
+                print(f'city static fields: {static_size:.1f} bytes/city')
+            column = (
+                ExtraWeatherDataModel.packed if compact else ExtraWeatherDataModel.data
+            )
+            results[compact] = (elapsed, get_size(session, column))
+            session.rollback()
+
+    plain = results[False][1]
+    for compact, (elapsed, size) in results.items():
+        print(
+            f'{"compact" if compact else "plain":<8} {elapsed * 1e3:9.1f} ms/run '
+            f'{size:9.1f} bytes/measurement  x{plain / size:.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
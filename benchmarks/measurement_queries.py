@@ -0,0 +1,192 @@
+"""
+Benchmark for measurement queries made by reports and relationship loads, with and
+without indexes, at seeded database.
+
+    $ python -m benchmarks.measurement_queries [--url postgresql://...]
+        [--cities 1000] [--measurements 2000] [--repeats 20]
+
+Tables are created at separate database (temporary SQLite file by default) and seeded
+with `cities * measurements` rows for every measurement table. All tables at provided
+database are dropped at the end.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as db
+
+from collector.models import (
+    Base,
+    ExtraWeatherDataModel,
+    MainWeatherDataModel,
+    MeasurementModel,
+)
+
+START = datetime(2020, 1, 1)
+
+SEED_POSTGRES = [
+    '''
+    INSERT INTO city (id, name, is_tracked)
+    SELECT n, 'City ' || n, true FROM generate_series(1, :cities) n
+    ''',
+    '''
+    INSERT INTO weather_measurement (id, city_id, measure_at)
+    SELECT n, (n - 1) % :cities + 1,
+        timestamp '2020-01-01' + ((n - 1) / :cities) * interval '1 hour'
+    FROM generate_series(1, :total) n
+    ''',
+    '''
+    INSERT INTO main_weather_measurement
+        (measurement_id, measure_at, temp, pressure, humidity)
+    SELECT id, measure_at, random() * 40 - 10, 1000, 50 FROM weather_measurement
+    ''',
+    '''
+    INSERT INTO extra_weather_data (measurement_id, measure_at, data)
+    SELECT id, measure_at, '{"visibility": 10000}' FROM weather_measurement
+    ''',
+]
+
+SEQUENCE_SQLITE = '''
+    WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {})
+'''
+# datetime is stored at SQLAlchemy text format (with microseconds), so it equals to values
+# bound by ORM (children are joined by measurement id and time)
+SEED_SQLITE = [
+    '''
+    INSERT INTO city (id, name, is_tracked)
+    {cities} SELECT n, 'City ' || n, 1 FROM seq
+    ''',
+    '''
+    INSERT INTO weather_measurement (id, city_id, measure_at)
+    {total} SELECT n, (n - 1) % :cities + 1,
+        datetime('2020-01-01', '+' || ((n - 1) / :cities) || ' hours') || '.000000'
+    FROM seq
+    ''',
+    '''
+    INSERT INTO main_weather_measurement
+        (measurement_id, measure_at, temp, pressure, humidity)
+    SELECT id, measure_at, abs(random() % 4000) / 100.0 - 10, 1000, 50
+    FROM weather_measurement
+    ''',
+    '''
+    INSERT INTO extra_weather_data (measurement_id, measure_at, data)
+    SELECT id, measure_at, '{{"visibility": 10000}}' FROM weather_measurement
+    ''',
+]
+
+
+def seed(engine: db.engine.Engine, cities: int, measurements: int):
+    total = cities * measurements
+    if engine.dialect.name == 'postgresql':
+        statements = SEED_POSTGRES
+    else:
+        statements = [
+            statement.format(
+                cities=SEQUENCE_SQLITE.format(cities),
+                total=SEQUENCE_SQLITE.format(total),
+            )
+            for statement in SEED_SQLITE
+        ]
+
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(db.text(statement), dict(cities=cities, total=total))
+
+
+def get_queries(cities: int, measurements: int):
+    """
+    Queries the same as `ReportWeather` and relationship loads make. Every query is a
+    function of random city id and random measurement id.
+    """
+    measurement = MeasurementModel.__table__
+    last_day = START + timedelta(hours=measurements - 24)
+    return {
+        'city measurements': lambda city, _: db.select(measurement)
+        .where(measurement.c.city_id == city)
+        .order_by(measurement.c.measure_at),
+        'city latest': lambda city, _: db.select(measurement)
+        .where(measurement.c.city_id == city)
+        .order_by(measurement.c.measure_at.desc())
+        .limit(1),
+        'city last day': lambda city, _: db.select(measurement).where(
+            measurement.c.city_id == city, measurement.c.measure_at >= last_day
+        ),
+        'main of measurement': lambda _, id: db.select(
+            MainWeatherDataModel.__table__
+        ).where(MainWeatherDataModel.measurement_id == id),
+        'extra of measurement': lambda _, id: db.select(
+            ExtraWeatherDataModel.__table__
+        ).where(ExtraWeatherDataModel.measurement_id == id),
+    }
+
+
+def run_queries(engine: db.engine.Engine, args: argparse.Namespace):
+    rnd = random.Random(0)  # the same arguments for both runs
+    results = {}
+    with engine.connect() as connection:
+        for name, query in get_queries(args.cities, args.measurements).items():
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                city = rnd.randint(1, args.cities)
+                id = rnd.randint(1, args.cities * args.measurements)
+                connection.execute(query(city, id)).fetchall()
+            results[name] = (time.perf_counter() - start) / args.repeats
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', type=str, default=None)
+    parser.add_argument('--cities', type=int, default=1000)
+    parser.add_argument('--measurements', type=int, default=2000)
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+    engine = db.create_engine(args.url or f'sqlite:///{path}', future=True)
+    indexes = [
+        index
+        for model in [MeasurementModel, MainWeatherDataModel, ExtraWeatherDataModel]
+        for index in model.__table__.indexes
+    ]
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        for index in indexes:
+            index.drop(engine)
+
+        start = time.perf_counter()
+        seed(engine, args.cities, args.measurements)
+        rows = args.cities * args.measurements
+        print(f'{engine.url!r}: seeded {rows} measurements ', end='')
+        print(f'in {time.perf_counter() - start:.1f} sec')
+
+        with engine.begin() as connection:
+            connection.execute(db.text('ANALYZE'))
+        before = run_queries(engine, args)
+
+        start = time.perf_counter()
+        for index in indexes:
+            index.create(engine)
+        with engine.begin() as connection:
+            connection.execute(db.text('ANALYZE'))
+        print(f'indexes created in {time.perf_counter() - start:.1f} sec')
+        after = run_queries(engine, args)
+    finally:
+        Base.metadata.drop_all(engine)
+
+    print(f'{"":<22} {"no indexes":>12} {"indexes":>12}')
+    for name in before:
+        print(
+            f'{name:<22} {before[name] * 1e3:9.2f} ms {after[name] * 1e3:9.2f} ms  '
+            f'x{before[name] / after[name]:.0f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
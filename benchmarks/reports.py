@@ -0,0 +1,154 @@
+"""
+Benchmark for `ReportWeather` reports at seeded database.
+
+    $ python -m benchmarks.reports [--url postgresql://...]
+        [--cities 50] [--measurements 2000] [--reports average latest]
+
+Tables are created at separate database (temporary SQLite file by default) and seeded
+the same way as `measurement_queries` benchmark does. All tables at provided database
+are dropped at the end.
+
+Cities rollup (`city_weather_stats`) is made after seeding, the same way as
+`rebuild_stats` command does (not measured).
+
+`before` is previous implementation: measurements are loaded by ORM for every city and
+aggregated by Python (or queried one by one for every city for `latest` report).
+`after` is current `ReportWeather` implementation (read from rollup). At PostgreSQL
+`latest` report is also compared with `DISTINCT ON` query (`distinct` column).
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import sqlalchemy as db
+import sqlalchemy.orm as orm
+
+import collector.session
+from benchmarks.measurement_queries import seed
+from collector.models import Base, CityModel, MainWeatherDataModel, MeasurementModel
+from collector.services.weather import ReportWeather
+from collector.stats import rebuild_stats
+
+
+def average_before(engine: db.engine.Engine):
+    report = ''
+    with orm.Session(engine) as session:
+        for city in session.query(CityModel).all():
+            measurements: list[MeasurementModel] = (
+                session.query(MeasurementModel)
+                .filter(MeasurementModel.city_id == city.id)
+                .order_by(MeasurementModel.measure_at)
+                .all()
+            )
+            if not measurements:
+                continue
+            average = sum(m.main_data.temp for m in measurements) / len(measurements)
+            report += f'\n{city.name} {average} {len(measurements)}'
+    return report
+
+
+def latest_before(engine: db.engine.Engine):
+    report = ''
+    with orm.Session(engine) as session:
+        for city in session.query(CityModel).all():
+            measure: MeasurementModel | None = (
+                session.query(MeasurementModel)
+                .filter(MeasurementModel.city_id == city.id)
+                .order_by(MeasurementModel.measure_at.desc())
+                .first()
+            )
+            if measure:
+                report += f'\n{city.name} {measure.main_data.temp} {measure.measure_at}'
+    return report
+
+
+def latest_distinct(engine: db.engine.Engine):
+    temp = db.func.coalesce(MeasurementModel.temp, MainWeatherDataModel.temp)
+    latest = (
+        db.select(MeasurementModel.city_id, MeasurementModel.measure_at, temp)
+        .outerjoin(MainWeatherDataModel)
+        .distinct(MeasurementModel.city_id)
+        .order_by(MeasurementModel.city_id, MeasurementModel.measure_at.desc())
+        .subquery()
+    )
+    with engine.connect() as connection:
+        return connection.execute(
+            db.select(CityModel.name, latest)
+            .join_from(CityModel, latest, CityModel.id == latest.c.city_id)
+            .order_by(CityModel.id)
+        ).all()
+
+
+def run_report(method: str):
+    service = ReportWeather()
+    try:
+        return ''.join(getattr(service, method)())
+    finally:
+        service.close_session()
+
+
+REPORTS = ['average', 'latest']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', type=str, default=None)
+    parser.add_argument('--cities', type=int, default=50)
+    parser.add_argument('--measurements', type=int, default=2000)
+    parser.add_argument(
+        '--reports', nargs='+', default=['average', 'latest'], choices=REPORTS
+    )
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+    engine = db.create_engine(args.url or f'sqlite:///{path}', future=True)
+    collector.session.engine = engine  # reports are made by services sessions
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        seed(engine, args.cities, args.measurements)
+        with engine.begin() as connection:
+            connection.execute(db.text('ANALYZE'))
+            rebuild_stats(connection)
+        rows = args.cities * args.measurements
+        print(f'{engine.url!r}: {rows} measurements of {args.cities} cities')
+
+        reports = {
+            'average': {
+                'before': lambda: average_before(engine),
+                'after': lambda: run_report('get_average'),
+            },
+            'latest': {
+                'before': lambda: latest_before(engine),
+                'after': lambda: run_report('get_latest'),
+            },
+        }
+        if engine.dialect.name == 'postgresql':
+            reports['latest']['distinct'] = lambda: latest_distinct(engine)
+
+        results = {}
+        for name in args.reports:
+            for label, run in reports[name].items():
+                start = time.perf_counter()
+                run()
+                results.setdefault(name, {})[label] = time.perf_counter() - start
+    finally:
+        Base.metadata.drop_all(engine)
+
+    print(f'{"":<10} {"before":>12} {"after":>12}  {"":<5} {"distinct":>12}')
+    for name, result in results.items():
+        before, after = result['before'], result['after']
+        line = (
+            f'{name:<10} {before * 1e3:9.1f} ms {after * 1e3:9.1f} ms  '
+            f'x{before / after:<4.0f}'
+        )
+        if 'distinct' in result:
+            line += f' {result["distinct"] * 1e3:9.1f} ms'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
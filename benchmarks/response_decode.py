@@ -0,0 +1,106 @@
+"""
+Micro-benchmark for weather response handling: decoding body and splitting it into
+validated measurement and extra data.
+
+    $ python -m benchmarks.response_decode [--number 20000]
+
+`before` is the previous pipeline: body decoded by `response.json()` once for schema
+parsing and once again for extra data (fields popped out of the second copy).
+`after` is the current one: body decoded once and split in a single pass.
+"""
+
+import argparse
+import json
+import timeit
+from typing import Any
+
+import requests
+from pydantic import parse_obj_as
+
+from collector.configurations import CONFIG
+from collector.functools import import_string
+from collector.services.weather import FetchWeather, WeatherMeasurementSchema
+
+SAMPLE_RESPONSE: dict[str, Any] = {
+    'coord': {'lon': 37.6156, 'lat': 55.7522},
+    'weather': [
+        {'id': 804, 'main': 'Clouds', 'description': 'overcast clouds', 'icon': '04n'}
+    ],
+    'base': 'stations',
+    'main': {
+        'temp': -1.96,
+        'feels_like': -6.31,
+        'temp_min': -2.62,
+        'temp_max': -1.38,
+        'pressure': 1024,
+        'humidity': 89,
+        'sea_level': 1024,
+        'grnd_level': 1005,
+    },
+    'visibility': 10000,
+    'wind': {'speed': 3.89, 'deg': 231, 'gust': 10.39},
+    'clouds': {'all': 100},
+    'dt': 1669306534,
+    'sys': {
+        'type': 2,
+        'id': 2000314,
+        'country': 'RU',
+        'sunrise': 1669268405,
+        'sunset': 1669295734,
+    },
+    'timezone': 10800,
+    'id': 524901,
+    'name': 'Moscow',
+    'cod': 200,
+}
+
+
+def make_response() -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'application/json; charset=utf-8'
+    response._content = json.dumps(SAMPLE_RESPONSE).encode()
+    return response
+
+
+def before(response: requests.Response):
+    measure = parse_obj_as(WeatherMeasurementSchema, response.json())
+    extra = response.json()
+    for field in WeatherMeasurementSchema.__fields__:
+        extra.pop(field)
+    return measure, extra
+
+
+def after(response: requests.Response, service: FetchWeather):
+    return service.parse(service.decode(response.content))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20_000)
+    args = parser.parse_args()
+
+    response = make_response()
+    service = FetchWeather.__new__(FetchWeather)  # no db session is needed for parsing
+    assert before(response) == after(response, service)
+
+    decoders = ['json.loads', 'orjson.loads']
+    results = {'before': timeit.timeit(lambda: before(response), number=args.number)}
+    for decoder in decoders:
+        try:
+            import_string(decoder)
+        except ImportError:
+            continue
+        CONFIG.json_decoder = decoder
+        results[f'after ({decoder})'] = timeit.timeit(
+            lambda: after(response, service), number=args.number
+        )
+
+    baseline = results['before']
+    for name, total in results.items():
+        per_response = total / args.number * 1e6
+        print(f'{name:<24} {per_response:8.2f} us/response  x{baseline / total:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmark for aggregates of dropped measurements, which `Retention` subtracts from
+cities rollup, at seeded database.
+
+    $ python -m benchmarks.retention [--url postgresql://...]
+        [--cities 50] [--measurements 4000] [--drop-months 3]
+
+Tables are created at separate database (temporary SQLite file by default) and seeded
+the same way as `measurement_queries` benchmark does (hourly measurements since
+2020-01-01). At PostgreSQL tables are converted to partitioned by month. All tables at
+provided database are dropped at the end. Nothing is dropped, aggregates are only read.
+
+`rebuild` is the whole rollup aggregated again. `before` is previous implementation: one
+aggregate over all dropped months. `after` is current `Retention` implementation: one
+aggregate per dropped month (main data is filtered by the month too, so only that month
+partitions are read at PostgreSQL).
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import sqlalchemy as db
+
+from benchmarks.measurement_queries import START, seed
+from collector.models import Base, MeasurementModel
+from collector.partitioning import add_months, convert_tables, month_start
+from collector.stats import aggregate_stats, group_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', type=str, default=None)
+    parser.add_argument('--cities', type=int, default=50)
+    parser.add_argument('--measurements', type=int, default=4000)
+    parser.add_argument('--drop-months', type=int, default=3)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+    engine = db.create_engine(args.url or f'sqlite:///{path}', future=True)
+    first = month_start(START)
+    before = add_months(first, args.drop_months)
+    months = [add_months(first, amount) for amount in range(args.drop_months)]
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    try:
+        seed(engine, args.cities, args.measurements)
+        with engine.begin() as connection:
+            if engine.dialect.name == 'postgresql':
+                convert_tables(connection)
+            connection.execute(db.text('ANALYZE'))
+            dropped = connection.scalar(
+                db.select(db.func.count()).where(MeasurementModel.measure_at < before)
+            )
+        rows = args.cities * args.measurements
+        print(
+            f'{engine.url!r}: {rows} measurements of {args.cities} cities, '
+            f'{dropped} of them before {before}'
+        )
+
+        queries = {
+            'rebuild': lambda: [aggregate_stats()],
+            'before': lambda: [group_stats(MeasurementModel.measure_at < before)],
+            'after': lambda: [
+                group_stats(window=(month, add_months(month, 1))) for month in months
+            ],
+        }
+        results = {}
+        with engine.connect() as connection:
+            for label, statements in queries.items():
+                start = time.perf_counter()
+                for statement in statements():
+                    connection.execute(statement).all()
+                results[label] = time.perf_counter() - start
+    finally:
+        Base.metadata.drop_all(engine)
+
+    for label, result in results.items():
+        print(f'{label:<10} {result * 1e3:9.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
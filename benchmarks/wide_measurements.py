@@ -0,0 +1,100 @@
+"""
+Benchmark for wide-row measurements schema: `main` data stored inline at measurement
+row against separate `MainWeatherDataModel` table.
+
+    $ python -m benchmarks.wide_measurements [--cities 5000]
+
+Runs against configured database (migrations must be applied). Every run is rolled
+back, so nothing is left at database.
+
+`insert` is `BulkInsert` of one collecting run, `read (sql)` selects time and
+temperature of all measurements, `read (orm)` loads measurements and reads
+`main_data.temp` the same way as `ReportWeather` does.
+"""
+
+import argparse
+import time
+
+import sqlalchemy as db
+import sqlalchemy.orm as orm
+
+from benchmarks.bulk_insert import EXTRA, MEASURE_AT, SAMPLE_RESPONSE
+from collector.models import (
+    CityModel,
+    ExtraWeatherDataModel,
+    MainWeatherDataModel,
+    MeasurementModel,
+)
+from collector.session import BulkInsert, DBSessionMixin, engine
+
+
+def insert(session: orm.Session, cities: list[CityModel], wide: bool):
+    writer = DBSessionMixin()
+    writer.session = session
+
+    if wide:
+        bulk = BulkInsert(MeasurementModel, extra=ExtraWeatherDataModel)
+    else:
+        bulk = BulkInsert(
+            MeasurementModel, main=MainWeatherDataModel, extra=ExtraWeatherDataModel
+        )
+
+    for city in cities:
+        row = {'city_id': city.id, 'measure_at': MEASURE_AT}
+        if wide:
+            bulk.add(row | SAMPLE_RESPONSE['main'], extra={'data': EXTRA})
+        else:
+            bulk.add(row, main=SAMPLE_RESPONSE['main'], extra={'data': EXTRA})
+    writer.bulk_create(bulk)
+
+
+def read_sql(session: orm.Session, wide: bool):
+    if wide:
+        query = db.select(MeasurementModel.measure_at, MeasurementModel.temp)
+    else:
+        query = db.select(MeasurementModel.measure_at, MainWeatherDataModel.temp).join(
+            MainWeatherDataModel
+        )
+    return session.execute(query).all()
+
+
+def read_orm(session: orm.Session, wide: bool):
+    session.expire_all()
+    measurements: list[MeasurementModel] = session.query(MeasurementModel).all()
+    return [measure.main_data.temp for measure in measurements]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cities', type=int, default=5_000)
+    args = parser.parse_args()
+
+    print(f'{engine.url!r}, {args.cities} measurements per run')
+    results: dict[str, dict[bool, float]] = {}
+    for wide in [False, True]:
+        with orm.Session(engine) as session:
+            cities = [CityModel(name=f'City {i}') for i in range(args.cities)]
+            session.add_all(cities)
+            session.flush()
+
+            for name, run in [
+                ('insert', lambda: insert(session, cities, wide)),
+                ('read (sql)', lambda: read_sql(session, wide)),
+                ('read (orm)', lambda: read_orm(session, wide)),
+            ]:
+                start = time.perf_counter()
+                run()
+                results.setdefault(name, {})[wide] = time.perf_counter() - start
+            session.rollback()
+
+    print(f'{"":<12} {"narrow":>12} {"wide":>12}')
+    for name, result in results.items():
+        narrow, wide = result[False], result[True]
+        print(
+            f'{name:<12} {narrow * 1e3:9.1f} ms {wide * 1e3:9.1f} ms  '
+            f'x{narrow / wide:.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
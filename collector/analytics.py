@@ -0,0 +1,90 @@
+"""
+Vectorized temperature analytics over measurements arrays of one city.
+
+Every function takes arrays ordered by measurement time: `measure_at` is `datetime64`
+array and `values` is float array where not measured values are NaN. Arrays are loaded
+by one query for all cities (see `AnalyzeWeather` service), so nothing is computed row
+by row at Python.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+HOUR = np.timedelta64(1, 'h')
+
+
+def rolling_mean(
+    measure_at: np.ndarray, values: np.ndarray, window: np.timedelta64
+) -> np.ndarray:
+    """
+    Mean of values measured within `window` before every measurement (the measurement
+    itself included). Windows are found by binary search at time array and summed by
+    cumulative sums, so it takes `O(n log n)` for any window size.
+
+    >>> measure_at = np.arange('2022-11-01T00', '2022-11-01T05', dtype='datetime64[h]')
+    >>> rolling_mean(measure_at, np.array([1, 2, 3, np.nan, 5]), 2 * HOUR)
+    array([1. , 1.5, 2.5, 3. , 5. ])
+    """
+    measured = ~np.isnan(values)
+    sums = np.concatenate([[0], np.cumsum(np.where(measured, values, 0))])
+    counts = np.concatenate([[0], np.cumsum(measured)])
+
+    start = np.searchsorted(measure_at, measure_at - window, side='right')
+    stop = np.arange(1, len(values) + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[stop] - sums[start]) / (counts[stop] - counts[start])
+
+
+def percentiles(values: np.ndarray, q: list[float]) -> np.ndarray:
+    """
+    Percentiles of measured values (linear interpolation).
+
+    >>> percentiles(np.array([4, 1, np.nan, 3, 2]), [0, 50, 100])
+    array([1. , 2.5, 4. ])
+    """
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return np.full(len(q), np.nan)
+    return np.percentile(values, q)
+
+
+def degree_hours(measure_at: np.ndarray, values: np.ndarray, threshold: float) -> float:
+    """
+    Integral of temperature excess over `threshold` by time (trapezoidal rule), in
+    degree-hours. Not measured values are skipped, so temperature is interpolated
+    between neighbour measurements.
+
+    >>> measure_at = np.arange('2022-11-01T00', '2022-11-01T04', dtype='datetime64[h]')
+    >>> degree_hours(measure_at, np.array([20, 24, np.nan, 24]), threshold=22)
+    5.0
+    """
+    measured = ~np.isnan(values)
+    hours = (measure_at[measured] - measure_at[0]) / HOUR
+    excess = np.clip(values[measured] - threshold, 0, None)
+    return float(np.trapz(excess, hours))
+
+
+def zscores(values: np.ndarray) -> np.ndarray:
+    """
+    Standard scores of values: distance from mean in standard deviations. Zeros if
+    all values are the same.
+
+    >>> zscores(np.array([1, 2, 3, np.nan]))
+    array([-1.22474487,  0.        ,  1.22474487,         nan])
+    """
+    std = np.nanstd(values)
+    if not std:
+        return np.where(np.isnan(values), np.nan, 0.0)
+    return (values - np.nanmean(values)) / std
+
+
+def anomalies(values: np.ndarray, threshold: float = 3.0) -> np.ndarray:
+    """
+    Indexes of values which standard score is beyond `threshold`.
+
+    >>> anomalies(np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 10]), threshold=2)
+    array([9])
+    """
+    with np.errstate(invalid='ignore'):
+        return np.flatnonzero(np.abs(zscores(values)) > threshold)
@@ -0,0 +1,108 @@
+"""
+Local cache of reports (SQLite file, see `report_cache` configuration).
+
+Cache has generation counter, which is bumped after every service commits its changes
+(see `session_exit`, services which only read data are skipped). Report is stored with
+generation it is made at and returned only while generation is the same, so reports
+between collecting runs are not queried from database again. Least recently used
+reports are evicted above `report_cache_size`.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import time
+
+from collector.configurations import CONFIG, logger
+
+SCHEMA = '''
+PRAGMA journal_mode = WAL;
+CREATE TABLE IF NOT EXISTS generation (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO generation VALUES (1, 0);
+CREATE TABLE IF NOT EXISTS report (
+    key TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    used_at REAL NOT NULL
+);
+'''
+
+
+class ReportCache:
+    """
+    Reports cache opened at current generation. Reports made by opened cache are not
+    stored if generation is bumped in the meantime (they could be made from data
+    before new collecting run).
+    """
+
+    def __init__(self, path: str, size: int) -> None:
+        self.size = size
+        # autocommit mode, every statement is a transaction on its own
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+        self.generation: int = self.connection.execute(
+            'SELECT value FROM generation'
+        ).fetchone()[0]
+
+    def get(self, key: str) -> str | None:
+        row = self.connection.execute(
+            'SELECT value FROM report WHERE key = ? AND generation = ?',
+            (key, self.generation),
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            'UPDATE report SET used_at = ? WHERE key = ?', (time.time(), key)
+        )
+        return row[0]
+
+    def set(self, key: str, value: str):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO report '
+            'SELECT ?, value, ?, ? FROM generation WHERE value = ?',
+            (key, value, time.time(), self.generation),
+        )
+        self.connection.execute(
+            'DELETE FROM report WHERE key NOT IN '
+            '(SELECT key FROM report ORDER BY used_at DESC LIMIT ?)',
+            (self.size,),
+        )
+
+    def bump(self):
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('UPDATE generation SET value = value + 1')
+            self.connection.execute('DELETE FROM report')
+            self.generation = self.connection.execute(
+                'SELECT value FROM generation'
+            ).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def open_report_cache() -> ReportCache | None:
+    """
+    Open reports cache, if it is configured.
+    """
+    if not CONFIG.report_cache:
+        return None
+    return ReportCache(CONFIG.report_cache, CONFIG.report_cache_size)
+
+
+def bump_generation():
+    """
+    Invalidate all cached reports. Must be called after changes are committed, so
+    report made after that sees them.
+    """
+    cache = open_report_cache()
+    if cache is None:
+        return
+    try:
+        cache.bump()
+        logger.debug(f'Reports cache generation is {cache.generation}. ')
+    finally:
+        cache.close()
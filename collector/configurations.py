@@ -8,6 +8,19 @@ logger = init_logger('weather-collector', 'INFO')
 
 
 class DatabaseConfig(pydantic.BaseModel):
+    """
+    bulk_copy: `bool` = True
+        Bulk inserts are made by `COPY FROM STDIN` (psycopg2 driver only). Otherwise by
+        multi-row INSERT statements.
+    pool_size: `int` = 5
+        Amount of connections kept open between collecting runs.
+    max_overflow: `int` = 5
+        Amount of extra connections allowed when all pool connections are in use.
+    pool_pre_ping: `bool` = True
+        Test connection before using it, so collector survives database restarts
+        between runs.
+    """
+
     dialect: str = 'postgresql'
     driver: str | None = 'psycopg2'
     user: str
@@ -16,6 +29,10 @@ class DatabaseConfig(pydantic.BaseModel):
     port: int = 5432
     database: str = 'default'
     echo: bool = False
+    bulk_copy: bool = True
+    pool_size: int = 5
+    max_overflow: int = 5
+    pool_pre_ping: bool = True
 
     @property
     def url(self):
@@ -35,6 +52,82 @@ class SQLiteDatabaseConfig(pydantic.BaseModel):
         return f'sqlite:///{self.path}'
 
 
+class HTTPClientConfig(pydantic.BaseModel):
+    """
+    pool_size: `int` = 10
+        Max amount of kept alive connections per host.
+    connect_timeout: `float` = 5
+        Seconds to wait for establishing connection.
+    read_timeout: `float` = 30
+        Seconds to wait for server response.
+    keepalive_timeout: `float` = 60
+        Seconds to keep idle connection open (for async client only, sync client keeps
+        connections until server close them).
+    """
+
+    pool_size: int = 10
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    keepalive_timeout: float = 60
+
+    @property
+    def timeout(self):
+        return self.connect_timeout, self.read_timeout
+
+
+class QuotaConfig(pydantic.BaseModel):
+    """
+    calls: `int`
+        Amount of calls allowed per `period`.
+    period: `float` = 60
+        Seconds.
+    burst: `int` = 1
+        Amount of calls could be made at once without waiting. Keep it small, otherwise
+        `calls + burst` requests could be made within one `period`.
+    monthly: `int | None` = None
+        Amount of calls allowed per calendar month. Not restricted if None. Calls are
+        counted in memory of collector process, so the count starts over at every
+        restart and is not shared between processes. Keep it below API quota.
+    """
+
+    calls: int
+    period: float = 60
+    burst: int = 1
+    monthly: int | None = None
+
+    @property
+    def rate(self):
+        return self.calls / self.period
+
+
+class RetryConfig(pydantic.BaseModel):
+    """
+    attempts: `int` = 3
+        Max amount of retries for one request.
+    backoff: `float` = 0.5
+        Max delay before the first retry. Doubles for every next one. Real delay is
+        random value up to that max (jitter). Seconds.
+    max_backoff: `float` = 30
+        Upper bound for backoff and for delay requested by `Retry-After` header.
+        Seconds.
+    budget_ratio: `float` = 0.2
+        Retries are allowed for that ratio of all made requests. So when API is down
+        collector do not multiply its load by `attempts` times.
+    budget_minimum: `int` = 10
+        Amount of retries allowed regardless `budget_ratio`.
+    budget_window: `float` = 60
+        Requests and retries are counted for that last period only, so long healthy
+        run does not save up retries for the next outage. Seconds.
+    """
+
+    attempts: int = 3
+    backoff: float = 0.5
+    max_backoff: float = 30
+    budget_ratio: float = 0.2
+    budget_minimum: int = 10
+    budget_window: float = 60
+
+
 class CollectorConfig(pydantic.BaseSettings):
     """
     debug: `bool`
@@ -45,10 +138,51 @@ class CollectorConfig(pydantic.BaseSettings):
         File to describe which cities weather collector fetching data for.
     collect_weather_delay: `float` = 1 * 60 * 60
         Delay between every weather measurement. Seconds. Default: 1 hour.
+    fetch_concurrency: `int` = 10
+        Max amount of simultaneous requests when weather is fetching concurrently.
+    geocoding_cache_ttl: `float` = 30 * 24 * 60 * 60
+        How long Geocoding API results are kept at database. Seconds. Default: 30 days.
     open_weather_key: `str`
         Open Weather API key. Open Weather could be used under FREE plan. Restrictions:
         - 60 calls/minute
         - 1,000,000 calls/month
+    wide_measurements: `bool` = False
+        Store `main` weather data inline at measurement row instead of separate table.
+        Run `migrate_main` to move already collected data.
+    compact_extra: `bool` = False
+        Store static fields of extra weather data (coordinates, Open Weather id, name,
+        etc.) once per city and the rest as JSONB at PostgreSQL or compressed bytes at
+        other databases. Static fields which are changed later (e.g. `timezone` by DST)
+        are kept with measurement. Run `migrate_extra` to convert already collected
+        data.
+    promoted_fields: `dict[str, str]`
+        Hot fields of extra weather data stored at typed (and indexed) measurement
+        columns too: column name and dotted path at response. Columns are fixed (see
+        `PromotedFieldsMixin`): `wind_speed`, `clouds_all`, `visibility` and
+        `weather_main`, only their paths are configurable and some of them could be
+        omitted. Run `backfill_promoted` to fill them for already collected data.
+    retention_months: `int` = 12
+        Months of measurements kept by `retention` service (current month included).
+        Older months are dropped as whole partitions at PostgreSQL.
+    report_cache: `str | None` = None
+        Local SQLite file to cache reports between collecting runs (see
+        `collector.cache`), for instance `report_cache.sqlite3`. Disabled by default.
+    report_cache_size: `int` = 100
+        Max amount of cached reports. Least recently used are evicted.
+    json_decoder: `str` = 'json.loads'
+        Import path of function to decode response body. Any faster implementation
+        could be plugged in here, for instance `orjson.loads` (must be installed).
+    urls: `dict[str, str]`
+        Base url for every third-party API. Point them to local stand-in server (see
+        `standin` service) to run collector without network access and API keys.
+    quotas: `dict[str, QuotaConfig]`
+        Client side rate limits for every third-party API. Fetch services wait for
+        their turn instead of getting 429 response.
+    retry: `RetryConfig`
+        Retry policy for failed requests. Every request retried on its own, so one
+        failed city costs one extra call.
+    http: `HTTPClientConfig`
+        Connections pool and timeouts for HTTP client shared by all fetch services.
     """
 
     debug: bool
@@ -57,6 +191,19 @@ class CollectorConfig(pydantic.BaseSettings):
     cities_file: str = 'cities.json'
     collect_weather_delay: float = 1 * 60 * 60
     retry_collect_delay: float = 3
+    fetch_concurrency: int = 10
+    geocoding_cache_ttl: float = 30 * 24 * 60 * 60
+    wide_measurements: bool = False
+    compact_extra: bool = False
+    promoted_fields: dict[str, str] = {
+        'wind_speed': 'wind.speed',
+        'clouds_all': 'clouds.all',
+        'visibility': 'visibility',
+        'weather_main': 'weather.0.main',
+    }
+    retention_months: int = 12
+    report_cache: str | None = None
+    report_cache_size: int = 100
     open_weather_key: str
 
     POSTGRES_USER: str | None = None
@@ -64,8 +211,37 @@ class CollectorConfig(pydantic.BaseSettings):
     POSTGRES_DB: str | None = None
     POSTGRES_HOST: str | None = None
 
+    json_decoder: str = 'json.loads'
+    urls: dict[str, str] = {
+        'open_weather': 'https://api.openweathermap.org',
+        'geodb': 'http://geodb-free-service.wirefreethought.com',
+    }
+    quotas: dict[str, QuotaConfig] = {
+        'open_weather': QuotaConfig(calls=60, period=60, monthly=1_000_000),
+        'geodb': QuotaConfig(calls=1, period=1),
+    }
+    retry: RetryConfig = RetryConfig()
+    http: HTTPClientConfig = HTTPClientConfig()
     db: DatabaseConfig | SQLiteDatabaseConfig = SQLiteDatabaseConfig()
 
+    @pydantic.validator('urls', 'quotas', pre=True)
+    def merge_with_default_apis(cls, value, field: pydantic.fields.ModelField):
+        # only overridden APIs could be provided (for example, by `URLS__GEODB` env)
+        if isinstance(value, dict):
+            return field.default | value
+        return value
+
+    @pydantic.validator('promoted_fields')
+    def only_promoted_columns(cls, value: dict, field: pydantic.fields.ModelField):
+        # columns are described by model, so unknown one fails inserts
+        unknown = value.keys() - field.default.keys()
+        if unknown:
+            raise ValueError(
+                f'Unknown promoted columns: {sorted(unknown)}. '
+                f'Available: {list(field.default)}. '
+            )
+        return value
+
     @pydantic.validator('db', pre=True)
     def debug_mode_database_sqlite(cls, db: dict, values: dict):
         if not isinstance(db, dict):
@@ -1,3 +1,6 @@
+from datetime import datetime
+
+
 class CollectorBaseException(Exception):
     message: str = ''
 
@@ -17,5 +20,15 @@ class ResponseSchemaError(ResponseError):
     message = 'Unexpected response data schema. '
 
 
+class QuotaExceededError(CollectorBaseException):
+    message = 'API calls quota exceeded. '
+
+    def __init__(
+        self, *args: object, msg: str = '', reset_at: datetime | None = None
+    ) -> None:
+        self.reset_at = reset_at
+        super().__init__(*args, msg=msg)
+
+
 class NoDataError(CollectorBaseException):
     message = 'No data provided. '
@@ -1,5 +1,7 @@
+import importlib
 import logging
-from typing import Literal
+from functools import lru_cache
+from typing import Any, Literal
 
 
 def init_logger(
@@ -17,3 +19,33 @@ def init_logger(
     handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
     logger.addHandler(handler)
     return logger
+
+
+@lru_cache
+def import_string(path: str) -> Any:
+    """
+    Import object by dotted path.
+
+    >>> import json
+    >>> import_string('json.loads') is json.loads
+    True
+    """
+    module, _, name = path.rpartition('.')
+    return getattr(importlib.import_module(module), name)
+
+
+def get_path(data: Any, path: str, default: Any = None) -> Any:
+    """
+    Get value at nested dicts and lists by dotted path.
+
+    >>> get_path({'weather': [{'main': 'Rain'}], 'wind': {}}, 'weather.0.main')
+    'Rain'
+    >>> get_path({'weather': [], 'wind': {}}, 'weather.0.main') is None
+    True
+    """
+    for key in path.split('.'):
+        try:
+            data = data[int(key)] if isinstance(data, list) else data[key]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return default
+    return data
@@ -1,14 +1,123 @@
 from __future__ import annotations
 
+import json
+import zlib
 from datetime import datetime
 from typing import TypeAlias
 
 import sqlalchemy as db
 from sqlalchemy import orm, sql
+from sqlalchemy.dialects import postgresql
+
+from collector.functools import get_path
 
 Base: TypeAlias = orm.declarative_base()  # type: ignore
 
 
+STATIC_WEATHER_FIELDS = [
+    'coord',
+    'id',
+    'name',
+    'timezone',
+    'sys.country',
+    'base',
+    'cod',
+]
+"""
+Fields of Open Weather response which are the same for every city measurement. They are
+stored once per city at compact extra storage mode (see `compact_extra` configuration).
+"""
+
+
+def split_static(data: dict, fields: list[str] = STATIC_WEATHER_FIELDS):
+    """
+    Split data by static fields (dotted paths) and volatile remainder.
+
+    >>> split_static({'id': 1, 'wind': {'speed': 2}, 'sys': {'country': 'RU', 'type': 1}})
+    ({'id': 1, 'sys': {'country': 'RU'}}, {'wind': {'speed': 2}, 'sys': {'type': 1}})
+    """
+    static: dict = {}
+    volatile = {
+        key: value.copy() if isinstance(value, dict) else value
+        for key, value in data.items()
+    }
+    for path in fields:
+        *parents, name = path.split('.')
+        source, target = volatile, static
+        for parent in parents:
+            if not isinstance(source.get(parent), dict):
+                break
+            source, target = source[parent], target.setdefault(parent, {})
+        else:
+            if name in source:
+                target[name] = source.pop(name)
+    for key in [key for key, value in volatile.items() if value == {}]:
+        del volatile[key]
+    return static, volatile
+
+
+def pack_static(
+    data: dict, static: dict | None, fields: list[str] = STATIC_WEATHER_FIELDS
+):
+    """
+    Split data by city `static` fields and packed remainder. City static is stored
+    once and never changed (otherwise earlier packed rows are decoded wrong), so static
+    fields which differ from it (e.g. `timezone` after DST change) are kept at packed
+    remainder. If city has no static yet, static fields of data become the one.
+
+    >>> pack_static({'id': 1, 'timezone': 0, 'cod': 200}, {'id': 1, 'timezone': 3600})
+    ({'id': 1, 'timezone': 3600}, {'timezone': 0, 'cod': 200})
+    """
+    found, packed = split_static(data, fields)
+    if static is None:
+        return found, packed
+
+    changed = [
+        path for path in fields if get_path(found, path) != get_path(static, path)
+    ]
+    differ, _ = split_static(found, changed)
+    return static, merge_static(differ, packed)
+
+
+def merge_static(static: dict, volatile: dict):
+    """
+    Reverse `split_static` (and `pack_static`). Volatile fields take precedence.
+
+    >>> merge_static({'id': 1, 'sys': {'country': 'RU'}}, {'sys': {'type': 1}})
+    {'id': 1, 'sys': {'country': 'RU', 'type': 1}}
+    """
+    data = static | volatile
+    for key, value in static.items():
+        if isinstance(value, dict) and isinstance(volatile.get(key), dict):
+            data[key] = value | volatile[key]
+    return data
+
+
+class CompactJSON(db.types.TypeDecorator):
+    """
+    JSON stored as JSONB at PostgreSQL (binary and compressed by TOAST) or as zlib
+    compressed bytes at other databases. Values are decoded transparently on read.
+    """
+
+    impl = db.LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.JSONB())
+        return dialect.type_descriptor(db.LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return zlib.compress(json.dumps(value, separators=(',', ':')).encode())
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        return json.loads(zlib.decompress(value))
+
+
 class BaseModel(Base):
     __abstract__ = True
 
@@ -40,6 +149,13 @@ class CityModel(BaseModel):
     latitude: float = db.Column(db.Float)
     longitude: float = db.Column(db.Float)
     population: int = db.Column(db.Integer)
+    open_weather_id: int = db.Column(
+        db.Integer, comment='City id at Open Weather. Known after weather fetching.'
+    )
+    weather_static: dict = db.Column(
+        db.JSON,
+        comment='Static fields of Open Weather responses (compact extra storage mode).',
+    )
 
     measurements: list[MeasurementModel] = orm.relationship(
         'MeasurementModel',
@@ -50,8 +166,83 @@ class CityModel(BaseModel):
     def __str__(self) -> str:
         return self.name
 
+    @property
+    def has_coordinates(self):
+        return self.latitude is not None and self.longitude is not None
+
+
+class GeocodingCacheModel(BaseModel):
+    """
+    Geocoding API results for city name and country code. Coordinates are empty if
+    Geocoding has no information about that city.
+
+    Cache is committed separately from weather measurements. So if collecting fails and
+    rolls back, coordinates are not requested again at the next run.
+    """
+
+    __tablename__ = 'geocoding_cache'
+    __table_args__ = (db.UniqueConstraint('name', 'countryCode'),)
+
+    name: str = db.Column(db.String(50), nullable=False)
+    countryCode: str = db.Column(
+        db.String(3), nullable=False, default='', comment='Empty string if unknown.'
+    )
+    latitude: float = db.Column(db.Float)
+    longitude: float = db.Column(db.Float)
+    fetched_at: datetime = db.Column(db.DateTime, nullable=False, comment='UTC.')
+
+
+class MainWeatherDataMixin:
+    """
+    Columns for data at `main` field from measurement response. They are stored at
+    `MainWeatherDataModel` table, or inline at `MeasurementModel` row (wide-row schema,
+    see `wide_measurements` configuration).
+    """
+
+    temp: float = db.Column(db.Float, comment='Temperature. Celsius.')
+    feels_like: float = db.Column(
+        db.Float,
+        comment='This temperature parameter accounts for the human perception of weather. Celsius.',
+    )
+    temp_min: float = db.Column(
+        db.Float,
+        comment='Minimum temperature at the moment. This is minimal currently observed temperature (within large megalopolises and urban areas). Celsius.',
+    )
+    temp_max: float = db.Column(
+        db.Float,
+        comment='Maximum temperature at the moment. This is maximal currently observed temperature (within large megalopolises and urban areas). Celsius.',
+    )
+    pressure: int = db.Column(
+        db.Integer,
+        comment='Atmospheric pressure (on the sea level, if there is no sea_level or grnd_level). hPa.',
+    )
+    humidity: int = db.Column(db.Integer, comment='Humidity. %')
+    sea_level: int = db.Column(
+        db.Integer, comment='Atmospheric pressure on the sea level. hPa.'
+    )
+    grnd_level: int = db.Column(
+        db.Integer, comment='Atmospheric pressure on the ground level. hPa.'
+    )
+
+
+class PromotedFieldsMixin:
+    """
+    Hot fields of extra weather data stored at typed columns, so analytics queries scan
+    (and filter by) plain columns instead of parsing JSON. See `promoted_fields`
+    configuration.
+    """
+
+    wind_speed: float = db.Column(db.Float, index=True, comment='Wind speed. m/s.')
+    clouds_all: int = db.Column(db.Integer, index=True, comment='Cloudiness. %')
+    visibility: int = db.Column(db.Integer, index=True, comment='Visibility. Meters.')
+    weather_main: str = db.Column(
+        db.String(20),
+        index=True,
+        comment='Group of weather parameters (Rain, Snow, Clouds etc.).',
+    )
 
-class MeasurementModel(BaseModel):
+
+class MeasurementModel(MainWeatherDataMixin, PromotedFieldsMixin, BaseModel):
     """
     Open Weather API provides a lot of information about current city weather. Depending
     on location and current weather situation some fields could appear some other could
@@ -65,9 +256,28 @@ class MeasurementModel(BaseModel):
 
     We may describe other tables to store all the data in relational (SQL) way later, if
     we will need it.
+
+    Wide-row schema: `main` data could be stored inline at measurement row instead (one
+    row and no join per measurement). Use `main_data` to read it for both schemas.
+
+    Hot fields of extra data are promoted to measurement columns too (see
+    `PromotedFieldsMixin`).
     """
 
     __tablename__ = 'weather_measurement'
+    __table_args__ = (
+        # Open Weather refreshes measurements once per a few minutes, so the same one
+        # could be fetched again (retries, short delay). It is stored once. Reports and
+        # relationship loads are filtering measurements by city and time by its index
+        db.UniqueConstraint(
+            'city_id', 'measure_at', name='uq_weather_measurement_city_id_measure_at'
+        ),
+        # referenced by children tables together with partitioning key (PostgreSQL
+        # tables are partitioned by `measure_at`, see `collector.partitioning`)
+        db.UniqueConstraint(
+            'id', 'measure_at', name='uq_weather_measurement_id_measure_at'
+        ),
+    )
 
     city_id: int = db.Column(
         db.Integer,
@@ -98,48 +308,93 @@ class MeasurementModel(BaseModel):
         cascade='all, delete-orphan',
     )
 
+    @property
+    def main_data(self) -> MainWeatherDataMixin:
+        """
+        Main data stored inline or at `MainWeatherDataModel` table. Child row is loaded
+        only for measurements which are not migrated to wide-row schema.
+        """
+        return self if self.temp is not None else self.main
 
-class MainWeatherDataModel(BaseModel):
+
+class MeasurementChildMixin:
+    """
+    Reference to measurement. `measure_at` is copied from measurement row, as it is
+    partitioning key for children tables too. So measurement and its children of the
+    same month are at partitions which are dropped together.
+    """
+
+    measurement_id: int = db.Column(db.Integer, index=True)
+    measure_at: datetime = db.Column(
+        db.DateTime, nullable=False, comment='The same as measurement has. UTC.'
+    )
+
+    @orm.declared_attr
+    def __table_args__(cls):
+        return (
+            db.ForeignKeyConstraint(
+                ['measurement_id', 'measure_at'],
+                ['weather_measurement.id', 'weather_measurement.measure_at'],
+                name=f'fk_{cls.__tablename__}_measurement',
+            ),
+        )
+
+
+class MainWeatherDataModel(MeasurementChildMixin, MainWeatherDataMixin, BaseModel):
     """
     Data at `main` field from measurement response.
     """
 
     __tablename__ = 'main_weather_measurement'
 
-    measurement_id = db.Column(db.Integer, db.ForeignKey('weather_measurement.id'))
 
-    temp: float = db.Column(db.Float, comment='Temperature. Celsius.')
-    feels_like: float = db.Column(
-        db.Float,
-        comment='This temperature parameter accounts for the human perception of weather. Celsius.',
-    )
-    temp_min: float = db.Column(
-        db.Float,
-        comment='Minimum temperature at the moment. This is minimal currently observed temperature (within large megalopolises and urban areas). Celsius.',
-    )
-    temp_max: float = db.Column(
-        db.Float,
-        comment='Maximum temperature at the moment. This is maximal currently observed temperature (within large megalopolises and urban areas). Celsius.',
-    )
-    pressure: int = db.Column(
-        db.Integer,
-        comment='Atmospheric pressure (on the sea level, if there is no sea_level or grnd_level). hPa.',
-    )
-    humidity: int = db.Column(db.Integer, comment='Humidity. %')
-    sea_level: int = db.Column(
-        db.Integer, comment='Atmospheric pressure on the sea level. hPa.'
-    )
-    grnd_level: int = db.Column(
-        db.Integer, comment='Atmospheric pressure on the ground level. hPa.'
+class ExtraWeatherDataModel(MeasurementChildMixin, BaseModel):
+    """
+    Additional data from weather measurement. Use `payload` to read it for both storage
+    modes.
+    """
+
+    __tablename__ = 'extra_weather_data'
+
+    data: dict = db.Column(db.JSON)
+    packed: dict = db.Column(
+        CompactJSON,
+        comment='Data without static city fields (compact extra storage mode).',
     )
 
+    @property
+    def payload(self) -> dict:
+        """
+        Extra data stored at both modes: plain `data`, or `packed` volatile data merged
+        with static fields of the city.
+        """
+        if self.packed is None:
+            return self.data
+        return merge_static(self.measurement.city.weather_static or {}, self.packed)
 
-class ExtraWeatherDataModel(BaseModel):
+
+class CityWeatherStatsModel(BaseModel):
     """
-    Additional data from weather measurement.
+    Rollup of measured temperatures for every city. Updated by every collecting run at
+    the same transaction as measurements are inserted (see `collector.stats`), so
+    reports read one row per city instead of scanning all measurements.
     """
 
-    __tablename__ = 'extra_weather_data'
+    __tablename__ = 'city_weather_stats'
 
-    measurement_id = db.Column(db.Integer, db.ForeignKey('weather_measurement.id'))
-    data: dict = db.Column(db.JSON)
+    city_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey('city.id', onupdate='CASCADE', ondelete='CASCADE'),
+        nullable=False,
+        unique=True,
+    )
+    temp_count: int = db.Column(db.Integer, nullable=False, default=0)
+    temp_sum: float = db.Column(db.Float, nullable=False, default=0)
+    temp_sum_squares: float = db.Column(
+        db.Float, nullable=False, default=0, comment='For standard deviation.'
+    )
+    temp_min: float = db.Column(db.Float)
+    temp_max: float = db.Column(db.Float)
+    first_at: datetime = db.Column(db.DateTime, comment='First measurement time. UTC.')
+    last_at: datetime = db.Column(db.DateTime, comment='Last measurement time. UTC.')
+    last_temp: float = db.Column(db.Float, comment='Temperature of last measurement.')
@@ -0,0 +1,250 @@
+"""
+PostgreSQL declarative partitioning of measurements tables by `measure_at` month.
+
+Measurements and their children tables are partitioned by the same key, so one month of
+data is a set of partitions which could be dropped at once (see `retention` service).
+Children tables reference measurement by `(measurement_id, measure_at)`, therefore
+relationship loads are pruned to one partition too.
+
+Tables are converted by migration, partitions for new months are created on insert
+(see `DBSessionMixin.bulk_create`). Other dialects have plain tables.
+"""
+
+from __future__ import annotations
+
+import re
+from datetime import date, datetime
+from typing import Iterable
+
+import sqlalchemy as db
+
+from collector.configurations import logger
+
+TABLES = ['weather_measurement', 'main_weather_measurement', 'extra_weather_data']
+"Partitioned tables. Parent goes first. "
+
+PARTITION_NAME = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def month_start(value: date | datetime) -> date:
+    """
+    >>> month_start(datetime(2022, 11, 25, 10, 30))
+    datetime.date(2022, 11, 1)
+    """
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, amount: int) -> date:
+    """
+    >>> add_months(date(2022, 11, 1), 2), add_months(date(2022, 1, 1), -1)
+    (datetime.date(2023, 1, 1), datetime.date(2021, 12, 1))
+    """
+    index = month.year * 12 + month.month - 1 + amount
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date):
+    """
+    >>> partition_name('weather_measurement', date(2022, 11, 1))
+    'weather_measurement_y2022m11'
+    """
+    return f'{table}_y{month.year}m{month.month:02}'
+
+
+def include_object(object, name: str | None, type_: str, reflected: bool, compare_to):
+    """
+    Alembic autogenerate filter. Partitions (and foreign keys to them, which PostgreSQL
+    makes for every referenced partition) are not described by models.
+    """
+    if type_ == 'table':
+        return not PARTITION_NAME.search(name or '')
+    if type_ == 'foreign_key_constraint':
+        return not PARTITION_NAME.search(object.referred_table.name)
+    return True
+
+
+def is_partitioned(connection: db.engine.Connection) -> bool:
+    if connection.dialect.name != 'postgresql':
+        return False
+    return bool(
+        connection.scalar(
+            db.text(
+                "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"
+            ),
+            {'table': TABLES[0]},
+        )
+    )
+
+
+def get_partitions(connection: db.engine.Connection, table: str) -> dict[date, str]:
+    names = connection.scalars(
+        db.text(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(:table)'
+        ),
+        {'table': table},
+    )
+    partitions = {}
+    for name in names:
+        if match := PARTITION_NAME.search(name):
+            partitions[date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+def get_definitions(connection: db.engine.Connection, table: str) -> list[str]:
+    """
+    Statements to recreate unique constraints and indexes of table (primary key and
+    foreign keys are not included).
+    """
+    constraints = connection.scalars(
+        db.text(
+            "SELECT 'ALTER TABLE ' || :table || ' ADD CONSTRAINT ' || conname || ' ' "
+            '|| pg_get_constraintdef(oid) FROM pg_constraint '
+            "WHERE conrelid = to_regclass(:table) AND contype = 'u'"
+        ),
+        {'table': table},
+    ).all()
+    indexes = connection.scalars(
+        db.text(
+            'SELECT indexdef FROM pg_indexes WHERE tablename = :table '
+            'AND indexname NOT IN '
+            '(SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:table))'
+        ),
+        {'table': table},
+    ).all()
+    return constraints + indexes
+
+
+def create_partitions(
+    connection: db.engine.Connection,
+    months: Iterable[date],
+    tables: Iterable[str] = TABLES,
+    parent: str | None = None,
+):
+    """
+    Create missing partitions for provided months. `parent` is a table to attach
+    partitions to, if it is not the same as `table` (while converting tables).
+    """
+    months = sorted(set(months))
+    for table in tables:
+        existing = get_partitions(connection, parent or table)
+        for month in months:
+            if month in existing:
+                continue
+            name = partition_name(table, month)
+            connection.execute(
+                db.text(
+                    f'CREATE TABLE IF NOT EXISTS {name} '
+                    f'PARTITION OF {parent or table} '
+                    f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+                )
+            )
+            logger.info(f'Partition {name} is created. ')
+
+
+def ensure_partitions(connection: db.engine.Connection, values: Iterable[datetime]):
+    """
+    Partitions for months of provided values and for the next one, so new month
+    partitions are created in advance.
+    """
+    months = {month_start(value) for value in values}
+    if not months or not is_partitioned(connection):
+        return
+    create_partitions(connection, months | {add_months(max(months), 1)})
+
+
+def drop_partitions(connection: db.engine.Connection, before: date) -> list[str]:
+    """
+    Drop whole months of measurements older than `before` month. Children partitions
+    are dropped first, parent partition is detached before dropping, as it is
+    referenced by children tables.
+    """
+    dropped = []
+    for table in reversed(TABLES):
+        for month, name in sorted(get_partitions(connection, table).items()):
+            if month >= month_start(before):
+                continue
+            connection.execute(db.text(f'ALTER TABLE {table} DETACH PARTITION {name}'))
+            connection.execute(db.text(f'DROP TABLE {name}'))
+            dropped.append(name)
+    return dropped
+
+
+def convert_tables(connection: db.engine.Connection, partitioned: bool = True):
+    """
+    Recreate measurements tables as partitioned (or back to plain) and copy data. Used
+    by migration, tables are locked for the whole conversion.
+    """
+    months: set[date] = set()
+    if partitioned:
+        first, last = connection.execute(
+            db.text('SELECT min(measure_at), max(measure_at) FROM weather_measurement')
+        ).one()
+        today = month_start(datetime.utcnow())
+        month = month_start(first or today)
+        while month <= add_months(month_start(last or today), 1):
+            months.add(month)
+            month = add_months(month, 1)
+        months |= {today, add_months(today, 1)}
+
+    partition_by = ' PARTITION BY RANGE (measure_at)' if partitioned else ''
+    definitions = {table: get_definitions(connection, table) for table in TABLES}
+    for table in TABLES:
+        connection.execute(
+            db.text(
+                f'CREATE TABLE {table}__new '
+                f'(LIKE {table} INCLUDING DEFAULTS INCLUDING COMMENTS){partition_by}'
+            )
+        )
+        if partitioned:
+            create_partitions(connection, months, [table], parent=f'{table}__new')
+        connection.execute(db.text(f'INSERT INTO {table}__new SELECT * FROM {table}'))
+        connection.execute(
+            db.text(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}__new.id')
+        )
+
+    for table in reversed(TABLES):
+        connection.execute(db.text(f'DROP TABLE {table}'))
+    for table in TABLES:
+        connection.execute(db.text(f'ALTER TABLE {table}__new RENAME TO {table}'))
+        if not partitioned:
+            # partitioned table can not have primary key without partitioning column
+            connection.execute(db.text(f'ALTER TABLE {table} ADD PRIMARY KEY (id)'))
+        for definition in definitions[table]:
+            if (
+                partitioned
+                and 'UNIQUE' in definition
+                and 'measure_at' not in definition
+            ):
+                # as well as unique constraints without partitioning column
+                continue
+            connection.execute(db.text(definition))
+
+    if not any(
+        'uq_weather_measurement_id_measure_at' in definition
+        for definition in definitions['weather_measurement']
+    ):
+        # children tables reference measurement together with partitioning key
+        connection.execute(
+            db.text(
+                'ALTER TABLE weather_measurement '
+                'ADD CONSTRAINT uq_weather_measurement_id_measure_at '
+                'UNIQUE (id, measure_at)'
+            )
+        )
+    connection.execute(
+        db.text(
+            'ALTER TABLE weather_measurement '
+            'ADD FOREIGN KEY (city_id) REFERENCES city (id) '
+            'ON UPDATE CASCADE ON DELETE CASCADE'
+        )
+    )
+    for table in TABLES[1:]:
+        connection.execute(
+            db.text(
+                f'ALTER TABLE {table} ADD CONSTRAINT fk_{table}_measurement '
+                'FOREIGN KEY (measurement_id, measure_at) '
+                'REFERENCES weather_measurement (id, measure_at)'
+            )
+        )
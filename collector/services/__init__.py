@@ -1,11 +1,29 @@
 __all__ = [
+    'AnalyzeWeather',
     'BaseService',
     'FetchCities',
     'InitCities',
     'CollectScheduler',
+    'ExportWeather',
     'FetchWeather',
+    'BackfillPromotedFields',
+    'MigrateExtraData',
+    'MigrateMainData',
+    'RebuildStats',
+    'Retention',
+    'StandInServer',
 ]
 
+from .analytics import AnalyzeWeather
 from .base import BaseService
 from .cities import FetchCities, InitCities
+from .export import ExportWeather
+from .maintenance import (
+    BackfillPromotedFields,
+    MigrateExtraData,
+    MigrateMainData,
+    RebuildStats,
+    Retention,
+)
+from .standin import StandInServer
 from .weather import CollectScheduler, FetchWeather
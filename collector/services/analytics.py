@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import argparse
+import sys
+from datetime import datetime
+from functools import partial
+from typing import Callable, Iterator, NamedTuple
+
+import numpy as np
+import sqlalchemy as db
+
+from collector.analytics import (
+    HOUR,
+    anomalies,
+    degree_hours,
+    percentiles,
+    rolling_mean,
+    zscores,
+)
+from collector.exceptions import NoDataError
+from collector.models import CityModel, MainWeatherDataModel, MeasurementModel
+from collector.services.base import (
+    BaseService,
+    add_window_arguments,
+    get_window_filters,
+)
+from collector.session import DBSessionMixin
+
+########################################################################################
+# Analyze Weather Service
+########################################################################################
+
+
+class CitySeries(NamedTuple):
+    """
+    Measurements of one city ordered by time, as contiguous arrays.
+    """
+
+    name: str
+    measure_at: np.ndarray
+    temp: np.ndarray
+
+
+class AnalyzeWeather(BaseService, DBSessionMixin):
+    """
+    Temperature analytics for every city: rolling means, percentiles, degree-hours
+    above threshold and anomalies (see `collector.analytics`). Default output is
+    `sys.stdout`.
+
+    Measurements of time window are loaded by one query into NumPy arrays (split by
+    cities), all computations are vectorized.
+    """
+
+    command = 'analyze'
+    output = sys.stdout
+    read_only = True
+
+    def __init__(
+        self,
+        rolling: float | None = None,
+        percentiles: list[float] | None = None,
+        degree_hours: float | None = None,
+        anomalies: float | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        city: list[str] | None = None,
+        **kwargs,
+    ) -> None:
+        self.methods: list[Callable[[], Iterator[str]]] = []
+        if rolling is not None:
+            self.methods.append(partial(self.get_rolling, rolling))
+        if percentiles:
+            self.methods.append(partial(self.get_percentiles, percentiles))
+        if degree_hours is not None:
+            self.methods.append(partial(self.get_degree_hours, degree_hours))
+        if anomalies is not None:
+            self.methods.append(partial(self.get_anomalies, anomalies))
+        if not self.methods:
+            raise NoDataError(
+                'No analytics requested. Provide any of --rolling, --percentiles, '
+                '--degree-hours or --anomalies. '
+            )
+
+        self.since = since
+        self.until = until
+        self.cities = city or []
+        self.series: list[CitySeries] = []
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--rolling',
+            metavar='<hours>',
+            type=float,
+            help='report rolling mean temperature for every measurement',
+        )
+        parser.add_argument(
+            '--percentiles',
+            metavar='<percent>',
+            type=float,
+            nargs='+',
+            help='report temperature percentiles (e.g. 5 50 95)',
+        )
+        parser.add_argument(
+            '--degree-hours',
+            metavar='<celsius>',
+            type=float,
+            help='report degree-hours of temperature above threshold',
+        )
+        parser.add_argument(
+            '--anomalies',
+            metavar='<z-score>',
+            type=float,
+            nargs='?',
+            const=3.0,
+            help='report temperatures beyond z-score threshold. Default: 3',
+        )
+        add_window_arguments(parser)
+
+    def execute(self):
+        super().execute()
+        self.series = self.load_series()
+        for method in self.methods:
+            for line in method():
+                self.output.write(line)
+            self.output.write('\n')
+            self.output.flush()
+
+    def load_series(self) -> list[CitySeries]:
+        """
+        Measurements of every city loaded by one bulk fetch. Rows are ordered by
+        `(city_id, measure_at)` unique index and columns are converted to arrays at
+        once, cities are array slices (not copies).
+        """
+        temp = db.func.coalesce(MeasurementModel.temp, MainWeatherDataModel.temp)
+        rows = self.session.execute(
+            db.select(MeasurementModel.city_id, MeasurementModel.measure_at, temp)
+            .outerjoin(MainWeatherDataModel)
+            .where(*get_window_filters(self.since, self.until, self.cities))
+            .order_by(MeasurementModel.city_id, MeasurementModel.measure_at)
+        ).all()
+        if not rows:
+            return []
+
+        city_ids, measure_at, temps = zip(*rows)
+        city_ids = np.array(city_ids, dtype=np.int64)
+        measure_at = np.array(measure_at, dtype='datetime64[us]')
+        temps = np.array(temps, dtype=np.float64)  # not measured (None) is NaN
+
+        names = dict(
+            self.session.execute(db.select(CityModel.id, CityModel.name)).all()
+        )
+        bounds = [0, *(np.flatnonzero(np.diff(city_ids)) + 1), len(city_ids)]
+        return [
+            CitySeries(
+                names[city_ids[start]], measure_at[start:stop], temps[start:stop]
+            )
+            for start, stop in zip(bounds, bounds[1:])
+        ]
+
+    def get_rolling(self, hours: float) -> Iterator[str]:
+        window = np.timedelta64(int(hours * 3600), 's')
+        for series in self.series:
+            means = rolling_mean(series.measure_at, series.temp, window)
+            for measure_at, mean in zip(series.measure_at.astype(datetime), means):
+                yield (
+                    f'\nRolling {hours:g} h mean temperature at {series.name} '
+                    f'is {mean:.2f} C. ({measure_at})'
+                )
+
+    def get_percentiles(self, q: list[float]) -> Iterator[str]:
+        for series in self.series:
+            values = percentiles(series.temp, q)
+            described = ', '.join(
+                f'p{percent:g} {value:.2f} C' for percent, value in zip(q, values)
+            )
+            yield f'\nTemperature percentiles at {series.name}: {described}.'
+
+    def get_degree_hours(self, threshold: float) -> Iterator[str]:
+        for series in self.series:
+            total = degree_hours(series.measure_at, series.temp, threshold)
+            hours = (series.measure_at[-1] - series.measure_at[0]) / HOUR
+            yield (
+                f'\nDegree-hours above {threshold:g} C at {series.name} '
+                f'is {total:.1f} C*h. ({hours:.1f} hours measured)'
+            )
+
+    def get_anomalies(self, threshold: float) -> Iterator[str]:
+        for series in self.series:
+            scores = zscores(series.temp)
+            for i in anomalies(series.temp, threshold):
+                measure_at = series.measure_at[i].astype(datetime)
+                yield (
+                    f'\nAnomaly temperature at {series.name} is {series.temp[i]} C, '
+                    f'z-score {scores[i]:.2f}. ({measure_at})'
+                )
@@ -1,14 +1,29 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import inspect
+import time
+from datetime import datetime
 from http import HTTPStatus
 from typing import Generic, Iterable, Type, TypeVar
 
+import aiohttp
 import requests
+import sqlalchemy as db
 from pydantic import BaseModel, ValidationError, parse_obj_as
+from requests.adapters import HTTPAdapter
 
 from collector.configurations import CONFIG, logger
 from collector.exceptions import ResponseError, ResponseSchemaError
+from collector.functools import import_string
+from collector.models import CityModel, MeasurementModel
+from collector.throttling import (
+    RETRY_STATUSES,
+    get_limiter,
+    get_retry_delay,
+    retry_budget,
+)
 
 _SchemaType = TypeVar('_SchemaType', bound=BaseModel | Iterable[BaseModel])
 """
@@ -17,6 +32,95 @@ Also bound to Iterable, because JSON response could be a `list[BaseModel]`.
 """
 
 
+def init_client() -> requests.Session:
+    """
+    Init HTTP client shared by all fetch services. Connections are pooled and kept
+    alive, so TCP and TLS handshakes are made once per host, not for every request.
+    """
+    client = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=CONFIG.http.pool_size)
+    client.mount('http://', adapter)
+    client.mount('https://', adapter)
+    return client
+
+
+def init_async_client() -> aiohttp.ClientSession:
+    """
+    Async version of `init_client`. Must be called inside running event loop, because
+    aiohttp session is bound to it.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=CONFIG.fetch_concurrency,
+        limit_per_host=CONFIG.http.pool_size,
+        keepalive_timeout=CONFIG.http.keepalive_timeout,
+    )
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=CONFIG.http.connect_timeout,
+        sock_read=CONFIG.http.read_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+client = init_client()
+
+
+def add_window_arguments(parser: argparse.ArgumentParser):
+    """
+    Arguments to select measurements by time window and cities names.
+    """
+    parser.add_argument(
+        '--since',
+        metavar='<datetime>',
+        type=datetime.fromisoformat,
+        help='measurements since that time (UTC, ISO format)',
+    )
+    parser.add_argument(
+        '--until',
+        metavar='<datetime>',
+        type=datetime.fromisoformat,
+        help='measurements before that time (UTC, ISO format)',
+    )
+    parser.add_argument(
+        '--city',
+        metavar='<name>',
+        action='append',
+        help='measurements of that city only (could be provided a few times)',
+    )
+
+
+def get_window_filters(
+    since: datetime | None = None,
+    until: datetime | None = None,
+    cities: list[str] | None = None,
+) -> list[db.sql.ColumnElement]:
+    """
+    Measurements filters by time window and cities names (see `add_window_arguments`).
+    Time window is pruned to its partitions at PostgreSQL.
+    """
+    filters = []
+    if since:
+        filters.append(MeasurementModel.measure_at >= since)
+    if until:
+        filters.append(MeasurementModel.measure_at < until)
+    if cities:
+        ids = db.select(CityModel.id).where(CityModel.name.in_(cities))
+        filters.append(MeasurementModel.city_id.in_(ids))
+    return filters
+
+
+def add_chunk_size_argument(parser: argparse.ArgumentParser, help: str):
+    """
+    Argument for amount of rows processed at once. `help` tells what is made with them.
+    """
+    parser.add_argument(
+        '--chunk-size',
+        metavar='<amount>',
+        type=int,
+        default=10_000,
+        help=f'rows amount {help} at once. Default: 10000',
+    )
+
+
 class BaseService:
     command: str = 'service_name'
     "Command name to run service in command line. "
@@ -30,14 +134,18 @@ class BaseService:
         Parsing command line args and getting service initialized with thouse args.
         """
         parser = argparse.ArgumentParser(description='Weather Collector. ')
-        parser.add_argument(
-            'service',
-            type=str,
-            help='service to proceed',
-            choices=[service.command for service in cls.__subclasses__()],
+        subparsers = parser.add_subparsers(
+            dest='service', required=True, help='service to proceed'
         )
+        # every service has its own arguments
         for service in cls.__subclasses__():
-            service.add_argument(parser)
+            service.add_argument(
+                subparsers.add_parser(
+                    service.command,
+                    description=inspect.getdoc(service),
+                    formatter_class=argparse.RawDescriptionHelpFormatter,
+                )
+            )
 
         args = parser.parse_args(argv)
         service_class = cls.get_service(command=args.service)
@@ -77,7 +185,10 @@ class BaseService:
 
 
 class FetchServiceMixin(Generic[_SchemaType]):
-    url: str = ''
+    api: str = 'open_weather'
+    "API name at `urls` and `quotas` configuration. Rate limiter is shared per API. "
+    path: str = ''
+    "Endpoint path. Base url is taken from configuration, so it could be overridden. "
     params: dict = {
         "appid": CONFIG.open_weather_key,
         "units": "metric",
@@ -85,16 +196,85 @@ class FetchServiceMixin(Generic[_SchemaType]):
     schema: Type[_SchemaType]
     "Pydantic Model to parse response JSON data. Must be defined at inhereted classes. "
 
-    def fetch(self) -> _SchemaType:
-        self.response = requests.get(self.url, self.params)
+    @property
+    def url(self) -> str:
+        return CONFIG.urls[self.api] + self.path
+
+    def fetch(self, params: dict | None = None) -> _SchemaType:
+        """
+        Fetch and parse response. `params` are used instead of class ones, so they could
+        be made for every call without changing shared class attribute.
+        """
+        retry_budget.deposit()
+        attempt = 0
+        while True:
+            get_limiter(self.api).acquire()
+            try:
+                self.response = client.get(
+                    self.url,
+                    params=self.params if params is None else params,
+                    timeout=CONFIG.http.timeout,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error, retry_after = ResponseError(e), None
+            else:
+                if self.response.status_code == HTTPStatus.OK:
+                    break
+                if self.response.status_code not in RETRY_STATUSES:
+                    raise ResponseError(self.response, self.response.text)
+                error = ResponseError(self.response, self.response.text)
+                retry_after = self.response.headers.get('Retry-After')
+
+            delay = get_retry_delay(attempt, retry_after)
+            if delay is None:
+                raise error
+            logger.warning(f'Request failed. Retry in {delay:.2f} sec. {error}')
+            time.sleep(delay)
+            attempt += 1
+
+        return self.parse(self.decode(self.response.content))
+
+    async def fetch_async(self, session: aiohttp.ClientSession, params: dict) -> dict:
+        """
+        Async version of `fetch`. Many requests are running at the same time, therefore
+        response is not stored at instance and `params` are passed explicitly. Returns
+        raw JSON data, call for `parse` to get schema instance.
+        """
+        retry_budget.deposit()
+        attempt = 0
+        while True:
+            await get_limiter(self.api).acquire_async()
+            try:
+                async with session.get(self.url, params=params) as response:
+                    if response.status == HTTPStatus.OK:
+                        return self.decode(await response.read())
+                    if response.status not in RETRY_STATUSES:
+                        raise ResponseError(response, await response.text())
+                    error = ResponseError(response, await response.text())
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error, retry_after = ResponseError(e), None
+
+            delay = get_retry_delay(attempt, retry_after)
+            if delay is None:
+                raise error
+            logger.warning(f'Request failed. Retry in {delay:.2f} sec. {error}')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def decode(self, content: bytes):
+        """
+        Decode response body. That is made once per response, all others steps are
+        working with decoded data. Decoder is pluggable by `json_decoder` configuration.
+        """
+        return import_string(CONFIG.json_decoder)(content)
 
-        if self.response.status_code != HTTPStatus.OK:
-            raise ResponseError(self.response, self.response.json())
+    def parse(self, data) -> _SchemaType:
         if not getattr(self, 'schema', None):
-            return self.response.json()
+            return data
 
         try:
-            instance = parse_obj_as(self.schema, self.response.json())
+            instance = parse_obj_as(self.schema, data)
         except ValidationError as e:
             raise ResponseSchemaError(e)
 
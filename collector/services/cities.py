@@ -1,17 +1,25 @@
 from __future__ import annotations
 
 import argparse
-import json
+import asyncio
 import os
 import unicodedata
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
 
+import aiohttp
 import pydantic
+import sqlalchemy as db
+import sqlalchemy.orm as orm
+from sqlalchemy import sql
+from sqlalchemy.dialects import postgresql, sqlite
 
 from collector.configurations import CONFIG, logger
-from collector.exceptions import NoDataError
-from collector.models import CityModel
-from collector.services.base import BaseService, FetchServiceMixin
+from collector.exceptions import NoDataError, ResponseError
+from collector.models import CityModel, GeocodingCacheModel
+from collector.services.base import BaseService, FetchServiceMixin, init_async_client
 from collector.session import DBSessionMixin
+from collector.throttling import get_limiter
 
 ########################################################################################
 # Cities Schemas
@@ -25,6 +33,7 @@ class CitySchema(pydantic.BaseModel):
     latitude: float | None
     longitude: float | None
     population: int | None
+    open_weather_id: int | None
 
     @pydantic.validator('name')
     def clean_name_unicode(cls, value):
@@ -64,7 +73,11 @@ class InitCities(BaseService, DBSessionMixin):
     command = 'init_cities'
 
     def __init__(
-        self, *, override: bool = False, predefined: list[CitySchema] = [], **kwargs
+        self,
+        *,
+        override: bool = False,
+        predefined: Iterable[CitySchema] = [],
+        **kwargs,
     ) -> None:
         self.predefined = predefined
         self.override = override
@@ -81,18 +94,21 @@ class InitCities(BaseService, DBSessionMixin):
 
     def execute(self):
         super().execute()
-        cities = self.predefined or self.load_from_file()
-        if not cities:
-            raise NoDataError(f'{CONFIG.cities_file} has no cities to initialize. ')
-
         if self.override:
             previous: list[CityModel] = self.query(CityModel).all()
             for city in previous:
                 city.is_tracked = False
             logger.info(f'{len(previous)} cities are not tracked anymore. ')
 
-        self.create_from_schema(CityModel, *cities)
-        logger.info(f'Add new {len(cities)} records to {CityModel}. ')
+        # `predefined` could be any iterable (cities are added as they are coming)
+        amount = 0
+        for city in self.predefined or self.load_from_file():
+            self.create_from_schema(CityModel, city)
+            amount += 1
+
+        if not amount:
+            raise NoDataError(f'{CONFIG.cities_file} has no cities to initialize. ')
+        logger.info(f'Add new {amount} records to {CityModel}. ')
 
     def load_from_file(self):
         try:
@@ -115,7 +131,8 @@ class FetchCities(BaseService, FetchServiceMixin[CitiesListSchema]):
     """
 
     command = 'fetch_cities'
-    url = 'http://geodb-free-service.wirefreethought.com/v1/geo/cities'
+    api = 'geodb'
+    path = '/v1/geo/cities'
 
     # [NOTE]
     # We are using GeoDB API Service under FREE plan provided at specified url.
@@ -129,46 +146,103 @@ class FetchCities(BaseService, FetchServiceMixin[CitiesListSchema]):
     }
     schema = CitiesListSchema
 
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        # passed to `InitCities`
+        InitCities.add_argument(parser)
+
     def execute(self):
         super().execute()
-        cities = self.fetch()
-        self.append_to_file(cities)
+        cities = self.stream_to_file(self.fetch())
+        InitCities(predefined=cities, **self.init_kwargs).execute()
+
         logger.info(
             f'Successfully fetched {CONFIG.cities_amount} cities and stored them at '
             f'{CONFIG.cities_file} file. Go there to confirm results. You can make any '
             'changes and commit them by calling for `init_cities` with --override flag.'
         )
 
-        InitCities(predefined=cities, **self.init_kwargs).execute()
-
-    def fetch(self):
-        cities: list[CitySchema] = []
-        repeats = CONFIG.cities_amount // self.restricted_limit
-        remains = CONFIG.cities_amount % self.restricted_limit
-
-        for i in range(repeats + int(bool(remains))):
-            if i == repeats:
-                self.params['limit'] = remains  # for final fetching
-
-            offset = i * self.restricted_limit
-            self.params['offset'] = offset
-
-            logger.info(f'Fetching cities: {offset}/{CONFIG.cities_amount}')
-
-            # `data` is a core field at response json with list of cities
-            cities += super().fetch().data
-
-        self.params['limit'] = self.restricted_limit
-        return cities
-
-    def append_to_file(self, cities: list[CitySchema]):
+    def get_pages(self) -> list[dict]:
+        """
+        Params for every page request. They are computed up front, so pages could be
+        fetched independently.
+        """
+        return [
+            self.params
+            | {
+                'offset': offset,
+                'limit': min(self.restricted_limit, CONFIG.cities_amount - offset),
+            }
+            for offset in range(0, CONFIG.cities_amount, self.restricted_limit)
+        ]
+
+    def fetch(self) -> Iterator[list[CitySchema]]:  # type: ignore
+        """
+        Fetch all pages concurrently (within GeoDB rate limit) and yield cities of every
+        page as soon as it and all previous pages arrive. So pages are yielded by offset
+        (ordered by population, as API lists them), pages arrived earlier are waiting
+        at their tasks for previous ones.
+
+        Event loop is running only while waiting for the next page, so caller could
+        handle received cities at usual (sync) way.
+        """
+        loop = asyncio.new_event_loop()
+        session = loop.run_until_complete(self.open_session())
+        tasks = [
+            loop.create_task(self.fetch_page(session, params))
+            for params in self.get_pages()
+        ]
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = loop.run_until_complete(
+                    asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                )
+                for task in done:
+                    task.result()  # any failed page fails fetching at once
+                while tasks and tasks[0].done():
+                    yield tasks.pop(0).result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.run_until_complete(session.close())
+            loop.close()
+            logger.info(f'GeoDB calls: {get_limiter(self.api).stats}. ')
+
+    @staticmethod
+    async def open_session():
+        return init_async_client()
+
+    async def fetch_page(self, session: aiohttp.ClientSession, params: dict):
+        logger.info(f'Fetching cities: {params["offset"]}/{CONFIG.cities_amount}')
+
+        # `data` is a core field at response json with list of cities
+        return self.parse(await self.fetch_async(session, params)).data
+
+    def stream_to_file(self, pages: Iterable[list[CitySchema]]) -> Iterator[CitySchema]:
+        """
+        Write cities to JSON file as they are coming (by page offset, see `fetch`) and
+        pass them further.
+        """
         if os.path.isfile(CONFIG.cities_file):
             logger.warning(
                 f'{CONFIG.cities_file} already exists. All data will be overridden. '
             )
 
         with open(CONFIG.cities_file, 'w+', encoding='utf-8') as file:
-            json.dump([city.dict() for city in cities], file)
+            file.write('[')
+            try:
+                separator = ''
+                for page in pages:
+                    for city in page:
+                        file.write(separator + city.json())
+                        separator = ', '
+                        yield city
+                    file.flush()
+            finally:
+                file.write(']')
 
 
 ########################################################################################
@@ -183,7 +257,9 @@ class FetchCoordinates(
 ):
     """
     If city object doesn't have coordinates, we should get them by calling for
-    Open Weather Geocoding API. The API documentation says:
+    Open Weather Geocoding API. Results are stored at durable cache (see
+    `GeocodingCacheModel`), so API is called only once per city. The API documentation
+    says:
 
     `Please use Geocoder API if you need automatic convert city names and zip-codes to
     geo coordinates and the other way around. Please note that API requests by city
@@ -193,42 +269,158 @@ class FetchCoordinates(
     """
 
     command = 'fetch_coordinates'
-    url = 'http://api.openweathermap.org/geo/1.0/direct'
+    path = '/geo/1.0/direct'
     schema = list[CityCoordinatesSchema]
     params = {
         "appid": CONFIG.open_weather_key,
         "limit": 10,
     }
 
-    def __init__(self, city: CityModel | str, **kwargs) -> None:
-        if isinstance(city, str):
-            self.city: CityModel = (
-                self.query(CityModel).filter(CityModel.name == city).one()
+    def __init__(self, *cities: CityModel | str, **kwargs) -> None:
+        """
+        Resolve coordinates for provided cities (objects or names). By default for all
+        tracked cities which have no coordinates.
+        """
+        if not cities:
+            cities = self.query(CityModel).filter(
+                CityModel.is_tracked,
+                sql.or_(CityModel.latitude.is_(None), CityModel.longitude.is_(None)),
             )
-        else:
-            self.city = city
 
-        self.params['q'] = f'{self.city.name},{self.city.countryCode}'
+        self.cities: list[CityModel] = [
+            self.query(CityModel).filter(CityModel.name == city).one()
+            if isinstance(city, str)
+            else city
+            for city in cities
+        ]
         super().__init__(**kwargs)
 
     def execute(self):
         super().execute()
 
-        geo_list = self.fetch()
-        if not geo_list:
-            raise NoDataError(
-                'Getting coordinates failed. '
-                f'Geocoding has no information about {self.city}. '
-            )
+        # [NOTE]
+        # Cache is stored by separate session, not by service one (which is shared with
+        # collecting run). So resolved coordinates survive failed run.
+        with self.separate_session() as cache:
+            entries = self.get_cached(cache, self.cities)
+            cache.commit()  # read transaction is not kept open while fetching
+            try:
+                errors = self.resolve(entries)
+            finally:
+                # fetched entries are stored even if resolving is interrupted
+                self.store_cached(cache, list(entries.values()))
+                cache.commit()
+
+        for error in errors:
+            logger.warning(f'{error}')
+        if errors and len(errors) == len(self.cities):
+            raise errors[0]
+
+    @staticmethod
+    def cache_key(city: CityModel):
+        return city.name, city.countryCode or ''
+
+    def get_cached(self, cache: orm.Session, cities: list[CityModel]):
+        """
+        Get cache entries for all cities by one query.
+        """
+        names = {city.name for city in cities}
+        entries: list[GeocodingCacheModel] = (
+            cache.query(GeocodingCacheModel)
+            .filter(GeocodingCacheModel.name.in_(names))
+            .all()
+        )
+        return {(entry.name, entry.countryCode): entry for entry in entries}
+
+    def store_cached(self, cache: orm.Session, entries: list[GeocodingCacheModel]):
+        """
+        Store new cache entries by upsert, so the same city cached by concurrent run at
+        the same time does not fail this one (the last fetched coordinates are kept).
+        Updated entries are flushed by `cache` session as usual.
+        """
+        rows = [
+            {
+                column: getattr(entry, column)
+                for column in [
+                    'name',
+                    'countryCode',
+                    'latitude',
+                    'longitude',
+                    'fetched_at',
+                ]
+            }
+            for entry in entries
+            if db.inspect(entry).transient
+        ]
+        if not rows:
+            return
+
+        dialect = postgresql if cache.bind.dialect.name == 'postgresql' else sqlite
+        insert = dialect.insert(GeocodingCacheModel)
+        cache.execute(
+            insert.on_conflict_do_update(
+                index_elements=['name', 'countryCode'],
+                set_={
+                    column: insert.excluded[column]
+                    for column in ['latitude', 'longitude', 'fetched_at']
+                },
+            ),
+            rows,
+        )
+
+    def resolve(
+        self, entries: dict[tuple[str, str], GeocodingCacheModel]
+    ) -> list[ResponseError]:
+        """
+        Set coordinates of cities from cache `entries`. Missed and expired entries are
+        fetched and put to `entries`. Returns failed requests.
+        """
+        errors: list[ResponseError] = []
+        expired_at = datetime.utcnow() - timedelta(seconds=CONFIG.geocoding_cache_ttl)
+
+        for city in self.cities:
+            key = self.cache_key(city)
+            entry = entries.get(key)
+            if entry is None or entry.fetched_at < expired_at:
+                try:
+                    entry = entries[key] = self.fetch_to_cache(city, entry)
+                except ResponseError as e:
+                    errors.append(e)
+                    continue
+
+            if entry.latitude is None or entry.longitude is None:
+                # [NOTE]
+                # Not found result is cached as well, so it is not an error: city is not
+                # fetched again until cache entry is expired.
+                logger.warning(
+                    'Getting coordinates failed. '
+                    f'Geocoding has no information about {city}. '
+                )
+                continue
+
+            city.latitude = entry.latitude
+            city.longitude = entry.longitude
+
+        return errors
+
+    def fetch_to_cache(
+        self, city: CityModel, entry: GeocodingCacheModel | None
+    ) -> GeocodingCacheModel:
+        geo_list = self.fetch(city)
         if len(geo_list) > 1:
-            logger.warning(
-                f'Geocoding has many records for {self.city}. Taking the first.'
-            )
+            logger.warning(f'Geocoding has many records for {city}. Taking the first.')
+        coordinates = geo_list[0] if geo_list else None
+
+        if not entry:
+            name, country_code = self.cache_key(city)
+            entry = GeocodingCacheModel(name=name, countryCode=country_code)
 
-        coordinates = geo_list[0]
-        self.city.latitude = coordinates.lat
-        self.city.longitude = coordinates.lon
+        entry.latitude = coordinates.lat if coordinates else None
+        entry.longitude = coordinates.lon if coordinates else None
+        entry.fetched_at = datetime.utcnow()
+        return entry
 
-    def fetch(self):
-        logger.info(f'Fetching coordinates for {self.city}. ')
+    def fetch(self, city: CityModel):  # type: ignore
+        logger.info(f'Fetching coordinates for {city}. ')
+        self.params['q'] = f'{city.name},{city.countryCode}'
         return super().fetch()
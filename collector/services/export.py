@@ -0,0 +1,469 @@
+from __future__ import annotations
+
+import abc
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime
+
+import sqlalchemy as db
+from sqlalchemy.dialects import postgresql
+
+from collector.configurations import logger
+from collector.exceptions import NoDataError
+from collector.functools import get_path
+from collector.models import (
+    CityModel,
+    ExtraWeatherDataModel,
+    MainWeatherDataMixin,
+    MainWeatherDataModel,
+    MeasurementModel,
+    PromotedFieldsMixin,
+    merge_static,
+)
+from collector.services.base import BaseService, add_chunk_size_argument
+from collector.session import DBSessionMixin
+
+########################################################################################
+# Export Writers
+########################################################################################
+
+
+class ExportWriter(abc.ABC):
+    """
+    Write chunks of rows to output. Writer reports its state after every chunk when
+    written data is complete at disk (so export is checkpointed and could be resumed
+    from that state after failure).
+    """
+
+    extension: str
+
+    def __init__(self, path: str, fields: dict[str, type], state: dict | None) -> None:
+        self.path = path
+        self.fields = fields
+
+    @abc.abstractmethod
+    def write(self, rows: list[tuple]) -> dict | None:
+        """
+        Write chunk of rows. Returns writer state if chunk is complete at disk.
+        """
+
+    def close(self) -> dict | None:
+        return None
+
+
+class GzipWriter(ExportWriter):
+    """
+    Every chunk is appended as separate gzip member (the same as `cat a.gz b.gz`, it is
+    decompressed as one stream). So file is valid after every chunk, and after failure
+    it is truncated to the last checkpointed size.
+    """
+
+    compresslevel = 6
+
+    def __init__(self, path: str, fields: dict[str, type], state: dict | None) -> None:
+        super().__init__(path, fields, state)
+        self.file = open(path, 'r+b' if state else 'wb')
+        if state:
+            self.file.truncate(state['size'])
+            self.file.seek(state['size'])
+        else:
+            self.file.write(self.compress(self.header()))
+
+    def header(self) -> str:
+        return ''
+
+    @abc.abstractmethod
+    def format(self, rows: list[tuple]) -> str:
+        """
+        Format chunk of rows to text.
+        """
+
+    def compress(self, text: str) -> bytes:
+        if not text:
+            return b''
+        return gzip.compress(text.encode(), compresslevel=self.compresslevel)
+
+    def write(self, rows: list[tuple]) -> dict | None:
+        return self.write_text(self.format(rows))
+
+    def write_text(self, text: str) -> dict | None:
+        """
+        Write chunk of already formatted text (see `ExportWeather.copy_chunk`).
+        """
+        self.file.write(self.compress(text))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'size': self.file.tell()}
+
+    def close(self) -> dict | None:
+        self.file.close()
+        return None
+
+
+class CSVWriter(GzipWriter):
+    extension = 'csv.gz'
+
+    def header(self) -> str:
+        return self.format([tuple(self.fields)], header=True)
+
+    def format(self, rows: list[tuple], header: bool = False) -> str:
+        # only extra fields could be objects, they are stored as JSON text
+        extra = {i for i, name in enumerate(self.fields) if name.startswith('extra.')}
+        if extra and not header:
+            rows = [
+                tuple(
+                    json.dumps(value)
+                    if i in extra and isinstance(value, (dict, list))
+                    else value
+                    for i, value in enumerate(row)
+                )
+                for row in rows
+            ]
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue()
+
+
+class JSONLinesWriter(GzipWriter):
+    extension = 'jsonl.gz'
+
+    def format(self, rows: list[tuple]) -> str:
+        return ''.join(
+            json.dumps(dict(zip(self.fields, row)), default=str) + '\n' for row in rows
+        )
+
+
+class ParquetWriter(ExportWriter):
+    """
+    Parquet dataset: directory of part files. Every chunk is a row group at current
+    part, which is closed (and checkpointed) after `part_rows`. After failure not
+    closed part is written again.
+
+    Requires `pyarrow` package.
+    """
+
+    extension = 'parquet'
+    part_rows = 1_000_000
+
+    def __init__(self, path: str, fields: dict[str, type], state: dict | None) -> None:
+        import pyarrow
+        import pyarrow.parquet
+
+        super().__init__(path, fields, state)
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        types = {
+            int: pyarrow.int64(),
+            float: pyarrow.float64(),
+            str: pyarrow.string(),
+            datetime: pyarrow.timestamp('us'),
+        }
+        self.schema = pyarrow.schema(
+            [(name, types[type_]) for name, type_ in fields.items()]
+        )
+        self.part = state['parts'] if state else 0
+        self.writer: pyarrow.parquet.ParquetWriter | None = None
+        self.rows = 0
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, rows: list[tuple]) -> dict | None:
+        columns = dict(zip(self.fields, zip(*rows)))
+        for name, type_ in self.fields.items():
+            # extra fields have no certain type, not strings are stored as JSON text
+            if type_ is str:
+                columns[name] = [
+                    value
+                    if value is None or isinstance(value, str)
+                    else json.dumps(value)
+                    for value in columns[name]
+                ]
+        table = self.pyarrow.table(columns, schema=self.schema)
+
+        if self.writer is None:
+            path = os.path.join(self.path, f'part-{self.part:05}.parquet')
+            self.writer = self.parquet.ParquetWriter(path, self.schema)
+        self.writer.write_table(table)
+        self.rows += len(rows)
+
+        if self.rows >= self.part_rows:
+            return self.close()
+        return None
+
+    def close(self) -> dict | None:
+        if self.writer is None:
+            return None
+        self.writer.close()
+        self.writer = None
+        self.rows = 0
+        self.part += 1
+        return {'parts': self.part}
+
+
+########################################################################################
+# Export Weather Service
+########################################################################################
+
+
+class ExportWeather(BaseService, DBSessionMixin):
+    """
+    Export measurements joined with main data (and selected extra data fields) to gzip
+    CSV, JSON Lines or Parquet.
+
+    Measurements are read by chunks ordered by id (keyset pagination: next chunk is
+    `id > last exported id`, so every chunk is read by index no matter how far it is)
+    and every chunk is written at once, so memory does not depend on export size.
+    Export state is saved at `<output>.checkpoint` file, use --resume to continue
+    failed export, or --after-id to export only new measurements.
+    """
+
+    command = 'export'
+    read_only = True
+    writers: dict[str, type[ExportWriter]] = {
+        'csv': CSVWriter,
+        'jsonl': JSONLinesWriter,
+        'parquet': ParquetWriter,
+    }
+    main_columns = [
+        name
+        for name, value in vars(MainWeatherDataMixin).items()
+        if isinstance(value, db.Column)
+    ]
+    promoted_columns = [
+        name
+        for name, value in vars(PromotedFieldsMixin).items()
+        if isinstance(value, db.Column)
+    ]
+    columns = main_columns + promoted_columns
+
+    def __init__(
+        self,
+        *,
+        format: str = 'csv',
+        output: str | None = None,
+        extra_fields: list[str] | None = None,
+        after_id: int = 0,
+        resume: bool = False,
+        chunk_size: int = 10_000,
+        **kwargs,
+    ) -> None:
+        self.writer_class = self.writers[format]
+        self.output = output or f'weather.{self.writer_class.extension}'
+        self.extra_fields = extra_fields or []
+        self.after_id = after_id
+        self.resume = resume
+        self.chunk_size = chunk_size
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--format',
+            choices=cls.writers,
+            default='csv',
+            help='export format. Default: csv',
+        )
+        parser.add_argument(
+            '--output',
+            metavar='<path>',
+            help='export file (directory for parquet). Default: weather.<format>',
+        )
+        parser.add_argument(
+            '--extra-fields',
+            metavar='<path>',
+            nargs='+',
+            help='extra data fields to export (dotted paths, e.g. wind.deg)',
+        )
+        parser.add_argument(
+            '--after-id',
+            metavar='<id>',
+            type=int,
+            default=0,
+            help='export measurements after that id',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='continue export from the last checkpoint',
+        )
+        add_chunk_size_argument(parser, 'exported')
+
+    @property
+    def checkpoint_path(self):
+        return f'{self.output}.checkpoint'
+
+    def load_checkpoint(self) -> dict | None:
+        if not self.resume:
+            return None
+        if not os.path.exists(self.checkpoint_path):
+            raise NoDataError(f'No checkpoint to resume: {self.checkpoint_path}. ')
+        with open(self.checkpoint_path) as file:
+            return json.load(file)
+
+    def save_checkpoint(self, state: dict):
+        # replaced at once, so checkpoint is never half written
+        with open(f'{self.checkpoint_path}.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(f'{self.checkpoint_path}.tmp', self.checkpoint_path)
+
+    def execute(self):
+        super().execute()
+        state = self.load_checkpoint()
+        last_id = state['last_id'] if state else self.after_id
+        writer = self.writer_class(self.output, self.get_fields(), state)
+        # CSV is formatted by PostgreSQL server, rows are not read by Python at all
+        text_writer = None
+        if isinstance(writer, CSVWriter) and self.copy_supported():
+            text_writer = writer
+
+        exported = 0
+        try:
+            while (end := self.get_chunk_end(last_id)) is not None:
+                if text_writer is not None:
+                    text, amount = self.copy_chunk(last_id, end)
+                    written = text_writer.write_text(text)
+                else:
+                    rows = self.session.execute(self.get_query(last_id, end))
+                    chunk = [self.format(row) for row in rows]
+                    amount = len(chunk)
+                    written = writer.write(chunk)
+                last_id = end
+                if written is not None:
+                    state = (state or {}) | written | {'last_id': last_id}
+                    self.save_checkpoint(state)
+
+                # read transaction is not kept open for the whole export
+                self.session.commit()
+                exported += amount
+                logger.info(f'{exported} measurements exported (ids up to {last_id}). ')
+        finally:
+            written = writer.close()
+
+        if written is not None:
+            self.save_checkpoint((state or {}) | written | {'last_id': last_id})
+        logger.info(f'Export is finished: {self.output}. ')
+
+    def get_fields(self) -> dict[str, type]:
+        """
+        Exported fields and their types.
+        """
+        columns = MeasurementModel.__table__.c
+        return (
+            {'id': int, 'city_id': int, 'city': str, 'measure_at': datetime}
+            | {name: columns[name].type.python_type for name in self.columns}
+            | {f'extra.{path}': str for path in self.extra_fields}
+        )
+
+    def get_chunk_end(self, last_id: int) -> int | None:
+        """
+        Last id of next chunk after `last_id` (`None` if there are no more
+        measurements). Only ids index is read.
+        """
+        ids = (
+            db.select(MeasurementModel.id)
+            .where(MeasurementModel.id > last_id)
+            .order_by(MeasurementModel.id)
+            .limit(self.chunk_size)
+            .subquery()
+        )
+        return self.session.scalar(db.select(db.func.max(ids.c.id)))
+
+    def get_query(self, last_id: int, end: int, copy: bool = False) -> db.sql.Select:
+        """
+        Measurements of chunk `(last_id, end]`, columns are at exported fields order.
+        Extra fields are taken by `format`, or by database for `copy_chunk`.
+        """
+        # main data stored inline or at `MainWeatherDataModel` table
+        main = [
+            db.func.coalesce(
+                getattr(MeasurementModel, column), getattr(MainWeatherDataModel, column)
+            ).label(column)
+            for column in self.main_columns
+        ]
+        promoted = [
+            getattr(MeasurementModel, column) for column in self.promoted_columns
+        ]
+        query = (
+            db.select(
+                MeasurementModel.id,
+                MeasurementModel.city_id,
+                CityModel.name,
+                MeasurementModel.measure_at,
+                *main,
+                *promoted,
+            )
+            .join_from(MeasurementModel, CityModel)
+            .outerjoin(MainWeatherDataModel)
+            .where(MeasurementModel.id > last_id, MeasurementModel.id <= end)
+            .order_by(MeasurementModel.id)
+        )
+        if not self.extra_fields:
+            return query
+
+        query = query.outerjoin(ExtraWeatherDataModel)
+        if not copy:
+            return query.add_columns(
+                ExtraWeatherDataModel.data,
+                ExtraWeatherDataModel.packed,
+                CityModel.weather_static,
+            )
+
+        # plain data, or packed data merged with static city fields (the same rule as
+        # `format` has: static fields are taken for packed data only). Empty path is
+        # the whole value, it is NULL for both SQL and JSON null.
+        def get_text(source: db.sql.ColumnElement, path: list[str]):
+            return source.op('#>>', return_type=db.Text)(
+                db.literal(path, postgresql.ARRAY(db.Text))
+            )
+
+        extra = ExtraWeatherDataModel.__table__.c
+        static = db.case(
+            (
+                db.and_(
+                    get_text(extra.data, []).is_(None),
+                    get_text(extra.packed, []).is_not(None),
+                ),
+                CityModel.__table__.c.weather_static,
+            )
+        )
+        return query.add_columns(
+            *[
+                db.func.coalesce(
+                    *[
+                        get_text(source, path.split('.'))
+                        for source in [extra.data, extra.packed, static]
+                    ]
+                )
+                for path in self.extra_fields
+            ]
+        )
+
+    def copy_chunk(self, last_id: int, end: int) -> tuple[str, int]:
+        """
+        Chunk as CSV text made by `COPY (query) TO STDOUT`, and amount of rows.
+        """
+        query = self.get_query(last_id, end, copy=True).compile(
+            dialect=self.session.bind.dialect
+        )
+        buffer = io.StringIO()
+        # raw DBAPI cursor at the same connection (and transaction) as session has
+        cursor = self.session.connection().connection.cursor()
+        sql = cursor.mogrify(f'COPY ({query}) TO STDOUT WITH CSV', query.params)
+        cursor.copy_expert(sql.decode(), buffer)
+        return buffer.getvalue(), cursor.rowcount
+
+    def format(self, row: db.engine.Row) -> tuple:
+        """
+        Values of exported fields (row columns are selected at the same order).
+        """
+        if not self.extra_fields:
+            return tuple(row)
+
+        *values, data, packed, static = row
+        if data is None and packed is not None:
+            data = merge_static(static or {}, packed)
+        return (*values, *[get_path(data or {}, path) for path in self.extra_fields])
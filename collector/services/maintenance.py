@@ -0,0 +1,460 @@
+from __future__ import annotations
+
+import argparse
+from datetime import datetime
+
+import sqlalchemy as db
+
+from collector.configurations import CONFIG, logger
+from collector.functools import get_path
+from collector.models import (
+    CityModel,
+    ExtraWeatherDataModel,
+    MainWeatherDataMixin,
+    MainWeatherDataModel,
+    MeasurementModel,
+    merge_static,
+    pack_static,
+)
+from collector.partitioning import (
+    add_months,
+    drop_partitions,
+    get_partitions,
+    is_partitioned,
+    month_start,
+)
+from collector.services.base import BaseService, add_chunk_size_argument
+from collector.session import DBSessionMixin
+from collector.stats import group_stats, rebuild_stats, subtract_stats
+
+########################################################################################
+# Migrate Main Data Service
+########################################################################################
+
+
+class MigrateMainData(BaseService, DBSessionMixin):
+    """
+    Move `main` weather data of collected measurements inline to measurement rows
+    (wide-row schema, see `wide_measurements` configuration) or back to separate table
+    with --reverse flag.
+
+    Rows are moved by chunks of measurements ids and every chunk is committed, so
+    migration does not hold long locks and could be stopped and continued later.
+    """
+
+    command = 'migrate_main'
+    columns = [
+        name
+        for name, value in vars(MainWeatherDataMixin).items()
+        if isinstance(value, db.Column)
+    ]
+
+    def __init__(
+        self, *, reverse: bool = False, chunk_size: int = 10_000, **kwargs
+    ) -> None:
+        self.reverse = reverse
+        self.chunk_size = chunk_size
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--reverse',
+            action='store_true',
+            help='move main weather data from measurement rows back to separate table',
+        )
+        add_chunk_size_argument(parser, 'migrated (and committed)')
+
+    def execute(self):
+        super().execute()
+        main = MainWeatherDataModel.__table__
+        measurement = MeasurementModel.__table__
+
+        if self.reverse:
+            ids = measurement.c.id
+            pending = measurement.c.temp.is_not(None)
+            move = self.move_to_table
+        else:
+            ids = main.c.measurement_id
+            pending = ids.is_not(None)
+            move = self.move_inline
+
+        first, last = self.session.execute(
+            db.select(db.func.min(ids), db.func.max(ids)).where(pending)
+        ).one()
+        if first is None:
+            logger.info('No measurements to migrate. ')
+            return
+
+        moved = 0
+        for start in range(first, last + 1, self.chunk_size):
+            moved += move(start, start + self.chunk_size)
+            self.session.commit()
+            logger.info(f'{moved} measurements migrated (ids up to {start}). ')
+
+    def move_inline(self, start: int, stop: int) -> int:
+        main = MainWeatherDataModel.__table__
+        measurement = MeasurementModel.__table__
+        in_chunk = main.c.measurement_id.between(start, stop - 1)
+
+        if self.session.bind.dialect.name == 'postgresql':
+            update = (
+                db.update(measurement)
+                .where(measurement.c.id == main.c.measurement_id, in_chunk)
+                .values({name: main.c[name] for name in self.columns})
+            )
+        else:
+            # SQLite dialect does not support UPDATE ... FROM, correlated subqueries
+            # are taken by `measurement_id` index
+            row = db.select(main).where(main.c.measurement_id == measurement.c.id)
+            update = (
+                db.update(measurement)
+                .where(row.exists(), measurement.c.id.between(start, stop - 1))
+                .values(
+                    {
+                        name: row.with_only_columns(main.c[name]).scalar_subquery()
+                        for name in self.columns
+                    }
+                )
+            )
+
+        result = self.session.execute(update)
+        self.session.execute(db.delete(main).where(in_chunk))
+        return result.rowcount
+
+    def move_to_table(self, start: int, stop: int) -> int:
+        main = MainWeatherDataModel.__table__
+        measurement = MeasurementModel.__table__
+        in_chunk = db.and_(
+            measurement.c.id.between(start, stop - 1),
+            measurement.c.temp.is_not(None),
+        )
+
+        result = self.session.execute(
+            db.insert(main).from_select(
+                ['measurement_id', 'measure_at', *self.columns],
+                db.select(
+                    measurement.c.id,
+                    measurement.c.measure_at,
+                    *[measurement.c[name] for name in self.columns],
+                ).where(in_chunk),
+            )
+        )
+        self.session.execute(
+            db.update(measurement)
+            .where(in_chunk)
+            .values(dict.fromkeys(self.columns, None))
+        )
+        return result.rowcount
+
+
+########################################################################################
+# Migrate Extra Data Service
+########################################################################################
+
+
+class MigrateExtraData(BaseService, DBSessionMixin):
+    """
+    Convert extra weather data of collected measurements to compact storage (see
+    `compact_extra` configuration): static fields are moved to city and the rest is
+    packed. Or back to plain JSON with --reverse flag.
+
+    Rows are converted by chunks of ids and every chunk is committed, the same way as
+    `migrate_main` does.
+    """
+
+    command = 'migrate_extra'
+
+    def __init__(
+        self, *, reverse: bool = False, chunk_size: int = 10_000, **kwargs
+    ) -> None:
+        self.reverse = reverse
+        self.chunk_size = chunk_size
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--reverse',
+            action='store_true',
+            help='unpack compact extra data back to plain JSON',
+        )
+        add_chunk_size_argument(parser, 'converted (and committed)')
+
+    def execute(self):
+        super().execute()
+        extra = ExtraWeatherDataModel.__table__
+        pending = extra.c.packed if self.reverse else extra.c.data
+
+        first, last = self.session.execute(
+            db.select(db.func.min(extra.c.id), db.func.max(extra.c.id)).where(
+                pending.is_not(None)
+            )
+        ).one()
+        if first is None:
+            logger.info('No extra data to migrate. ')
+            return
+
+        migrate = self.unpack if self.reverse else self.pack
+        migrated = 0
+        for start in range(first, last + 1, self.chunk_size):
+            migrated += migrate(start, start + self.chunk_size)
+            self.session.commit()
+            logger.info(f'{migrated} extra data rows migrated (ids up to {start}). ')
+
+    def pack(self, start: int, stop: int) -> int:
+        extra = ExtraWeatherDataModel.__table__
+        city = CityModel.__table__
+        rows = self.session.execute(
+            db.select(extra.c.id, extra.c.data, MeasurementModel.city_id)
+            .join_from(extra, MeasurementModel.__table__)
+            .where(extra.c.id.between(start, stop - 1), extra.c.data.is_not(None))
+        ).all()
+        if not rows:
+            return 0
+
+        # rows are packed against static already stored for city (the same way as
+        # collecting run does), it is never changed
+        statics: dict[int, dict | None] = dict(
+            self.session.execute(
+                db.select(city.c.id, city.c.weather_static).where(
+                    city.c.id.in_({city_id for *_, city_id in rows})
+                )
+            ).all()
+        )
+        packed, new_statics = [], {}
+        for id, data, city_id in rows:
+            static, volatile = pack_static(data, statics[city_id])
+            if statics[city_id] is None:
+                statics[city_id] = new_statics[city_id] = static
+            packed.append({'_id': id, '_packed': volatile})
+
+        # static fields of cities which are not collected at compact mode yet
+        if new_statics:
+            self.session.execute(
+                db.update(city)
+                .where(city.c.id == db.bindparam('_id'))
+                .values(
+                    weather_static=db.bindparam(
+                        '_static', type_=city.c.weather_static.type
+                    )
+                ),
+                [{'_id': id, '_static': static} for id, static in new_statics.items()],
+            )
+        self.session.execute(
+            db.update(extra)
+            .where(extra.c.id == db.bindparam('_id'))
+            .values(
+                packed=db.bindparam('_packed', type_=extra.c.packed.type), data=None
+            ),
+            packed,
+        )
+        return len(rows)
+
+    def unpack(self, start: int, stop: int) -> int:
+        extra = ExtraWeatherDataModel.__table__
+        rows = self.session.execute(
+            db.select(extra.c.id, extra.c.packed, CityModel.weather_static)
+            .join_from(extra, MeasurementModel.__table__)
+            .join(CityModel.__table__)
+            .where(extra.c.id.between(start, stop - 1), extra.c.packed.is_not(None))
+        ).all()
+        if not rows:
+            return 0
+
+        self.session.execute(
+            db.update(extra)
+            .where(extra.c.id == db.bindparam('_id'))
+            .values(data=db.bindparam('_data', type_=extra.c.data.type), packed=None),
+            [
+                {'_id': id, '_data': merge_static(static or {}, packed)}
+                for id, packed, static in rows
+            ],
+        )
+        return len(rows)
+
+
+########################################################################################
+# Backfill Promoted Fields Service
+########################################################################################
+
+
+class BackfillPromotedFields(BaseService, DBSessionMixin):
+    """
+    Fill promoted measurement columns (see `promoted_fields` configuration) from extra
+    weather data of already collected measurements.
+
+    Rows are updated by chunks of measurements ids and every chunk is committed, the
+    same way as `migrate_main` does.
+    """
+
+    command = 'backfill_promoted'
+
+    def __init__(self, *, chunk_size: int = 10_000, **kwargs) -> None:
+        self.chunk_size = chunk_size
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        add_chunk_size_argument(parser, 'updated (and committed)')
+
+    def execute(self):
+        super().execute()
+        if not CONFIG.promoted_fields:
+            logger.info('No promoted fields configured. ')
+            return
+
+        measurement = MeasurementModel.__table__
+        first, last = self.session.execute(
+            db.select(db.func.min(measurement.c.id), db.func.max(measurement.c.id))
+        ).one()
+        if first is None:
+            logger.info('No measurements to backfill. ')
+            return
+
+        backfilled = 0
+        for start in range(first, last + 1, self.chunk_size):
+            backfilled += self.backfill(start, start + self.chunk_size)
+            self.session.commit()
+            logger.info(f'{backfilled} measurements backfilled (ids up to {start}). ')
+
+    def backfill(self, start: int, stop: int) -> int:
+        measurement = MeasurementModel.__table__
+        extra = ExtraWeatherDataModel.__table__
+        rows = self.session.execute(
+            db.select(
+                measurement.c.id, measurement.c.measure_at, extra.c.data, extra.c.packed
+            )
+            .join_from(measurement, extra)
+            .where(measurement.c.id.between(start, stop - 1))
+        ).all()
+        if not rows:
+            return 0
+
+        # promoted fields are volatile, so they are at packed data too (compact mode).
+        # Partitioning key is provided, so every update is pruned to one partition
+        self.session.execute(
+            db.update(measurement)
+            .where(
+                measurement.c.id == db.bindparam('_id'),
+                measurement.c.measure_at == db.bindparam('_measure_at'),
+            )
+            .values(
+                {
+                    column: db.bindparam(f'_{column}')
+                    for column in CONFIG.promoted_fields
+                }
+            ),
+            [
+                {'_id': id, '_measure_at': measure_at}
+                | {
+                    f'_{column}': get_path(data if data is not None else packed, path)
+                    for column, path in CONFIG.promoted_fields.items()
+                }
+                for id, measure_at, data, packed in rows
+            ],
+        )
+        return len(rows)
+
+
+########################################################################################
+# Retention Service
+########################################################################################
+
+
+class Retention(BaseService, DBSessionMixin):
+    """
+    Drop measurements older than `keep_months` (current month included).
+
+    PostgreSQL tables are partitioned by month (see `collector.partitioning`), so whole
+    partitions are detached and dropped without scanning rows. Otherwise old rows are
+    deleted.
+
+    Dropped measurements are subtracted from cities rollup. Month by month, their
+    aggregates are taken by one sequential read of that month partitions (the same
+    rows which are dropped, not the whole tables), then partitions are dropped. So the
+    cost is one read of dropped months plus re-aggregation of cities which extreme
+    temperature is dropped (see `subtract_stats`).
+    """
+
+    command = 'retention'
+
+    def __init__(self, *, keep_months: int | None = None, **kwargs) -> None:
+        self.keep_months = keep_months or CONFIG.retention_months
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--keep-months',
+            metavar='<amount>',
+            type=int,
+            help='months of measurements to keep. Default: retention_months config',
+        )
+
+    def execute(self):
+        super().execute()
+        before = add_months(month_start(datetime.utcnow()), 1 - self.keep_months)
+        connection = self.session.connection()
+
+        if is_partitioned(connection):
+            months = sorted(
+                month
+                for month in get_partitions(connection, MeasurementModel.__tablename__)
+                if month < before
+            )
+            cities = aggregated = 0
+            for month in months:
+                # one aggregate over the month partitions just before they are dropped
+                deltas = self.get_deltas(window=(month, add_months(month, 1)))
+                drop_partitions(connection, add_months(month, 1))
+                cities += len(deltas)
+                aggregated += subtract_stats(connection, deltas)
+            logger.info(f'{len(months)} months before {before} are dropped. ')
+        else:
+            deltas = self.get_deltas(MeasurementModel.measure_at < before)
+            deleted = 0
+            for model in [
+                ExtraWeatherDataModel,
+                MainWeatherDataModel,
+                MeasurementModel,
+            ]:
+                result = self.session.execute(
+                    db.delete(model).where(model.measure_at < before)
+                )
+                deleted = result.rowcount
+            logger.info(f'{deleted} measurements before {before} are deleted. ')
+            cities = len(deltas)
+            aggregated = subtract_stats(connection, deltas)
+
+        logger.info(
+            f'Dropped measurements of {cities} cities are subtracted from stats '
+            f'({aggregated} cities are aggregated again). '
+        )
+
+    def get_deltas(self, *where: db.sql.ColumnElement, **kwargs) -> list[dict]:
+        """
+        Aggregates of measurements to drop, they are subtracted from cities rollup.
+        """
+        rows = self.session.connection().execute(group_stats(*where, **kwargs))
+        return [dict(row._mapping) for row in rows]
+
+
+########################################################################################
+# Rebuild Stats Service
+########################################################################################
+
+
+class RebuildStats(BaseService, DBSessionMixin):
+    """
+    Make cities rollup (see `collector.stats`) from all collected measurements. For
+    measurements changed by hand (rollup of already collected ones is made by
+    migration).
+    """
+
+    command = 'rebuild_stats'
+
+    def execute(self):
+        super().execute()
+        cities = rebuild_stats(self.session.connection())
+        logger.info(f'Weather stats of {cities} cities are rebuilt. ')
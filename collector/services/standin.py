@@ -0,0 +1,466 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from http import HTTPStatus
+from urllib.parse import urlencode
+
+import aiohttp
+from aiohttp import web
+
+from collector.configurations import CONFIG, CollectorConfig, logger
+from collector.services.base import BaseService
+
+########################################################################################
+# Stand-in Data
+########################################################################################
+
+
+CITIES: list[tuple[str, str, str, float, float, int]] = [
+    # name, country, countryCode, latitude, longitude, population
+    ('Shanghai', 'China', 'CN', 31.23, 121.47, 24870895),
+    ('Beijing', 'China', 'CN', 39.9, 116.41, 21893095),
+    ('Delhi', 'India', 'IN', 28.65, 77.23, 16787941),
+    ('Chengdu', 'China', 'CN', 30.57, 104.07, 16330000),
+    ('Chongqing', 'China', 'CN', 29.56, 106.55, 15872179),
+    ('Istanbul', 'Turkey', 'TR', 41.01, 28.98, 15462452),
+    ('Lagos', 'Nigeria', 'NG', 6.52, 3.38, 15388000),
+    ('Karachi', 'Pakistan', 'PK', 24.86, 67.01, 14910352),
+    ('Tokyo', 'Japan', 'JP', 35.69, 139.69, 13960236),
+    ('Tianjin', 'China', 'CN', 39.13, 117.2, 13866009),
+    ('Guangzhou', 'China', 'CN', 23.13, 113.26, 13858700),
+    ('Shenzhen', 'China', 'CN', 22.54, 114.06, 12528300),
+    ('Moscow', 'Russia', 'RU', 55.75, 37.62, 12506468),
+    ('Mumbai', 'India', 'IN', 19.08, 72.88, 12442373),
+    ('Sao Paulo', 'Brazil', 'BR', -23.55, -46.63, 12325232),
+    ('Kinshasa', 'DR Congo', 'CD', -4.32, 15.31, 11855000),
+    ('Lahore', 'Pakistan', 'PK', 31.55, 74.34, 11126285),
+    ('Wuhan', 'China', 'CN', 30.59, 114.31, 11081000),
+    ('Jakarta', 'Indonesia', 'ID', -6.21, 106.85, 10562088),
+    ('Dhaka', 'Bangladesh', 'BD', 23.81, 90.41, 10278882),
+    ('Lima', 'Peru', 'PE', -12.05, -77.04, 9751717),
+    ('Seoul', 'South Korea', 'KR', 37.57, 126.98, 9668465),
+    ('Cairo', 'Egypt', 'EG', 30.04, 31.24, 9539673),
+    ('Mexico City', 'Mexico', 'MX', 19.43, -99.13, 9209944),
+    ('Ho Chi Minh City', 'Vietnam', 'VN', 10.82, 106.63, 8993082),
+    ('London', 'United Kingdom', 'GB', 51.51, -0.13, 8982000),
+    ('New York City', 'United States', 'US', 40.71, -74.01, 8804190),
+    ('Tehran', 'Iran', 'IR', 35.69, 51.39, 8693706),
+    ('Bangalore', 'India', 'IN', 12.97, 77.59, 8443675),
+    ('Luanda', 'Angola', 'AO', -8.84, 13.23, 8330000),
+    ('Bangkok', 'Thailand', 'TH', 13.76, 100.5, 8305218),
+    ('Hanoi', 'Vietnam', 'VN', 21.03, 105.85, 8053663),
+    ('Bogota', 'Colombia', 'CO', 4.71, -74.07, 7743955),
+    ('Riyadh', 'Saudi Arabia', 'SA', 24.71, 46.68, 7676654),
+    ('Hong Kong', 'Hong Kong', 'HK', 22.32, 114.17, 7413070),
+    ('Baghdad', 'Iraq', 'IQ', 33.31, 44.36, 7216000),
+    ('Chennai', 'India', 'IN', 13.08, 80.27, 7088000),
+    ('Hyderabad', 'India', 'IN', 17.39, 78.49, 6993262),
+    ('Rio de Janeiro', 'Brazil', 'BR', -22.91, -43.17, 6747815),
+    ('Santiago', 'Chile', 'CL', -33.45, -70.67, 6310000),
+    ('Singapore', 'Singapore', 'SG', 1.29, 103.85, 5685807),
+    ('Ankara', 'Turkey', 'TR', 39.93, 32.86, 5663322),
+    ('Johannesburg', 'South Africa', 'ZA', -26.2, 28.05, 5635127),
+    ('Ahmedabad', 'India', 'IN', 23.02, 72.57, 5570585),
+    ('Saint Petersburg', 'Russia', 'RU', 59.94, 30.31, 5384342),
+    ('Sydney', 'Australia', 'AU', -33.87, 151.21, 5312163),
+    ('Alexandria', 'Egypt', 'EG', 31.2, 29.92, 5200000),
+    ('Yangon', 'Myanmar', 'MM', 16.87, 96.2, 5160512),
+    ('Abidjan', 'Ivory Coast', 'CI', 5.36, -4.01, 4707000),
+    ('Kolkata', 'India', 'IN', 22.57, 88.36, 4496694),
+    ('Nairobi', 'Kenya', 'KE', -1.29, 36.82, 4397073),
+    ('Los Angeles', 'United States', 'US', 34.05, -118.24, 3898747),
+    ('Berlin', 'Germany', 'DE', 52.52, 13.4, 3664088),
+    ('Madrid', 'Spain', 'ES', 40.42, -3.7, 3223334),
+    ('Buenos Aires', 'Argentina', 'AR', -34.6, -58.38, 3075646),
+    ('Toronto', 'Canada', 'CA', 43.65, -79.38, 2794356),
+]
+"""
+The biggest world cities ordered by population. Stand-in GeoDB lists them first and
+then generates as many cities as requested.
+"""
+
+ROUTES = {
+    '/data/2.5/weather': 'open_weather',
+    '/data/2.5/group': 'open_weather',
+    '/geo/1.0/direct': 'open_weather',
+    '/v1/geo/cities': 'geodb',
+}
+"Stand-in endpoints and API names they belong to (the same as at `urls` config). "
+
+GEODB_LIMIT = 10
+"The same restriction as GeoDB FREE plan has. "
+
+
+def stable_random(*seed) -> random.Random:
+    """
+    Random generator which returns the same values for the same seed at every run.
+    (builtin `hash` of strings is salted for every process, so it is not used here)
+    """
+    digest = hashlib.md5(repr(seed).encode()).hexdigest()
+    return random.Random(int(digest, 16))
+
+
+########################################################################################
+# Stand-in Server Service
+########################################################################################
+
+
+class StandInServer(BaseService):
+    """
+    Local stand-in for Open Weather and GeoDB APIs. Serves generated (or previously
+    recorded) responses with configurable latency and failures, so collector could be
+    developed, tested and load tested without network access and API quotas.
+
+    Point collector to it by overriding urls: `URLS__OPEN_WEATHER=http://localhost:8080`
+    and `URLS__GEODB=http://localhost:8080`. Run it with `--host 0.0.0.0` to serve
+    collector at other container.
+    """
+
+    command = 'standin'
+
+    def __init__(
+        self,
+        *,
+        host: str = 'localhost',
+        port: int = 8080,
+        latency: float = 0,
+        error_rate: float = 0,
+        throttle_rate: float = 0,
+        rate_limit: int | None = None,
+        record: str | None = None,
+        replay: str | None = None,
+        seed: int | None = None,
+        **kwargs,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.record = record
+        self.replay = replay
+
+        self.random = random.Random(seed)
+        self.calls: dict[str, deque[float]] = {api: deque() for api in CONFIG.urls}
+        self.stats: Counter[str] = Counter()
+        self.connections: set[tuple] = set()
+        "Client addresses, every kept alive connection is counted once. "
+        self.recordings: dict[str, dict] = {}
+        self.cities = {
+            self.city_id(lat, lon): (name, code, lat, lon)
+            for name, _, code, lat, lon, _ in CITIES
+        }
+        super().__init__(**kwargs)
+
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '--host',
+            default='localhost',
+            help='stand-in server host. Use 0.0.0.0 to serve other containers',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8080,
+            help='stand-in server port',
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0,
+            help='stand-in server average response delay (seconds)',
+        )
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0,
+            help='stand-in server ratio of responses failed with 500 status',
+        )
+        parser.add_argument(
+            '--throttle-rate',
+            type=float,
+            default=0,
+            help='stand-in server ratio of responses failed with 429 status',
+        )
+        parser.add_argument(
+            '--rate-limit',
+            type=int,
+            default=None,
+            help='stand-in server calls per minute for every API (429 status above)',
+        )
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(
+            '--record',
+            type=str,
+            default=None,
+            help='stand-in server proxies requests to real APIs and saves responses',
+        )
+        group.add_argument(
+            '--replay',
+            type=str,
+            default=None,
+            help='stand-in server serves responses saved by --record',
+        )
+
+    def execute(self):
+        super().execute()
+        logger.info(
+            f'Stand-in server at http://{self.host}:{self.port}. Run collector with '
+            f'URLS__OPEN_WEATHER=http://{self.host}:{self.port} '
+            f'URLS__GEODB=http://{self.host}:{self.port}'
+        )
+        try:
+            web.run_app(self.make_app(), host=self.host, port=self.port, print=None)
+        except KeyboardInterrupt:
+            logger.info('Stand-in server stopped. ')
+
+    def start(self) -> str:
+        """
+        Run server at background thread and return its base url. Used by tests.
+        """
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(self.make_app())
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        host, port = self.runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/data/2.5/weather', self.weather)
+        app.router.add_get('/data/2.5/group', self.group)
+        app.router.add_get('/geo/1.0/direct', self.geocoding)
+        app.router.add_get('/v1/geo/cities', self.geodb_cities)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_startup(self, app: web.Application):
+        if self.replay:
+            with open(self.replay, encoding='utf-8') as file:
+                self.recordings = json.load(file)
+            logger.info(f'{len(self.recordings)} responses loaded from {self.replay}. ')
+        if self.record:
+            if os.path.isfile(self.record):
+                with open(self.record, encoding='utf-8') as file:
+                    self.recordings = json.load(file)
+            self.upstream = aiohttp.ClientSession()
+
+    async def on_cleanup(self, app: web.Application):
+        if self.record:
+            await self.upstream.close()
+        logger.info(f'Stand-in server responses: {dict(self.stats)}. ')
+
+    ####################################################################################
+    # Faults, Record and Replay
+    ####################################################################################
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler):
+        if request.transport:
+            self.connections.add(request.transport.get_extra_info('peername'))
+        api = ROUTES.get(request.path)
+        if not api:
+            return await handler(request)
+
+        if self.latency:
+            await asyncio.sleep(self.random.uniform(0.5, 1.5) * self.latency)
+
+        retry_after = self.check_rate_limit(api)
+        if retry_after is not None:
+            return self.throttled(retry_after)
+        if self.random.random() < self.throttle_rate:
+            return self.throttled(1)
+        if self.random.random() < self.error_rate:
+            self.stats['500'] += 1
+            return web.json_response(
+                {'cod': 500, 'message': 'Internal error (stand-in). '},
+                status=HTTPStatus.INTERNAL_SERVER_ERROR,
+            )
+
+        key = self.recording_key(request)
+        if self.record:
+            await self.record_upstream(self.record, api, request, key)
+        if key in self.recordings:
+            self.stats['recorded'] += 1
+            recorded = self.recordings[key]
+            return web.json_response(recorded['data'], status=recorded['status'])
+
+        self.stats['generated'] += 1
+        return await handler(request)
+
+    def check_rate_limit(self, api: str) -> int | None:
+        """
+        Sliding window of the last minute calls. Returns seconds to wait if limit is
+        exceeded.
+        """
+        if not self.rate_limit:
+            return None
+
+        now = time.monotonic()
+        calls = self.calls[api]
+        while calls and calls[0] <= now - 60:
+            calls.popleft()
+        if len(calls) >= self.rate_limit:
+            return math.ceil(calls[0] + 60 - now)
+        calls.append(now)
+        return None
+
+    def throttled(self, retry_after: int):
+        self.stats['429'] += 1
+        return web.json_response(
+            {'cod': 429, 'message': 'Requests limitation exceeded (stand-in). '},
+            status=HTTPStatus.TOO_MANY_REQUESTS,
+            headers={'Retry-After': str(retry_after)},
+        )
+
+    @staticmethod
+    def recording_key(request: web.Request):
+        # API key is not a part of recording, so recordings could be shared
+        query = sorted((k, v) for k, v in request.query.items() if k != 'appid')
+        return f'{request.path}?{urlencode(query)}'
+
+    async def record_upstream(
+        self, path: str, api: str, request: web.Request, key: str
+    ):
+        url = CollectorConfig.__fields__['urls'].default[api] + request.path
+        async with self.upstream.get(url, params=request.query) as response:
+            try:
+                data = await response.json(content_type=None)
+            except json.JSONDecodeError:
+                logger.warning(f'Not JSON response is not recorded: {response}. ')
+                return
+
+        self.recordings[key] = {'status': response.status, 'data': data}
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.recordings, file, indent=2)
+
+    ####################################################################################
+    # Generated Responses
+    ####################################################################################
+
+    async def weather(self, request: web.Request):
+        lat, lon = float(request.query['lat']), float(request.query['lon'])
+        return web.json_response(self.make_weather(self.city_id(lat, lon), lat, lon))
+
+    async def group(self, request: web.Request):
+        ids = [int(id) for id in request.query['id'].split(',')]
+        items = [self.make_weather(id, *self.city_coordinates(id)) for id in ids]
+        return web.json_response({'cnt': len(items), 'list': items})
+
+    async def geocoding(self, request: web.Request):
+        name, _, code = request.query['q'].partition(',')
+        if not name:
+            return web.json_response([])
+
+        # country code is not required to match, as real API is not strict about it
+        for city_name, _, city_code, lat, lon, _ in CITIES:
+            if city_name.lower() == name.lower():
+                return web.json_response(
+                    [{'name': city_name, 'lat': lat, 'lon': lon, 'country': city_code}]
+                )
+
+        rnd = stable_random(name, code)
+        lat, lon = round(rnd.uniform(-60, 70), 4), round(rnd.uniform(-180, 180), 4)
+        return web.json_response([{'name': name, 'lat': lat, 'lon': lon}])
+
+    async def geodb_cities(self, request: web.Request):
+        offset = int(request.query.get('offset', 0))
+        limit = min(int(request.query.get('limit', 5)), GEODB_LIMIT)
+        data = [self.make_geodb_city(rank) for rank in range(offset, offset + limit)]
+        return web.json_response(
+            {
+                'data': data,
+                'metadata': {'currentOffset': offset, 'totalCount': 100_000},
+            }
+        )
+
+    @staticmethod
+    def city_id(lat: float, lon: float) -> int:
+        return stable_random(round(lat, 2), round(lon, 2)).randrange(10**5, 10**7)
+
+    def city_coordinates(self, id: int) -> tuple[float, float]:
+        if id in self.cities:
+            return self.cities[id][2:]
+        rnd = stable_random(id)
+        return round(rnd.uniform(-60, 70), 4), round(rnd.uniform(-180, 180), 4)
+
+    def make_geodb_city(self, rank: int):
+        if rank < len(CITIES):
+            name, country, code, lat, lon, population = CITIES[rank]
+        else:
+            rnd = stable_random('geodb', rank)
+            name, country, code = f'Stand-in City {rank + 1}', 'Stand-in', 'XX'
+            lat, lon = round(rnd.uniform(-60, 70), 4), round(rnd.uniform(-180, 180), 4)
+            population = max(CITIES[-1][-1] - (rank - len(CITIES) + 1) * 1000, 1000)
+
+        return {
+            'id': rank + 1,
+            'type': 'CITY',
+            'city': name,
+            'name': name,
+            'country': country,
+            'countryCode': code,
+            'latitude': lat,
+            'longitude': lon,
+            'population': population,
+        }
+
+    def make_weather(self, id: int, lat: float, lon: float):
+        """
+        Open Weather alike response. Values depend on coordinates and change every 10
+        minutes as real measurements do.
+        """
+        now = int(time.time())
+        dt = now - now % 600
+        rnd = stable_random(id, dt)
+        name, code, *_ = self.cities.get(id, ('Stand-in', 'XX'))
+
+        # warmer at equator, never exactly zero (tests ensure temp is provided)
+        temp = round(30 - 0.5 * abs(lat) + rnd.uniform(-5, 5), 2) or 0.01
+        main = rnd.choice(['Clear', 'Clouds', 'Rain', 'Snow' if temp < 0 else 'Mist'])
+        return {
+            'coord': {'lon': lon, 'lat': lat},
+            'weather': [
+                {'id': 800, 'main': main, 'description': main.lower(), 'icon': '01d'}
+            ],
+            'base': 'stations',
+            'main': {
+                'temp': temp,
+                'feels_like': round(temp - rnd.uniform(0, 3), 2),
+                'temp_min': round(temp - rnd.uniform(0, 2), 2),
+                'temp_max': round(temp + rnd.uniform(0, 2), 2),
+                'pressure': rnd.randint(980, 1040),
+                'humidity': rnd.randint(10, 100),
+            },
+            'visibility': rnd.choice([10000, 8000, 5000]),
+            'wind': {'speed': round(rnd.uniform(0, 15), 2), 'deg': rnd.randint(0, 359)},
+            'clouds': {'all': rnd.randint(0, 100)},
+            'dt': dt,
+            'sys': {'country': code, 'sunrise': dt - 6 * 3600, 'sunset': dt + 6 * 3600},
+            'timezone': round(lon / 15) * 3600,
+            'id': id,
+            'name': name,
+            'cod': 200,
+        }
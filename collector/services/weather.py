@@ -1,23 +1,47 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import json
+import math
 import sys
 from datetime import datetime, timedelta
+from typing import Callable, Iterator
 
+import aiohttp
 import pydantic
+import sqlalchemy as db
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+from collector.cache import ReportCache, open_report_cache
 from collector.configurations import CONFIG, logger
-from collector.exceptions import CollectorBaseException, NoDataError
+from collector.exceptions import (
+    CollectorBaseException,
+    NoDataError,
+    QuotaExceededError,
+    ResponseError,
+)
+from collector.functools import get_path
 from collector.models import (
     CityModel,
+    CityWeatherStatsModel,
     ExtraWeatherDataModel,
     MainWeatherDataModel,
     MeasurementModel,
+    pack_static,
+)
+from collector.services.base import (
+    BaseService,
+    FetchServiceMixin,
+    add_chunk_size_argument,
+    add_window_arguments,
+    get_window_filters,
+    init_async_client,
 )
-from collector.services.base import BaseService, FetchServiceMixin
 from collector.services.cities import FetchCities, FetchCoordinates, InitCities
-from collector.session import DBSessionMixin
+from collector.session import BulkInsert, DBSessionMixin, pool_stats
+from collector.stats import aggregate_stats, get_deltas, update_stats
+from collector.throttling import get_limiter
 
 ########################################################################################
 # Weather Schemas
@@ -54,11 +78,50 @@ class WeatherMeasurementSchema(pydantic.BaseModel):
     "Time of data forecasted, Unix, UTC (timestamp). `measure_at` field at model."
 
 
+class WeatherGroupSchema(pydantic.BaseModel):
+    """
+    Schema for parsing Open Weather response for group of cities. Every item is the
+    same as response for one city and parsed by `FetchWeather`.
+    """
+
+    cnt: int
+    items: list[dict] = pydantic.Field(alias='list')
+
+
 ########################################################################################
 # Fetch Weather Service
 ########################################################################################
 
 
+class FetchWeatherGroup(FetchServiceMixin[WeatherGroupSchema]):
+    """
+    Fetch weather for group of cities by one call. Cities are identified by Open
+    Weather ids. Used by `FetchWeather` at batch mode.
+
+    Endpoint detail information: https://openweathermap.org/current#severalid
+    """
+
+    path = '/data/2.5/group'
+    schema = WeatherGroupSchema
+    params = {
+        "appid": CONFIG.open_weather_key,
+        "units": "metric",
+    }
+    max_size = 20
+    "Max amount of cities per one call. "
+
+    def fetch(self, cities: list[CityModel]):  # type: ignore
+        return super().fetch(self.params | {'id': self.get_ids(cities)})
+
+    async def fetch_async(self, session: aiohttp.ClientSession, cities: list[CityModel]):  # type: ignore
+        params = self.params | {'id': self.get_ids(cities)}
+        return self.parse(await super().fetch_async(session, params))
+
+    @staticmethod
+    def get_ids(cities: list[CityModel]):
+        return ','.join(str(city.open_weather_id) for city in cities)
+
+
 class FetchWeather(
     BaseService, DBSessionMixin, FetchServiceMixin[WeatherMeasurementSchema]
 ):
@@ -70,10 +133,15 @@ class FetchWeather(
     """
 
     command = 'fetch_weather'
-    url = 'https://api.openweathermap.org/data/2.5/weather'
+    path = '/data/2.5/weather'
     schema = WeatherMeasurementSchema
 
-    def __init__(self, **kwargs) -> None:
+    def __init__(
+        self, *, concurrent: bool = False, batch: bool = False, **kwargs
+    ) -> None:
+        self.concurrent = concurrent
+        self.batch = batch
+        self.group = FetchWeatherGroup()
         self.cities: list[CityModel] = (
             self.query(CityModel).filter(CityModel.is_tracked).all()
         )
@@ -85,37 +153,223 @@ class FetchWeather(
 
         super().__init__(**kwargs)
 
+    @classmethod
+    def add_argument(cls, parser: argparse.ArgumentParser):
+        parser.add_argument(
+            '-c',
+            '--concurrent',
+            action='store_true',
+            help='fetch weather for all cities concurrently (asyncio)',
+        )
+        parser.add_argument(
+            '-b',
+            '--batch',
+            action='store_true',
+            help=(
+                'fetch weather by groups of '
+                f'{FetchWeatherGroup.max_size} cities per call'
+            ),
+        )
+
     def execute(self):
         super().execute()
-        for city in self.cities:
-            if not all([city.longitude, city.latitude]):
-                try:
-                    FetchCoordinates(city, **self.init_kwargs).execute()
-                except NoDataError as e:
-                    logger.warning(f'Can not get weather for {city}: {e}. Continue. ')
-                    continue
-
-            measure, extra = self.fetch(city)
-            model = MeasurementModel(
-                city=city,
-                measure_at=datetime.utcfromtimestamp(measure.dt),
-                main=MainWeatherDataModel(**measure.main.dict()),
-                extra=ExtraWeatherDataModel(data=extra),
+        requests = self.get_requests()
+
+        if self.concurrent:
+            responses = asyncio.run(self.fetch_concurrently(requests))
+        else:
+            responses = [self.fetch_request(cities) for cities in requests]
+
+        cities = [city for request in requests for city in request]
+        results = [result for response in responses for result in response]
+
+        # [NOTE]
+        # Failed request is already retried at fetch layer. Do not fail the whole run
+        # for one city (otherwise all cities will be fetched again by scheduler), only
+        # when all of them are failed (API is down, or key is invalid).
+        errors = [result for result in results if isinstance(result, ResponseError)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+
+        # measurements are inserted by a few multi-row statements (see `BulkInsert`)
+        if CONFIG.wide_measurements:
+            bulk = BulkInsert(MeasurementModel, extra=ExtraWeatherDataModel)
+        else:
+            bulk = BulkInsert(
+                MeasurementModel, main=MainWeatherDataModel, extra=ExtraWeatherDataModel
             )
-            self.create(model)
+
+        temps: dict[tuple[int, datetime], float | None] = {}
+        for city, result in zip(cities, results):
+            if isinstance(result, ResponseError):
+                logger.warning(f'Can not get weather for {city}: {result}. Continue. ')
+                continue
+
+            measure, extra = result
+            city.open_weather_id = extra.get('id', city.open_weather_id)
+            row = {
+                'city_id': city.id,
+                'measure_at': datetime.utcfromtimestamp(measure.dt),
+            }
+            temps[city.id, row['measure_at']] = measure.main.temp
+            for column, path in CONFIG.promoted_fields.items():
+                row[column] = get_path(extra, path)
+            extra_row = {'data': extra}
+            if CONFIG.compact_extra:
+                # city static is stored once, changed fields are packed with the row
+                static, packed = pack_static(extra, city.weather_static)
+                if city.weather_static is None:
+                    city.weather_static = static
+                extra_row = {'packed': packed}
+
+            if CONFIG.wide_measurements:
+                bulk.add(row | measure.main.dict(), extra=extra_row)
+            else:
+                bulk.add(row, main=measure.main.dict(), extra=extra_row)
+
+        stored = self.bulk_create(bulk)
+
+        # the same transaction, so rollup counts exactly committed measurements
+        update_stats(
+            self.session.connection(),
+            get_deltas(
+                (
+                    row['city_id'],
+                    row['measure_at'],
+                    temps[row['city_id'], row['measure_at']],
+                )
+                for row in stored
+            ),
+        )
+
+        logger.info(f'Open Weather calls: {get_limiter(self.api).stats}. ')
+        logger.info(f'Database pool: {pool_stats}. ')
+
+    def get_requests(self) -> list[list[CityModel]]:
+        """
+        Split cities by requests. At batch mode cities with known Open Weather id are
+        fetched by groups. Others are fetched one by one by their coordinates (Open
+        Weather id is received from response, so they will be batched next time).
+        """
+        batched: list[CityModel] = []
+        if self.batch:
+            batched = [city for city in self.cities if city.open_weather_id]
+
+        single = self.resolve_coordinates(
+            [city for city in self.cities if city not in batched]
+        )
+        size = self.group.max_size
+        groups = [batched[i : i + size] for i in range(0, len(batched), size)]
+
+        requests = [[city] for city in single] + groups
+        if not requests:
+            raise NoDataError('No cities with known coordinates to fetch weather. ')
+        return requests
+
+    def resolve_coordinates(self, cities: list[CityModel]) -> list[CityModel]:
+        """
+        Get coordinates for all cities at once before fetching weather. Returns cities
+        with known coordinates.
+        """
+        unknown = [city for city in cities if not city.has_coordinates]
+        if unknown:
+            try:
+                FetchCoordinates(
+                    *unknown, session=self.session, **self.init_kwargs
+                ).execute()
+            except (NoDataError, ResponseError) as e:
+                logger.warning(f'Can not get coordinates for any city: {e}. ')
+
+        for city in cities:
+            if not city.has_coordinates:
+                logger.warning(f'Can not get weather for {city}: no coordinates. ')
+        return [city for city in cities if city.has_coordinates]
+
+    def is_group(self, cities: list[CityModel]):
+        return self.batch and bool(cities[0].open_weather_id)
+
+    def fetch_request(self, cities: list[CityModel]) -> list:
+        """
+        Fetch weather for one city or for group of cities. Returns result for every
+        city: measurement data or error.
+        """
+        try:
+            if self.is_group(cities):
+                return self.split_group(cities, self.group.fetch(cities))
+            return [self.fetch(cities[0])]
+        except ResponseError as e:
+            return [e] * len(cities)
+
+    async def fetch_request_async(
+        self, session: aiohttp.ClientSession, cities: list[CityModel]
+    ) -> list:
+        try:
+            if self.is_group(cities):
+                group = await self.group.fetch_async(session, cities)
+                return self.split_group(cities, group)
+            return [await self.fetch_async(session, cities[0])]
+        except ResponseError as e:
+            return [e] * len(cities)
+
+    def split_group(self, cities: list[CityModel], group: WeatherGroupSchema) -> list:
+        """
+        Split response for group of cities into results for every city.
+        """
+        logger.info(f'Fetched weather for group of {group.cnt} cities. ')
+        items = {item.get('id'): item for item in group.items}
+
+        results: list = []
+        for city in cities:
+            item = items.get(city.open_weather_id)
+            if item is None:
+                results.append(ResponseError(msg=f'No {city} at group response. '))
+                continue
+            try:
+                results.append(self.parse(item))
+            except ResponseError as e:
+                results.append(e)
+        return results
 
     def fetch(self, city: CityModel):  # type: ignore
         logger.info(f'Fetching weather for {city}. ')
 
-        self.params['lat'] = str(city.latitude)
-        self.params['lon'] = str(city.longitude)
-        measure = super().fetch()
+        params = self.params | {'lat': str(city.latitude), 'lon': str(city.longitude)}
+        return super().fetch(params)
+
+    async def fetch_concurrently(self, requests: list[list[CityModel]]):
+        """
+        Make all requests at once. Amount of simultaneous requests is restricted by
+        `fetch_concurrency` configuration (connections pool limit).
+        """
+        async with init_async_client() as session:
+            responses = await asyncio.gather(
+                *[self.fetch_request_async(session, cities) for cities in requests],
+                return_exceptions=True,
+            )
+
+        for response in responses:
+            if isinstance(response, BaseException):
+                raise response
+        return responses
+
+    async def fetch_async(self, session: aiohttp.ClientSession, city: CityModel):  # type: ignore
+        logger.info(f'Fetching weather for {city}. ')
+
+        params = self.params | {'lat': str(city.latitude), 'lon': str(city.longitude)}
+        return self.parse(await super().fetch_async(session, params))
 
-        extra: dict = self.response.json()
-        for field in self.schema.__fields__:
-            extra.pop(field)
+    def parse(self, data: dict):  # type: ignore
+        """
+        Split response data into schema fields and extra fields in one pass. Only schema
+        fields are validated, extra data is stored as it is.
+        """
+        fields = self.schema.__fields__
+        measure: dict = {}
+        extra: dict = {}
+        for field, value in data.items():
+            (measure if field in fields else extra)[field] = value
 
-        return measure, extra
+        return super().parse(measure), extra
 
 
 ########################################################################################
@@ -159,12 +413,15 @@ class CollectScheduler(BaseService):
             '-i',
             '--initial',
             action='store_true',
-            help='init cities before collecting. Useful with -O flag',
+            help='init cities before collecting. Useful with -o flag',
         )
+        # passed to services called at collecting run
+        InitCities.add_argument(parser)
+        FetchWeather.add_argument(parser)
 
     def execute(self):
         super().execute()
-        self.scheduler.add_job(
+        self.job = self.scheduler.add_job(
             self._worker, 'interval', seconds=CONFIG.collect_weather_delay
         )
 
@@ -180,24 +437,34 @@ class CollectScheduler(BaseService):
             logger.info('Collected successfully. ')
             logger.info(f'Next collecting runs in {CONFIG.collect_weather_delay} sec. ')
 
+        except QuotaExceededError as e:
+            # retrying does not help until quota is available again
+            next_run_at = e.reset_at or datetime.now() + timedelta(
+                seconds=CONFIG.collect_weather_delay
+            )
+            logger.error(f'Collecting stops until {next_run_at}. Detail: {e}. ')
+            self.job.modify(next_run_time=next_run_at)
+
         except CollectorBaseException as e:
             # make log and try again in a while
             #
             # [NOTE]
-            # Custom exceptions raised when response is broken or when db has not
-            # necessary data. While this thread will be waiting for nex job execution,
-            # the reason of error could be changed by others.
-            # Therefore, wa adding a new job in a scheduler.
+            # Custom exceptions raised when db has not necessary data or when all
+            # responses are broken (single requests are retried at fetch layer). While
+            # this thread will be waiting for nex job execution, the reason of error
+            # could be changed by others.
+            # Therefore, we are moving the next run of collecting job closer. Adding a
+            # new job is not suitable, because two collecting runs could overlap.
             logger.error(
                 'Collecting fails. '
                 f'Try again in {CONFIG.retry_collect_delay}. Detail: {e}. '
             )
             retry_at = datetime.now() + timedelta(seconds=CONFIG.retry_collect_delay)
-            self.scheduler.add_job(self._worker, 'date', run_date=retry_at)
+            self.job.modify(next_run_time=retry_at)
 
         finally:
             self.counter += 1
-            if self.repeats and self.counter >= self.repeats:
+            if self.repeats and self.counter >= self.repeats and self.scheduler.running:
                 self.scheduler.shutdown(wait=True)
 
 
@@ -209,18 +476,42 @@ class CollectScheduler(BaseService):
 class ReportWeather(BaseService, DBSessionMixin):
     """
     Get report about all weather measurements records. Default output is `sys.stdout`.
+
+    Report is written line by line as rows are fetched (by chunks, through server-side
+    cursor at PostgreSQL), so it starts at once and takes constant memory for any
+    amount of measurements. Small reports are cached until next collecting run (see
+    `collector.cache`).
     """
 
     command = 'report'
     output = sys.stdout
+    read_only = True
+    cached_methods = ['get_basic', 'get_average', 'get_latest']
+    "Reports stored at reports cache (history is streamed, it is never cached). "
 
-    def __init__(self, average: bool = False, latest: bool = False, **kwargs) -> None:
+    def __init__(
+        self,
+        average: bool = False,
+        latest: bool = False,
+        history: bool = False,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        city: list[str] | None = None,
+        chunk_size: int = 10_000,
+        **kwargs,
+    ) -> None:
         self.methods = [self.get_basic]
         if average:
             self.methods.append(self.get_average)
         if latest:
             self.methods.append(self.get_latest)
+        if history:
+            self.methods.append(self.get_history)
 
+        self.since = since
+        self.until = until
+        self.cities = city or []
+        self.chunk_size = chunk_size
         super().__init__(**kwargs)
 
     @classmethod
@@ -235,60 +526,145 @@ class ReportWeather(BaseService, DBSessionMixin):
             action='store_true',
             help='report latest measured temperature for all cities',
         )
+        parser.add_argument(
+            '--history',
+            action='store_true',
+            help='report every measured temperature for all cities',
+        )
+        add_window_arguments(parser)
+        add_chunk_size_argument(parser, 'fetched')
 
     def execute(self):
         super().execute()
-        for method in self.methods:
-            self.output.write(method())
-            self.output.write('\n')
-
-    def get_basic(self):
-        n_cites = self.query(CityModel).count()
-        n_measure = self.query(MeasurementModel).count()
-        return (
+        # generation is taken before any report is made
+        cache = open_report_cache()
+        try:
+            for method in self.methods:
+                for line in self.cached(method, cache):
+                    self.output.write(line)
+                self.output.write('\n')
+                self.output.flush()
+        finally:
+            if cache:
+                cache.close()
+
+    def get_cache_key(self, method: Callable[[], Iterator[str]]) -> str:
+        return json.dumps(
+            {
+                'report': method.__name__,
+                'database': repr(self.session.bind.url),
+                'since': self.since,
+                'until': self.until,
+                'cities': sorted(self.cities),
+            },
+            default=str,
+        )
+
+    def cached(
+        self, method: Callable[[], Iterator[str]], cache: ReportCache | None
+    ) -> Iterator[str]:
+        """
+        Report lines from cache, or made by `method` and stored to cache. Cached
+        report is not queried from database at all.
+        """
+        if cache is None or method.__name__ not in self.cached_methods:
+            yield from method()
+            return
+
+        key = self.get_cache_key(method)
+        report = cache.get(key)
+        if report is not None:
+            yield report
+            return
+
+        lines = []
+        for line in method():
+            lines.append(line)
+            yield line
+        cache.set(key, ''.join(lines))
+
+    def get_basic(self) -> Iterator[str]:
+        cities = self.query(CityModel)
+        if self.cities:
+            cities = cities.filter(CityModel.name.in_(self.cities))
+        n_cites = cities.count()
+        n_measure = self.query(MeasurementModel).filter(*self.get_filters()).count()
+        yield (
             '\n'
             f'Collector storing {n_measure} weather measurements for {n_cites} cities.'
         )
 
-    def get_average(self):
-        report = ''
-        cites: list[CityModel] = self.query(CityModel).all()
-        for city in cites:
-            measurements: list[MeasurementModel] = (
-                self.query(MeasurementModel)
-                .filter(MeasurementModel.city_id == city.id)
-                .all()
-            )
-            if not measurements:
-                continue
+    def get_filters(self) -> list[db.sql.ColumnElement]:
+        return get_window_filters(self.since, self.until, self.cities)
 
-            n_measure = len(measurements)
-            first = measurements[0]
-            last = measurements[-1]
-            average = sum([measure.main.temp for measure in measurements]) / n_measure
-            report += (
+    def stream(self, query: db.sql.Select) -> Iterator[db.engine.Row]:
+        """
+        Fetch rows by chunks of `chunk_size`. Server-side cursor is used if dialect
+        supports it.
+        """
+        yield from self.session.execute(
+            query.execution_options(yield_per=self.chunk_size)
+        )
+
+    def get_stats(self, *columns: str) -> Iterator[db.engine.Row]:
+        """
+        Stats of every city. All-time stats are read from cities rollup (see
+        `collector.stats`) by one row per city, measurements are not scanned. Stats for
+        time window are aggregated from its measurements.
+        """
+        stats = CityWeatherStatsModel.__table__
+        if self.since or self.until:
+            stats = aggregate_stats(*self.get_filters()).subquery()
+
+        query = (
+            db.select(CityModel.name, *[stats.c[column] for column in columns])
+            .join_from(CityModel, stats, CityModel.id == stats.c.city_id)
+            .where(stats.c.temp_count > 0)
+            .order_by(CityModel.id)
+        )
+        if self.cities:
+            query = query.where(CityModel.name.in_(self.cities))
+        return self.stream(query)
+
+    def get_average(self) -> Iterator[str]:
+        rows = self.get_stats(
+            'temp_count',
+            'temp_sum',
+            'temp_sum_squares',
+            'temp_min',
+            'temp_max',
+            'first_at',
+            'last_at',
+        )
+        for row in rows:
+            average = row.temp_sum / row.temp_count
+            variance = row.temp_sum_squares / row.temp_count - average**2
+            std = math.sqrt(max(variance, 0))  # rounding error could make it negative
+            yield (
                 '\n'
-                f'Average temperature at {city.name} is {average} C. '
-                f'({n_measure} measurements {first.measure_at} ... {last.measure_at})'
+                f'Average temperature at {row.name} is {average:.2f} C '
+                f'(min {row.temp_min} C, max {row.temp_max} C, std {std:.2f} C). '
+                f'({row.temp_count} measurements {row.first_at} ... {row.last_at})'
             )
-        return report
-
-    def get_latest(self):
-        report = ''
-        cites: list[CityModel] = self.query(CityModel).all()
-        for city in cites:
-            measure: MeasurementModel = (
-                self.query(MeasurementModel)
-                .filter(MeasurementModel.city_id == city.id)
-                .order_by(MeasurementModel.id.desc())
-                .first()
-            )
-            if not measure:
-                continue
 
-            report += (
+    def get_latest(self) -> Iterator[str]:
+        for row in self.get_stats('last_temp', 'last_at'):
+            yield (
                 '\n'
-                f'Last measured temperature at {city.name} is {measure.main.temp} C. '
-                f'({measure.measure_at})'
+                f'Last measured temperature at {row.name} is {row.last_temp} C. '
+                f'({row.last_at})'
             )
-        return report
+
+    def get_history(self) -> Iterator[str]:
+        temp = db.func.coalesce(MeasurementModel.temp, MainWeatherDataModel.temp)
+        # ordered the same way as `(city_id, measure_at)` unique index, so it is read
+        # by index without sorting
+        query = (
+            db.select(CityModel.name, MeasurementModel.measure_at, temp.label('temp'))
+            .join_from(MeasurementModel, CityModel)
+            .outerjoin(MainWeatherDataModel)
+            .where(*self.get_filters())
+            .order_by(MeasurementModel.city_id, MeasurementModel.measure_at)
+        )
+        for row in self.stream(query):
+            yield f'\nTemperature at {row.name} is {row.temp} C. ({row.measure_at})'
@@ -2,18 +2,73 @@ from __future__ import annotations
 
 import functools
 import inspect
-from typing import Callable, Type
+import io
+from datetime import date, datetime
+from typing import Callable, Container, Iterator, Type
 
 import pydantic
 import sqlalchemy as db
 import sqlalchemy.orm as orm
+from sqlalchemy.dialects import postgresql, sqlite
 
-from collector.configurations import CONFIG, logger
+from collector.cache import bump_generation
+from collector.configurations import CONFIG, DatabaseConfig, logger
 from collector.models import BaseModel
+from collector.partitioning import ensure_partitions
+
+
+class PoolStats(pydantic.BaseModel):
+    """
+    Connection pool events since process start. For long-running collector `connects`
+    should stay close to pool size, while `checkouts` grows by one per run.
+    """
+
+    connects: int = 0
+    checkouts: int = 0
+    invalidations: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f'{self.connects} connects, {self.checkouts} checkouts, '
+            f'{self.invalidations} invalidated'
+        )
+
+
+pool_stats = PoolStats()
+
+
+def count_pool_event(field: str):
+    def listener(*args):
+        setattr(pool_stats, field, getattr(pool_stats, field) + 1)
+
+    return listener
+
+
+# listen for every pool (not only for `engine` below), so engines created by tests or
+# scripts are counted too
+db.event.listen(db.pool.Pool, 'connect', count_pool_event('connects'))
+db.event.listen(db.pool.Pool, 'checkout', count_pool_event('checkouts'))
+db.event.listen(db.pool.Pool, 'invalidate', count_pool_event('invalidations'))
+
+
+def init_engine():
+    """
+    Engine is created once per process and kept alive between collecting runs, so
+    connections are reused from its pool.
+    """
+    options = {}
+    if isinstance(CONFIG.db, DatabaseConfig):
+        options = dict(
+            pool_size=CONFIG.db.pool_size,
+            max_overflow=CONFIG.db.max_overflow,
+            pool_pre_ping=CONFIG.db.pool_pre_ping,
+        )
+    return db.create_engine(CONFIG.db.url, future=True, echo=CONFIG.db.echo, **options)
+
 
 try:
     logger.debug(f'Establishing (lazy) connection to database: {CONFIG.db.url}')
-    engine = db.create_engine(CONFIG.db.url, future=True, echo=CONFIG.db.echo)
+    engine = init_engine()
 except Exception as e:
     logger.critical(f'Connection failed. Check your database is running: {CONFIG.db}')
     raise e
@@ -21,21 +76,41 @@ except Exception as e:
 
 def session_enter(wrapped: Callable):
     @functools.wraps(wrapped)
-    def wrapper(self: DBSessionMixin, *args, **kwargs):
-        self.session = orm.Session(engine)
+    def wrapper(
+        self: DBSessionMixin, *args, session: orm.Session | None = None, **kwargs
+    ):
+        # service called by another one shares its session (and connection), so the
+        # whole run is one unit of work. Only the session owner commits, rolls back and
+        # closes it. Data which must survive failed run is stored by separate session
+        # (see `DBSessionMixin.separate_session`)
+        #
+        # [NOTE]
+        # Nested service does not open SAVEPOINT: pysqlite emits no BEGIN before it, so
+        # its RELEASE commits at SQLite.
+        self.session_owner = session is None
+        self.session = session or orm.Session(engine)
         logger.debug(f'Session is open with {engine=}. ')
-        return wrapped(self, *args, **kwargs)
+        try:
+            return wrapped(self, *args, **kwargs)
+        except Exception as e:
+            self.close_session()
+            raise e
 
+    wrapper.opens_session = True  # type: ignore
     return wrapper
 
 
 def session_exit(wrapped: Callable):
     @functools.wraps(wrapped)
     def wrapper(self: DBSessionMixin, *args, **kwargs):
-        result = wrapped(self, *args, **kwargs)
-        self.session.commit()
-        self.session.close()
-        logger.debug('Session is closed. ')
+        try:
+            result = wrapped(self, *args, **kwargs)
+            self.save()
+            # committed changes are seen by reports, cached ones are made again
+            if self.session_owner and not self.read_only:
+                bump_generation()
+        finally:
+            self.close_session()
         return result
 
     return wrapper
@@ -48,12 +123,98 @@ def safe_transaction(wrapped: Callable):
             return wrapped(self, *args, **kwargs)
         except Exception as e:
             logger.debug(f'Transaction is rolling back. Exception: {e}')
-            self.session.rollback()
+            self.rollback()
             raise e
 
     return wrapper
 
 
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_format(value) -> str:
+    r"""
+    Represent value for `COPY` text format.
+
+    >>> copy_format(None), copy_format(True), copy_format(1.5), copy_format('a\tb\\c')
+    ('\\N', 't', '1.5', 'a\\tb\\\\c')
+    """
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value).translate(COPY_ESCAPES)
+
+
+class BulkInsert:
+    """
+    Buffer of rows to insert into parent table and its one-to-one children tables by a
+    few multi-row statements instead of ORM unit of work (which makes INSERT with
+    RETURNING round trip for every object).
+
+    Child rows are linked to parent row by position at buffer. Parent ids are allocated
+    at flush (see `DBSessionMixin.bulk_create`).
+
+    >>> from collector.models import MainWeatherDataModel, MeasurementModel
+    >>> bulk = BulkInsert(MeasurementModel, main=MainWeatherDataModel)
+    >>> bulk.add({'city_id': 1}, main={'temp': 1.5})
+    >>> len(bulk)
+    1
+    """
+
+    def __init__(self, model: Type[BaseModel], **children: Type[BaseModel]) -> None:
+        self.model = model
+        self.children = children
+        self.rows: list[dict] = []
+        self.children_rows: dict[str, list[dict]] = {name: [] for name in children}
+
+    def add(self, row: dict, **children: dict):
+        self.rows.append(row)
+        for name, child in children.items():
+            self.children_rows[name].append(child)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_foreign_key(self, child: Type[BaseModel]) -> dict[str, str]:
+        """
+        Names of child table columns referenced to parent table columns (id and
+        partitioning key).
+        """
+        for constraint in child.__table__.foreign_key_constraints:
+            if constraint.referred_table is self.model.__table__:
+                return {
+                    element.parent.name: element.column.name
+                    for element in constraint.elements
+                }
+        raise ValueError(f'{child} has no reference to {self.model}. ')
+
+    def with_ids(self, ids: list[int]) -> list[dict]:
+        """
+        Parent rows with allocated ids.
+        """
+        return [row | {'id': id} for row, id in zip(self.rows, ids)]
+
+    def children_of(
+        self, rows: list[dict], stored: Container[int]
+    ) -> Iterator[tuple[Type[BaseModel], list[dict]]]:
+        """
+        Children rows with resolved references to parent `rows` for every child table.
+        Only children of `stored` parent rows are taken.
+        """
+        for name, child in self.children.items():
+            foreign_key = self.get_foreign_key(child)
+            yield child, [
+                child_row | {column: row[key] for column, key in foreign_key.items()}
+                for child_row, row in zip(self.children_rows[name], rows)
+                if row['id'] in stored
+            ]
+
+
 class DBSessionMeta(type):
     """
     Create class which operates as session context manager.
@@ -61,6 +222,10 @@ class DBSessionMeta(type):
     Meta is for wrapping all class methods into `safe_transaction` decorator.
     And for wrapping enter method for `Session()` opening and exit method for
     `session.commit()`, `session.close()`.
+
+    Enter method inherited from not session class (for instance, `BaseService.__init__`
+    of service which declares no `__init__`) is wrapped too. `DBSessionMixin` itself
+    opens no session.
     """
 
     session_enter_method = '__init__'
@@ -76,7 +241,16 @@ class DBSessionMeta(type):
                 if key == cls.session_exit_method:
                     attrs[key] = session_exit(attrs[key])
 
-        return type.__new__(cls, clsname, bases, attrs)
+        new = type.__new__(cls, clsname, bases, attrs)
+        name = cls.session_enter_method
+        if bases and not getattr(getattr(new, name), 'opens_session', False):
+
+            def enter(self, *args, **kwargs):
+                return getattr(super(new, self), name)(*args, **kwargs)
+
+            enter.__name__, enter.__qualname__ = name, f'{clsname}.{name}'
+            setattr(new, name, session_enter(safe_transaction(enter)))
+        return new
 
 
 class DBSessionMixin(metaclass=DBSessionMeta):
@@ -84,9 +258,44 @@ class DBSessionMixin(metaclass=DBSessionMeta):
     Mixin for handling usual CRUD operations with database.
     Session is opening at class init and closing when `save()` is called. For commit any
     changes `save()` method must by called.
+
+    Every service takes `session` keyword argument: nested service shares that session
+    instead of opening its own. It is taken by `session_enter` wrapper before `__init__`
+    is called, so services declare it by their `**kwargs` only.
     """
 
     session: orm.Session
+    session_owner: bool = True
+    read_only: bool = False
+    "Service does not change any data, so cached reports are kept after it. "
+
+    def save(self):
+        """
+        Commit changes. Changes of nested service (not session owner) are committed
+        together with owner ones.
+        """
+        if self.session_owner:
+            self.session.commit()
+
+    def rollback(self):
+        """
+        Roll back changes. Nested service leaves it to session owner, which gets its
+        exception.
+        """
+        if self.session_owner:
+            self.session.rollback()
+
+    def separate_session(self) -> orm.Session:
+        """
+        New session committed apart from service one. For data which must be stored
+        even if service (or collecting run it is called by) fails.
+        """
+        return orm.Session(engine, expire_on_commit=False)
+
+    def close_session(self):
+        if self.session_owner:
+            self.session.close()
+            logger.debug('Session is closed. ')
 
     def query(self, model_class: Type[BaseModel]):
         return self.session.query(model_class)
@@ -94,6 +303,126 @@ class DBSessionMixin(metaclass=DBSessionMeta):
     def create(self, *instances: BaseModel):
         self.session.add_all(instances)
 
+    def bulk_create(self, bulk: BulkInsert):
+        """
+        Insert all buffered rows. One `executemany` statement per table (psycopg2
+        dialect pages them into multi-row INSERTs).
+
+        Parent rows conflicting with already stored ones (for instance, the same
+        measurement fetched twice) are skipped by `ON CONFLICT DO NOTHING` together
+        with their children rows. Children rows are streamed by `COPY` if supported.
+
+        Returns stored parent rows (with ids).
+        """
+        if not bulk:
+            return []
+
+        if 'measure_at' in bulk.model.__table__.c:
+            # partitions for new months are created by the first run at that month
+            ensure_partitions(
+                self.session.connection(), (row['measure_at'] for row in bulk.rows)
+            )
+
+        ids = self.allocate_ids(bulk.model, len(bulk))
+        rows = bulk.with_ids(ids)
+        self.session.execute(self.insert_ignore(bulk.model), rows)
+        stored = self.get_stored_ids(bulk.model, ids)
+
+        copy = self.copy_supported()
+        for model, children_rows in bulk.children_of(rows, stored):
+            if not children_rows:
+                continue
+            if copy:
+                self.copy_rows(model, children_rows)
+            else:
+                self.session.execute(db.insert(model), children_rows)
+
+        logger.debug(
+            f'Bulk insert {len(bulk)} rows to {bulk.model.__tablename__}, '
+            f'{len(bulk) - len(stored)} skipped. '
+        )
+        return [row for row in rows if row['id'] in stored]
+
+    def insert_ignore(self, model: Type[BaseModel]) -> db.sql.Insert:
+        """
+        INSERT statement skipping rows which violate any unique constraint.
+        """
+        if self.session.bind.dialect.name == 'postgresql':
+            return postgresql.insert(model).on_conflict_do_nothing()
+        return sqlite.insert(model).on_conflict_do_nothing()
+
+    def get_stored_ids(self, model: Type[BaseModel], ids: list[int]) -> set[int]:
+        """
+        Which of just allocated ids are inserted. Ids are taken by range, as they are
+        (mostly) sequential, and rows of other writers at that range are filtered out.
+        """
+        if not ids:
+            return set()
+        stored = self.session.scalars(
+            db.select(model.id).where(model.id.between(min(ids), max(ids)))
+        )
+        return set(ids).intersection(stored)
+
+    def copy_supported(self):
+        dialect = self.session.bind.dialect
+        return (
+            getattr(CONFIG.db, 'bulk_copy', False)
+            and dialect.name == 'postgresql'
+            and dialect.driver == 'psycopg2'
+        )
+
+    def copy_rows(self, model: Type[BaseModel], rows: list[dict]):
+        """
+        Stream rows by `COPY FROM STDIN` through in-memory buffer (text format). Values
+        are processed by column types the same way as for INSERT (JSON is dumped).
+        """
+        dialect = self.session.bind.dialect
+        names = set().union(*rows)
+        columns = [column for column in model.__table__.columns if column.name in names]
+        processors = [
+            (i, process)
+            for i, column in enumerate(columns)
+            if (process := column.type.dialect_impl(dialect).bind_processor(dialect))
+        ]
+
+        buffer = io.StringIO()
+        for row in rows:
+            values = [row.get(column.name) for column in columns]
+            for i, process in processors:
+                values[i] = process(values[i])
+            buffer.write('\t'.join(map(copy_format, values)) + '\n')
+        buffer.seek(0)
+
+        # raw DBAPI cursor at the same connection (and transaction) as session has
+        cursor = self.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f'COPY {model.__tablename__} ({", ".join(c.name for c in columns)}) '
+            'FROM STDIN',
+            buffer,
+        )
+
+    def allocate_ids(self, model: Type[BaseModel], amount: int) -> list[int]:
+        """
+        Reserve ids for new rows, so children rows could reference them before parent
+        rows are inserted.
+        """
+        table = model.__tablename__
+        if self.session.bind.dialect.name == 'postgresql':
+            return self.session.scalars(
+                db.select(
+                    db.func.nextval(db.func.pg_get_serial_sequence(table, 'id'))
+                ).select_from(db.func.generate_series(1, amount))
+            ).all()
+
+        # [NOTE]
+        # SQLite has no sequences, it takes max id + 1 for new rows the same way. No-op
+        # update takes database write lock before max id is read, so concurrent writer
+        # waits until these ids are inserted and committed.
+        table = model.__table__
+        self.session.execute(table.update().where(db.false()).values(id=table.c.id))
+        last = self.session.scalar(db.select(db.func.max(model.id))) or 0
+        return list(range(last + 1, last + amount + 1))
+
     def create_from_schema(
         self, model_class: Type[BaseModel], *instances: pydantic.BaseModel
     ):
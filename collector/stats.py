@@ -0,0 +1,265 @@
+"""
+Incrementally maintained temperature rollup for every city (`city_weather_stats`).
+
+Collecting run aggregates its stored measurements by city and adds them to the rollup
+by one upsert statement at the same transaction (see `FetchWeather`). So the rollup is
+always consistent with committed measurements. Dropped measurements are subtracted
+from it (see `Retention` service). Whole rollup is rebuilt from all measurements by
+`rebuild_stats` service only.
+"""
+
+from __future__ import annotations
+
+from datetime import date, datetime
+from typing import Iterable
+
+import sqlalchemy as db
+from sqlalchemy.dialects import postgresql, sqlite
+
+from collector.models import (
+    CityWeatherStatsModel,
+    MainWeatherDataModel,
+    MeasurementModel,
+)
+
+
+def get_deltas(measurements: Iterable[tuple[int, datetime, float | None]]):
+    """
+    Aggregate `(city_id, measure_at, temp)` of new measurements by city. Measurements
+    without temperature are skipped.
+
+    >>> deltas = get_deltas(
+    ...     [
+    ...         (1, datetime(2022, 11, 2), 4.0),
+    ...         (1, datetime(2022, 11, 1), 2.0),
+    ...         (2, datetime(2022, 11, 1), None),
+    ...     ]
+    ... )
+    >>> [(d['city_id'], d['temp_count'], d['temp_sum'], d['last_temp']) for d in deltas]
+    [(1, 2, 6.0, 4.0)]
+    """
+    deltas: dict[int, dict] = {}
+    for city_id, measure_at, temp in measurements:
+        if temp is None:
+            continue
+        delta = deltas.get(city_id)
+        if delta is None:
+            deltas[city_id] = {
+                'city_id': city_id,
+                'temp_count': 1,
+                'temp_sum': temp,
+                'temp_sum_squares': temp**2,
+                'temp_min': temp,
+                'temp_max': temp,
+                'first_at': measure_at,
+                'last_at': measure_at,
+                'last_temp': temp,
+            }
+            continue
+
+        delta['temp_count'] += 1
+        delta['temp_sum'] += temp
+        delta['temp_sum_squares'] += temp**2
+        delta['temp_min'] = min(delta['temp_min'], temp)
+        delta['temp_max'] = max(delta['temp_max'], temp)
+        delta['first_at'] = min(delta['first_at'], measure_at)
+        if measure_at > delta['last_at']:
+            delta['last_at'], delta['last_temp'] = measure_at, temp
+    return list(deltas.values())
+
+
+def update_stats(connection: db.engine.Connection, deltas: list[dict]):
+    """
+    Add deltas (see `get_deltas`) to cities rollup rows, or insert new ones. One
+    `executemany` upsert statement for all cities.
+    """
+    if not deltas:
+        return
+
+    table = CityWeatherStatsModel.__table__
+    if connection.dialect.name == 'postgresql':
+        insert = postgresql.insert(table)
+        least, greatest = db.func.least, db.func.greatest
+    else:
+        insert = sqlite.insert(table)
+        least, greatest = db.func.min, db.func.max  # scalar with several arguments
+
+    new = insert.excluded
+    connection.execute(
+        insert.on_conflict_do_update(
+            index_elements=[table.c.city_id],
+            set_={
+                'temp_count': table.c.temp_count + new.temp_count,
+                'temp_sum': table.c.temp_sum + new.temp_sum,
+                'temp_sum_squares': table.c.temp_sum_squares + new.temp_sum_squares,
+                'temp_min': least(table.c.temp_min, new.temp_min),
+                'temp_max': greatest(table.c.temp_max, new.temp_max),
+                'first_at': least(table.c.first_at, new.first_at),
+                'last_at': greatest(table.c.last_at, new.last_at),
+                'last_temp': db.case(
+                    (new.last_at >= table.c.last_at, new.last_temp),
+                    else_=table.c.last_temp,
+                ),
+                'updated_at': db.func.now(),
+            },
+        ),
+        deltas,
+    )
+
+
+def group_stats(
+    *where: db.sql.ColumnElement, window: tuple[date, date] | None = None
+) -> db.sql.Select:
+    """
+    Measurements (filtered by `where` clauses) aggregated by city, without the last
+    temperature.
+
+    `window` is `[since, until)` range of measurement time. It filters main data too
+    (at join condition), so at PostgreSQL only partitions of that range are read from
+    both tables.
+    """
+    temp = db.func.coalesce(MeasurementModel.temp, MainWeatherDataModel.temp)
+    onclause = db.and_(
+        MainWeatherDataModel.measurement_id == MeasurementModel.id,
+        MainWeatherDataModel.measure_at == MeasurementModel.measure_at,
+    )
+    if window:
+        since, until = window
+        where += (
+            MeasurementModel.measure_at >= since,
+            MeasurementModel.measure_at < until,
+        )
+        onclause = db.and_(
+            onclause,
+            MainWeatherDataModel.measure_at >= since,
+            MainWeatherDataModel.measure_at < until,
+        )
+    return (
+        db.select(
+            MeasurementModel.city_id,
+            db.func.count().label('temp_count'),
+            db.func.sum(temp).label('temp_sum'),
+            db.func.sum(temp * temp).label('temp_sum_squares'),
+            db.func.min(temp).label('temp_min'),
+            db.func.max(temp).label('temp_max'),
+            db.func.min(MeasurementModel.measure_at).label('first_at'),
+            db.func.max(MeasurementModel.measure_at).label('last_at'),
+        )
+        .outerjoin(MainWeatherDataModel, onclause)
+        .where(temp.is_not(None), *where)
+        .group_by(MeasurementModel.city_id)
+    )
+
+
+def aggregate_stats(*where: db.sql.ColumnElement) -> db.sql.Select:
+    """
+    Measurements (filtered by `where` clauses) aggregated by city. The same columns as
+    rollup table has.
+    """
+    temp = db.func.coalesce(MeasurementModel.temp, MainWeatherDataModel.temp)
+    stats = group_stats(*where).subquery()
+    # last measurement is unique by city and time
+    return (
+        db.select(stats, temp.label('last_temp'))
+        .join_from(
+            stats,
+            MeasurementModel,
+            db.and_(
+                MeasurementModel.city_id == stats.c.city_id,
+                MeasurementModel.measure_at == stats.c.last_at,
+            ),
+        )
+        .outerjoin(MainWeatherDataModel)
+    )
+
+
+def subtract_stats(connection: db.engine.Connection, dropped: list[dict]) -> int:
+    """
+    Subtract aggregates of dropped measurements (see `group_stats`, they are taken
+    before measurements are dropped) from cities rollup. Returns amount of cities
+    aggregated again.
+
+    Count and sums are subtracted, first measurement time is the first remaining one
+    (read by `(city_id, measure_at)` index). Minimum, maximum and last temperature
+    could not be subtracted, so cities which extreme temperature (or all
+    measurements) are dropped are aggregated again from their remaining measurements.
+    """
+    if not dropped:
+        return 0
+
+    table = CityWeatherStatsModel.__table__
+    current = {
+        row.city_id: row
+        for row in connection.execute(
+            db.select(table).where(
+                table.c.city_id.in_([delta['city_id'] for delta in dropped])
+            )
+        )
+    }
+    subtracted, aggregated = [], []
+    for delta in dropped:
+        row = current.get(delta['city_id'])
+        if row is None:
+            continue
+        if (
+            delta['temp_count'] >= row.temp_count
+            or delta['temp_min'] <= row.temp_min
+            or delta['temp_max'] >= row.temp_max
+        ):
+            aggregated.append(delta['city_id'])
+        else:
+            subtracted.append(
+                {
+                    f'_{key}': delta[key]
+                    for key in ['city_id', 'temp_count', 'temp_sum', 'temp_sum_squares']
+                }
+            )
+
+    if subtracted:
+        first_at = (
+            db.select(db.func.min(MeasurementModel.measure_at))
+            .where(MeasurementModel.city_id == table.c.city_id)
+            .scalar_subquery()
+        )
+        connection.execute(
+            db.update(table)
+            .where(table.c.city_id == db.bindparam('_city_id'))
+            .values(
+                temp_count=table.c.temp_count - db.bindparam('_temp_count'),
+                temp_sum=table.c.temp_sum - db.bindparam('_temp_sum'),
+                temp_sum_squares=(
+                    table.c.temp_sum_squares - db.bindparam('_temp_sum_squares')
+                ),
+                first_at=first_at,
+                updated_at=db.func.now(),
+            ),
+            subtracted,
+        )
+
+    if aggregated:
+        connection.execute(db.delete(table).where(table.c.city_id.in_(aggregated)))
+        rows = aggregate_stats(MeasurementModel.city_id.in_(aggregated))
+        connection.execute(
+            db.insert(table).from_select(rows.selected_columns.keys(), rows)
+        )
+    return len(aggregated)
+
+
+def rebuild_stats(connection: db.engine.Connection) -> int:
+    """
+    Replace rollup by aggregation of all measurements. Returns amount of cities.
+
+    PostgreSQL rollup table is locked until transaction ends, so collecting run at the
+    same time waits and adds its measurements after rebuild (they are not counted
+    twice or lost).
+    """
+    table = CityWeatherStatsModel.__table__
+    if connection.dialect.name == 'postgresql':
+        connection.execute(db.text(f'LOCK TABLE {table.name} IN EXCLUSIVE MODE'))
+    connection.execute(db.delete(table))
+
+    rows = aggregate_stats()
+    result = connection.execute(
+        db.insert(table).from_select(rows.selected_columns.keys(), rows)
+    )
+    return result.rowcount
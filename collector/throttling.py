@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+
+import pydantic
+
+from collector.configurations import CONFIG, QuotaConfig, RetryConfig
+from collector.exceptions import QuotaExceededError
+
+
+class TokenBucket:
+    """
+    Bucket holds up to `capacity` tokens and refills them at `rate` tokens per second.
+
+    Taking a token from empty bucket reserves it in advance: caller gets the delay to
+    wait until that token is refilled. Therefore many threads (or coroutines) could
+    share one bucket and every call is made exactly at bucket rate, without polling.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take one token. Returns seconds to wait before using it.
+        """
+        with self.lock:
+            now = time.monotonic()
+            refilled = (now - self.updated_at) * self.rate
+            self.tokens = min(self.capacity, self.tokens + refilled)
+            self.updated_at = now
+
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+class MonthlyBudget:
+    """
+    Calls counter which is reset at every new calendar month (UTC). Counter is kept in
+    memory, so it is per process and starts over at restart.
+    """
+
+    def __init__(self, limit: int | None) -> None:
+        self.limit = limit
+        self.used = 0
+        self.month = self.current_month()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def current_month():
+        now = datetime.utcnow()
+        return now.year, now.month
+
+    def reset_at(self) -> datetime:
+        """
+        Start of the next month (UTC), when budget is available again.
+        """
+        year, month = self.month
+        if month == 12:
+            return datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+        return datetime(year, month + 1, 1, tzinfo=timezone.utc)
+
+    def spend(self):
+        with self.lock:
+            month = self.current_month()
+            if month != self.month:
+                self.month = month
+                self.used = 0
+
+            if self.limit is not None and self.used >= self.limit:
+                raise QuotaExceededError(
+                    msg=f'Monthly budget is spent: {self.used}/{self.limit} calls. ',
+                    reset_at=self.reset_at(),
+                )
+            self.used += 1
+
+
+class LimiterStats(pydantic.BaseModel):
+    calls: int = 0
+    waits: int = 0
+    wait_time: float = 0
+    max_wait: float = 0
+
+    def add(self, delay: float):
+        self.calls += 1
+        if delay:
+            self.waits += 1
+            self.wait_time += delay
+            self.max_wait = max(self.max_wait, delay)
+
+    def __str__(self) -> str:
+        return (
+            f'{self.calls} calls, {self.waits} waits, '
+            f'{self.wait_time:.2f} sec waited (max {self.max_wait:.2f} sec)'
+        )
+
+
+class RateLimiter:
+    """
+    Client side restriction for API calls quota.
+    """
+
+    def __init__(self, quota: QuotaConfig) -> None:
+        self.bucket = TokenBucket(quota.rate, quota.burst)
+        self.budget = MonthlyBudget(quota.monthly)
+        self.stats = LimiterStats()
+
+    def reserve(self) -> float:
+        self.budget.spend()
+        delay = self.bucket.reserve()
+        self.stats.add(delay)
+        return delay
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self.reserve())
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api: str) -> RateLimiter:
+    """
+    Get rate limiter for API by its name at `quotas` configuration. Limiter is shared
+    by all fetch services calling for that API.
+    """
+    with _limiters_lock:
+        if api not in _limiters:
+            _limiters[api] = RateLimiter(CONFIG.quotas[api])
+        return _limiters[api]
+
+
+########################################################################################
+# Retries
+########################################################################################
+
+
+RETRY_STATUSES = {
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+}
+"Response statuses which are worth to retry. Others are client errors. "
+
+
+class RetryBudget:
+    """
+    Retries are allowed for some ratio of requests made within sliding window (see
+    `budget_window`). When API is down, every request fails and retrying all of them
+    only adds load.
+    """
+
+    def __init__(self) -> None:
+        self._requests: deque[float] = deque()
+        self._retries: deque[float] = deque()
+        self.lock = threading.Lock()
+
+    @property
+    def requests(self) -> int:
+        with self.lock:
+            self.expire(CONFIG.retry)
+            return len(self._requests)
+
+    @property
+    def retries(self) -> int:
+        with self.lock:
+            self.expire(CONFIG.retry)
+            return len(self._retries)
+
+    def expire(self, config: RetryConfig):
+        """
+        Forget requests and retries made before window. Must be called under lock.
+        """
+        since = time.monotonic() - config.budget_window
+        for made_at in self._requests, self._retries:
+            while made_at and made_at[0] < since:
+                made_at.popleft()
+
+    def deposit(self):
+        with self.lock:
+            self.expire(CONFIG.retry)
+            self._requests.append(time.monotonic())
+
+    def withdraw(self, config: RetryConfig) -> bool:
+        with self.lock:
+            self.expire(config)
+            allowed = config.budget_minimum + config.budget_ratio * len(self._requests)
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(time.monotonic())
+            return True
+
+
+retry_budget = RetryBudget()
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    `Retry-After` header is seconds or HTTP date.
+
+    >>> parse_retry_after('3')
+    3.0
+    >>> parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT')
+    0.0
+    >>> parse_retry_after('unknown')
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_retry_delay(attempt: int, retry_after: str | None = None) -> float | None:
+    """
+    Get seconds to wait before next attempt, or None if request should not be retried
+    anymore. `attempt` is amount of already made retries.
+
+    Delay is exponential backoff with full jitter, unless server tells how long to wait
+    by `Retry-After` header. Both are capped by `max_backoff`.
+    """
+    config = CONFIG.retry
+    if attempt >= config.attempts or not retry_budget.withdraw(config):
+        return None
+
+    delay = parse_retry_after(retry_after)
+    if delay is not None:
+        return min(config.max_backoff, delay)
+
+    return random.uniform(0, min(config.max_backoff, config.backoff * 2**attempt))
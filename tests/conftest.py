@@ -10,11 +10,20 @@ pytest_plugins = [
     'tests.fixtures.fixture_db',
     'tests.fixtures.fixture_config',
     'tests.fixtures.fixture_cities',
+    'tests.fixtures.fixture_standin',
 ]
 
 logger = init_logger('pytest', 'DEBUG')
 
 
+def pytest_addoption(parser: pytest.Parser):
+    parser.addoption(
+        '--live',
+        action='store_true',
+        help='run tests against real Open Weather and GeoDB APIs instead of stand-in',
+    )
+
+
 @pytest.fixture(autouse=True)
 def new_line():
     """
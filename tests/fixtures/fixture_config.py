@@ -7,6 +7,7 @@ from collector.configurations import (
     CONFIG,
     CollectorConfig,
     DatabaseConfig,
+    QuotaConfig,
     SQLiteDatabaseConfig,
 )
 from tests import logger
@@ -31,8 +32,16 @@ TEST_DB_FILE = os.path.join(os.path.dirname(__file__), 'testdb.sqlite3')
         ),
     ],
 )
-def config(request: pytest.FixtureRequest):
+def config(request: pytest.FixtureRequest, standin: str | None):
     db_config: pydantic.BaseSettings = request.param
+    apis: dict = {}
+    if standin:
+        # stand-in server has no rate limits, so tests are not waiting for quotas
+        apis = dict(
+            urls={api: standin for api in CONFIG.urls},
+            quotas={api: QuotaConfig(calls=1000, period=1) for api in CONFIG.quotas},
+        )
+
     config = CollectorConfig(
         debug=False,
         cities_amount=20,
@@ -40,6 +49,7 @@ def config(request: pytest.FixtureRequest):
         collect_weather_delay=0.5,
         retry_collect_delay=1,
         db=db_config.dict(),
+        **apis,
     )
     logger.debug(f'Running tests under those configurations: {config}')
     return config
@@ -7,6 +7,8 @@ import sqlalchemy.orm as orm
 import collector
 from collector import models
 from collector.configurations import CollectorConfig
+from collector.partitioning import convert_tables
+from collector.session import BulkInsert, DBSessionMixin
 from tests import logger
 
 
@@ -45,3 +47,33 @@ def session(engine: db.engine.Engine, session_class: Type[orm.Session]):
     with session_class(engine) as session:
         yield session
         session.commit()
+
+
+@pytest.fixture
+def store_measurements(session: orm.Session):
+    """
+    Store measurements bulks at `session` the same way as collecting run does (by
+    `DBSessionMixin.bulk_create`) and commit them.
+    """
+    logger.debug('store_measurements fixture')
+    writer = DBSessionMixin()
+    writer.session = session
+
+    def store(*bulks: BulkInsert):
+        for bulk in bulks:
+            writer.bulk_create(bulk)
+        session.commit()
+
+    return store
+
+
+@pytest.fixture
+def partitioned_database(engine: db.engine.Engine, setup_database):
+    """
+    Measurements tables partitioned by month the same way as migration makes.
+    """
+    if engine.dialect.name != 'postgresql':
+        pytest.skip('Partitioning is supported by PostgreSQL only. ')
+
+    with engine.begin() as connection:
+        convert_tables(connection)
@@ -0,0 +1,18 @@
+import pytest
+
+from collector.services import StandInServer
+
+
+@pytest.fixture(scope='session')
+def standin(request: pytest.FixtureRequest):
+    """
+    Run local stand-in server for Open Weather and GeoDB APIs. Yields its url or None
+    if tests are running against real APIs (--live option).
+    """
+    if request.config.getoption('--live'):
+        yield None
+        return
+
+    server = StandInServer(port=0)
+    yield server.start()
+    server.stop()
@@ -1,22 +1,131 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
 import pydantic
 import pytest
+import sqlalchemy as db
 import sqlalchemy.orm as orm
 
-from collector.configurations import CONFIG, CollectorConfig
-from collector.exceptions import NoDataError
-from collector.models import CityModel, MeasurementModel
+from collector import throttling
+from collector.cache import ReportCache, open_report_cache
+from collector.configurations import (
+    CONFIG,
+    CollectorConfig,
+    DatabaseConfig,
+    RetryConfig,
+)
+from collector.exceptions import NoDataError, QuotaExceededError, ResponseError
+from collector.models import (
+    CityModel,
+    CityWeatherStatsModel,
+    ExtraWeatherDataModel,
+    GeocodingCacheModel,
+    MainWeatherDataModel,
+    MeasurementModel,
+    PromotedFieldsMixin,
+)
+from collector.partitioning import (
+    add_months,
+    get_partitions,
+    month_start,
+    partition_name,
+)
+from collector.services import (
+    AnalyzeWeather,
+    BackfillPromotedFields,
+    BaseService,
+    ExportWeather,
+    MigrateExtraData,
+    MigrateMainData,
+    RebuildStats,
+    Retention,
+    StandInServer,
+    base,
+)
 from collector.services.cities import (
     CitySchema,
     FetchCities,
     FetchCoordinates,
     InitCities,
 )
-from collector.services.weather import CollectScheduler, FetchWeather, ReportWeather
+from collector.services.export import ParquetWriter
+from collector.services.weather import (
+    CollectScheduler,
+    FetchWeather,
+    FetchWeatherGroup,
+    MainWeatherSchema,
+    ReportWeather,
+    WeatherGroupSchema,
+)
+from collector.session import BulkInsert, DBSessionMixin, pool_stats
+from collector.stats import get_deltas, group_stats, update_stats
+from collector.throttling import MonthlyBudget, RetryBudget, get_limiter
 
 
 @pytest.mark.usefixtures('mock_config', 'setup_database')
 class TestServices:
 
+    ####################################################################################
+    # Base Service
+    ####################################################################################
+
+    def test_manage_services_own_arguments(self):
+        report = BaseService.manage_services(
+            ['report', '--city', 'Moscow', '--chunk-size', '5']
+        )
+        assert isinstance(report, ReportWeather)
+        assert (report.cities, report.chunk_size) == (['Moscow'], 5)
+
+        # arguments of other services are not accepted
+        with pytest.raises(SystemExit):
+            BaseService.manage_services(['export', '--city', 'Moscow'])
+
+        # but collecting run takes arguments of services it calls
+        collect = BaseService.manage_services(['collect', '--override', '--batch'])
+        assert collect.init_kwargs['override'] and collect.init_kwargs['batch']
+
+        standin = BaseService.manage_services(['standin', '--host', '0.0.0.0'])
+        assert (standin.host, standin.port) == ('0.0.0.0', 8080)
+
+    ####################################################################################
+    # Fetch Service Mixin
+    ####################################################################################
+
+    def test_fetch_services_share_http_client(
+        self, seed_cities_to_database, monkeypatch: pytest.MonkeyPatch
+    ):
+        adapters = [
+            base.client.get_adapter(CONFIG.urls[service.api])
+            for service in [FetchCities, FetchCoordinates, FetchWeather]
+        ]
+        for adapter in adapters:
+            assert adapter._pool_maxsize == CONFIG.http.pool_size
+
+        server = StandInServer(port=0)
+        url = server.start()
+        monkeypatch.setattr(CONFIG, 'urls', dict.fromkeys(CONFIG.urls, url))
+        requested: list[str] = []
+        get = base.client.get
+
+        def counted_get(url: str, **kwargs):
+            requested.append(url)
+            return get(url, **kwargs)
+
+        monkeypatch.setattr(base.client, 'get', counted_get)
+        FetchCoordinates('Moscow').execute()
+        FetchWeather().execute()
+        server.stop()
+
+        # both services are fetching by shared client through one kept alive connection
+        assert len(requested) > 2
+        assert len(server.connections) == 1
+
     ####################################################################################
     # Init Cities Service
     ####################################################################################
@@ -78,6 +187,30 @@ class TestServices:
         cities_from_file = pydantic.parse_file_as(list[CitySchema], config.cities_file)
         assert len(cities_from_file) == amount
 
+    def test_fetch_cities_file_order(
+        self,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+        config: CollectorConfig,
+    ):
+        monkeypatch.setattr(CONFIG, 'cities_amount', 30)
+        fetch_page = FetchCities.fetch_page
+
+        async def fetch_page_reversed(self, session, params: dict):
+            page = await fetch_page(self, session, params)
+            # the first page arrives the last
+            await asyncio.sleep((CONFIG.cities_amount - params['offset']) / 100)
+            return page
+
+        monkeypatch.setattr(FetchCities, 'fetch_page', fetch_page_reversed)
+        FetchCities().execute()
+
+        # pages are written by offset, so file is ordered by population as API lists
+        cities_from_file = pydantic.parse_file_as(list[CitySchema], config.cities_file)
+        population = [city.population for city in cities_from_file]
+        assert len(population) == 30
+        assert population == sorted(population, reverse=True)
+
     def test_fetch_cities_zero_cities_amount_rises(
         self, monkeypatch: pytest.MonkeyPatch
     ):
@@ -97,6 +230,112 @@ class TestServices:
             FetchCoordinates(city).execute()
             assert city.latitude and city.longitude
 
+    def test_fetch_coordinates_from_cache(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        cites: list[CityModel] = session.query(CityModel).all()
+        session.add_all(
+            [
+                GeocodingCacheModel(
+                    name=city.name,
+                    latitude=1,
+                    longitude=2,
+                    fetched_at=datetime.utcnow(),
+                )
+                for city in cites
+            ]
+        )
+        session.commit()
+
+        def fetch(*args):
+            raise AssertionError('Cached coordinates should not be fetched. ')
+
+        monkeypatch.setattr(FetchCoordinates, 'fetch', fetch)
+        FetchCoordinates().execute()
+
+        session.expire_all()
+        for city in session.query(CityModel).all():
+            assert (city.latitude, city.longitude) == (1, 2)
+
+    def test_fetch_coordinates_not_found_is_cached(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        fetched: list[CityModel] = []
+
+        def fetch(self, city: CityModel):
+            fetched.append(city)
+            return []
+
+        monkeypatch.setattr(FetchCoordinates, 'fetch', fetch)
+        FetchCoordinates().execute()
+        cities = len(fetched)
+        assert cities
+        assert session.query(GeocodingCacheModel).count() == cities
+
+        # not found results are not fetched again
+        FetchCoordinates().execute()
+        assert len(fetched) == cities
+
+    def test_fetch_coordinates_concurrent_cache_insert(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        city: CityModel = session.query(CityModel).first()
+        get_cached = FetchCoordinates.get_cached
+
+        def get_cached_then_insert(self, cache: orm.Session, cities: list):
+            entries = get_cached(self, cache, cities)
+            # concurrent run caches the same city while this one is fetching
+            session.add(
+                GeocodingCacheModel(
+                    name=city.name,
+                    countryCode=city.countryCode or '',
+                    latitude=0,
+                    longitude=0,
+                    fetched_at=datetime.utcnow(),
+                )
+            )
+            session.commit()
+            return entries
+
+        monkeypatch.setattr(FetchCoordinates, 'get_cached', get_cached_then_insert)
+        FetchCoordinates(city).execute()
+
+        [entry] = session.query(GeocodingCacheModel).all()
+        session.refresh(entry)
+        assert (entry.latitude, entry.longitude) == (city.latitude, city.longitude)
+        assert entry.latitude
+
+    def test_geocoding_cache_survives_failed_run(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        def bulk_create(self, bulk: BulkInsert):
+            raise RuntimeError('Storing measurements is failed. ')
+
+        monkeypatch.setattr(FetchWeather, 'bulk_create', bulk_create)
+        with pytest.raises(RuntimeError):
+            FetchWeather().execute()
+
+        # coordinates of run are rolled back, but cache is committed on its own
+        assert not session.query(MeasurementModel).count()
+        assert (
+            not session.query(CityModel).filter(CityModel.latitude.is_not(None)).count()
+        )
+        assert session.query(GeocodingCacheModel).count() == len(
+            session.query(CityModel).all()
+        )
+
     ####################################################################################
     # Fetch Weather Service
     ####################################################################################
@@ -114,6 +353,133 @@ class TestServices:
             assert measure.extra
             assert measure.extra.data
 
+    def test_fetch_weather_concurrent(
+        self, cities_list: list, seed_cities_to_database, session: orm.Session
+    ):
+        FetchWeather(concurrent=True).execute()
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert len(measures) == len(cities_list)
+        for measure in measures:
+            assert measure.main.temp
+            assert measure.extra.data
+
+    def test_fetch_weather_batch(
+        self,
+        cities_list: list,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        for i, city in enumerate(session.query(CityModel).all()):
+            city.open_weather_id = i + 1
+        session.commit()
+
+        requested: list[list[CityModel]] = []
+
+        def fetch(self, cities: list[CityModel]):
+            requested.append(cities)
+            items = [
+                {
+                    'id': city.open_weather_id,
+                    'name': city.name,
+                    'dt': 1669306534,
+                    'main': dict.fromkeys(MainWeatherSchema.__fields__, 1),
+                }
+                for city in reversed(cities)
+            ]
+            return WeatherGroupSchema(cnt=len(items), list=items)
+
+        monkeypatch.setattr(FetchWeatherGroup, 'fetch', fetch)
+        monkeypatch.setattr(FetchWeatherGroup, 'max_size', 2)
+        FetchWeather(batch=True).execute()
+
+        assert len(requested) == 3
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert len(measures) == len(cities_list)
+        for measure in measures:
+            assert measure.extra.data['name'] == measure.city.name
+
+    def test_fetch_weather_batch_async(
+        self, seed_cities_to_database, session: orm.Session
+    ):
+        cities = session.query(CityModel).limit(3).all()
+        for i, city in enumerate(cities):
+            city.open_weather_id = i + 1
+        session.commit()
+        params = dict(FetchWeatherGroup.params)
+        shared_params = dict(base.FetchServiceMixin.params)
+
+        async def fetch():
+            async with base.init_async_client() as client:
+                return await service.fetch_request_async(client, cities)
+
+        service = FetchWeather(batch=True)
+        results = asyncio.run(fetch())
+
+        assert len(results) == len(cities)
+        for city, (schema, extra) in zip(cities, results):
+            assert schema.main.temp is not None
+            assert extra['id'] == city.open_weather_id
+
+        # ids and coordinates are passed by call, class params are not changed
+        service.group.fetch(cities)
+        service.fetch(CityModel(name='Moscow', latitude=1, longitude=2))
+        assert FetchWeatherGroup.params == params
+        assert base.FetchServiceMixin.params == shared_params
+
+    @pytest.mark.parametrize('bulk_copy', [True, False])
+    def test_bulk_create(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        store_measurements,
+        monkeypatch: pytest.MonkeyPatch,
+        bulk_copy: bool,
+    ):
+        if isinstance(CONFIG.db, DatabaseConfig):
+            monkeypatch.setattr(CONFIG.db, 'bulk_copy', bulk_copy)
+
+        cities: list[CityModel] = session.query(CityModel).all()
+        bulk = BulkInsert(
+            MeasurementModel, main=MainWeatherDataModel, extra=ExtraWeatherDataModel
+        )
+        for i, city in enumerate(cities):
+            bulk.add(
+                {'city_id': city.id, 'measure_at': datetime.utcnow()},
+                main={'temp': i, 'sea_level': None},
+                extra={'data': {'name': city.name, 'escaped': 'a\tb\nc\\d'}},
+            )
+
+        store_measurements(bulk)
+
+        for i, city in enumerate(cities):
+            [measure] = city.measurements
+            assert measure.main.temp == i
+            assert measure.main.sea_level is None
+            assert measure.extra.data == {
+                'name': city.name,
+                'escaped': 'a\tb\nc\\d',
+            }
+
+    def test_allocate_ids_concurrent_writers(self, engine: db.engine.Engine):
+        def allocate() -> list[int]:
+            writer = DBSessionMixin()
+            with orm.Session(engine) as writer.session:
+                return writer.allocate_ids(CityModel, 2)
+
+        first = DBSessionMixin()
+        first.session = orm.Session(engine)
+        ids = first.allocate_ids(CityModel, 2)
+
+        with ThreadPoolExecutor() as executor:
+            second = executor.submit(allocate)
+            time.sleep(0.2)  # second writer is waiting for the first one
+            first.session.add_all([CityModel(id=id, name=f'{id}') for id in ids])
+            first.session.commit()
+            first.session.close()
+
+            assert not set(ids) & set(second.result())
+
     ####################################################################################
     # Collect Weather Service
     ####################################################################################
@@ -128,7 +494,7 @@ class TestServices:
         monkeypatch.setattr(CONFIG, 'cities_amount', cities_amount)
 
         CollectScheduler(repeats=repeats, initial=True).execute()
-        assert session.query(MeasurementModel).count() == cities_amount * repeats
+        self.assert_measurements_stored_once(session, cities_amount, repeats)
 
     def test_collect_weather_initial_many_cities(
         self,
@@ -140,7 +506,7 @@ class TestServices:
         monkeypatch.setattr(CONFIG, 'cities_amount', cities_amount)
 
         CollectScheduler(repeats=repeats, initial=True).execute()
-        assert session.query(MeasurementModel).count() == cities_amount * repeats
+        self.assert_measurements_stored_once(session, cities_amount, repeats)
 
     def test_collect_weather_with_cities_at_db(
         self,
@@ -151,7 +517,165 @@ class TestServices:
     ):
         repeats = 2
         CollectScheduler(repeats=repeats).execute()
-        assert session.query(MeasurementModel).count() == len(cities_list) * repeats
+        self.assert_measurements_stored_once(session, len(cities_list), repeats)
+
+    def test_collect_weather_quota_exceeded(
+        self, seed_cities_to_database, monkeypatch: pytest.MonkeyPatch
+    ):
+        monkeypatch.setattr(CONFIG, 'retry_collect_delay', 0.01)
+        started: list[float] = []
+
+        class SpentOnceBudget(MonthlyBudget):
+            def spend(self):
+                started.append(time.monotonic())
+                if len(started) == 1:
+                    raise QuotaExceededError(
+                        reset_at=datetime.now(timezone.utc) + timedelta(seconds=1)
+                    )
+
+        limiter = get_limiter('open_weather')
+        monkeypatch.setattr(limiter, 'budget', SpentOnceBudget(limit=None))
+        CollectScheduler(repeats=2).execute()
+
+        # not retried at once, but when quota is available again
+        assert started[1] - started[0] >= 0.9
+
+    def assert_measurements_stored_once(
+        self, session: orm.Session, cities_amount: int, repeats: int
+    ):
+        # Open Weather refreshes measurements every 10 minutes, so repeats are mostly
+        # the same measurements and they are stored once
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert cities_amount <= len(measures) <= cities_amount * repeats
+        assert len({measure.city_id for measure in measures}) == cities_amount
+        assert len({(m.city_id, m.measure_at) for m in measures}) == len(measures)
+
+    ####################################################################################
+    # Stand-in Server Service
+    ####################################################################################
+
+    def test_standin_replay(
+        self,
+        tmp_path,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        recordings = tmp_path / 'recordings.json'
+        recordings.write_text(
+            json.dumps(
+                {
+                    '/geo/1.0/direct?limit=10&q=Moscow%2CNone': {
+                        'status': 200,
+                        'data': [{'name': 'Moscow', 'lat': 1, 'lon': 2}],
+                    }
+                }
+            )
+        )
+        server = StandInServer(port=0, replay=str(recordings))
+        monkeypatch.setattr(CONFIG, 'urls', dict.fromkeys(CONFIG.urls, server.start()))
+
+        city = session.query(CityModel).filter(CityModel.name == 'Moscow').one()
+        FetchCoordinates(city).execute()
+        server.stop()
+
+        assert (city.latitude, city.longitude) == (1, 2)
+        assert server.stats['recorded'] == 1
+
+    def test_standin_faults(
+        self, seed_cities_to_database, monkeypatch: pytest.MonkeyPatch
+    ):
+        server = StandInServer(port=0, error_rate=1)
+        monkeypatch.setattr(CONFIG, 'urls', dict.fromkeys(CONFIG.urls, server.start()))
+        monkeypatch.setattr(CONFIG, 'retry', RetryConfig(attempts=1, backoff=0))
+        budget = RetryBudget()
+        monkeypatch.setattr(base, 'retry_budget', budget)
+        monkeypatch.setattr(throttling, 'retry_budget', budget)
+
+        with pytest.raises(ResponseError):
+            FetchCoordinates('Moscow').execute()
+        server.stop()
+
+        # every request is retried once, but counted at retry budget once
+        assert server.stats['500'] == 2
+        assert (budget.requests, budget.retries) == (1, 1)
+
+    def test_collect_weather_reuses_session_and_connections(
+        self, seed_cities_to_database, monkeypatch: pytest.MonkeyPatch
+    ):
+        nested: list[orm.Session] = []
+        fetch_coordinates = FetchCoordinates.execute
+
+        def execute(self: FetchCoordinates):
+            nested.append(self.session)
+            return fetch_coordinates(self)
+
+        monkeypatch.setattr(FetchCoordinates, 'execute', execute)
+        connects = pool_stats.connects
+
+        service = FetchWeather()
+        service.execute()
+        CollectScheduler(repeats=2).execute()
+
+        # coordinates are resolved at the same session (unit of work) as weather
+        assert nested == [service.session]
+        if isinstance(CONFIG.db, DatabaseConfig):
+            assert pool_stats.connects - connects <= 1
+
+    def test_inherited_init_opens_session(self, session: orm.Session):
+        class CountCities(BaseService, DBSessionMixin):
+            # no `__init__`, `BaseService.__init__` is inherited
+            def execute(self):
+                return self.session.query(CityModel).count()
+
+        service = CountCities()
+        assert service.session_owner
+        assert service.init_kwargs == {}
+        nested = CountCities(session=service.session)
+        assert nested.session is service.session
+        assert not nested.session_owner
+        assert nested.execute() == service.execute()
+
+        # already wrapped `__init__` of session class does not open second session
+        class Subclass(CountCities):
+            pass
+
+        assert Subclass.__init__ is CountCities.__init__
+
+    def test_nested_service_does_not_commit_owner_session(self, session: orm.Session):
+        class AddCity(DBSessionMixin):
+            def __init__(self, name: str, fail: bool = False, **kwargs) -> None:
+                self.name = name
+                self.fail = fail
+                super().__init__(**kwargs)
+
+            def execute(self):
+                self.session.add(CityModel(name=self.name))
+                self.session.flush()
+                if self.fail:
+                    raise RuntimeError('Nested service is failed. ')
+
+        def names() -> set[str]:
+            return {name for name, in session.query(CityModel.name)}
+
+        # nested service is the first one writing at transaction (no BEGIN is emitted
+        # by pysqlite before that), but it still does not commit
+        owner = AddCity('Owner')
+        AddCity('Nested', session=owner.session).execute()
+        owner.session.add(CityModel(name='Pending'))
+        with pytest.raises(RuntimeError):
+            AddCity('Failed', fail=True, session=owner.session).execute()
+
+        # nested services neither commit nor roll back, that is up to owner
+        assert not names()
+        owner.execute()
+        assert names() == {'Owner', 'Nested', 'Pending', 'Failed'}
+
+        failed = AddCity('Failed owner', fail=True)
+        AddCity('Nested at failed', session=failed.session).execute()
+        with pytest.raises(RuntimeError):
+            failed.execute()
+        assert names() == {'Owner', 'Nested', 'Pending', 'Failed'}
 
     ####################################################################################
     # Report Weather Service
@@ -161,3 +685,713 @@ class TestServices:
         CollectScheduler(repeats=1).execute()
         ReportWeather(average=True, latest=True).execute()
         ...
+
+    def test_report_weather_average(
+        self, seed_cities_to_database, session: orm.Session, store_measurements
+    ):
+        city: CityModel = session.query(CityModel).first()
+        start = datetime(2022, 11, 1)
+        wide = BulkInsert(MeasurementModel)
+        narrow = BulkInsert(MeasurementModel, main=MainWeatherDataModel)
+        for temp in [1, 2, 3]:
+            wide.add({'city_id': city.id, 'measure_at': start, 'temp': temp})
+            start += timedelta(hours=1)
+        narrow.add({'city_id': city.id, 'measure_at': start}, main={'temp': 6})
+
+        store_measurements(wide, narrow)
+        RebuildStats().execute()
+
+        report = ReportWeather(average=True)
+        report.output = io.StringIO()
+        report.execute()
+        assert report.output.getvalue().endswith(
+            f'\nAverage temperature at {city.name} is 3.00 C '
+            '(min 1.0 C, max 6.0 C, std 1.87 C). '
+            '(4 measurements 2022-11-01 00:00:00 ... 2022-11-01 03:00:00)\n'
+        )
+
+    def test_report_weather_latest(
+        self, seed_cities_to_database, session: orm.Session, store_measurements
+    ):
+        first, second = session.query(CityModel).order_by(CityModel.id).limit(2)
+        start = datetime(2022, 11, 1)
+        wide = BulkInsert(MeasurementModel)
+        narrow = BulkInsert(MeasurementModel, main=MainWeatherDataModel)
+        for temp in [1, 2, 3]:
+            wide.add({'city_id': first.id, 'measure_at': start, 'temp': temp})
+            narrow.add(
+                {'city_id': second.id, 'measure_at': start + timedelta(days=temp)},
+                main={'temp': temp * 10},
+            )
+            start += timedelta(hours=1)
+
+        store_measurements(wide, narrow)
+        RebuildStats().execute()
+
+        report = ReportWeather(latest=True)
+        report.output = io.StringIO()
+        report.execute()
+        assert report.output.getvalue().endswith(
+            f'\nLast measured temperature at {first.name} is 3.0 C. '
+            '(2022-11-01 02:00:00)'
+            f'\nLast measured temperature at {second.name} is 30.0 C. '
+            '(2022-11-04 02:00:00)\n'
+        )
+
+    def test_report_weather_time_window(
+        self, seed_cities_to_database, session: orm.Session, store_measurements
+    ):
+        first, second = session.query(CityModel).order_by(CityModel.id).limit(2)
+        start = datetime(2022, 11, 1)
+        bulk = BulkInsert(MeasurementModel, main=MainWeatherDataModel)
+        for city in [first, second]:
+            for day in range(4):
+                bulk.add(
+                    {'city_id': city.id, 'measure_at': start + timedelta(day)},
+                    main={'temp': day},
+                )
+
+        store_measurements(bulk)
+
+        report = ReportWeather(
+            average=True,
+            latest=True,
+            history=True,
+            since=datetime(2022, 11, 2),
+            until=datetime(2022, 11, 4),
+            city=[first.name],
+            chunk_size=1,
+        )
+        report.output = io.StringIO()
+        report.execute()
+        assert report.output.getvalue() == (
+            '\nCollector storing 2 weather measurements for 1 cities.\n'
+            f'\nAverage temperature at {first.name} is 1.50 C '
+            '(min 1.0 C, max 2.0 C, std 0.50 C). '
+            '(2 measurements 2022-11-02 00:00:00 ... 2022-11-03 00:00:00)\n'
+            f'\nLast measured temperature at {first.name} is 2.0 C. '
+            '(2022-11-03 00:00:00)\n'
+            f'\nTemperature at {first.name} is 1.0 C. (2022-11-02 00:00:00)'
+            f'\nTemperature at {first.name} is 2.0 C. (2022-11-03 00:00:00)\n'
+        )
+
+    def test_report_weather_cache(
+        self,
+        tmp_path,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(CONFIG, 'report_cache', str(tmp_path / 'reports.sqlite3'))
+        FetchWeather().execute()
+        cache = open_report_cache()
+        assert cache is not None
+        assert cache.generation == 1
+        cache.close()
+
+        def report(**kwargs) -> str:
+            service = ReportWeather(average=True, latest=True, **kwargs)
+            service.output = io.StringIO()
+            service.execute()
+            return service.output.getvalue()
+
+        cached = report()
+        assert 'Average temperature at' in cached
+
+        # changed without collecting run, so reports are still taken from cache
+        session.query(CityWeatherStatsModel).delete()
+        session.commit()
+        assert report() == cached
+        assert 'Average temperature at' not in report(city=['Tokyo'])
+
+        # any committed service makes cached reports again
+        MigrateMainData().execute()
+        assert 'Average temperature at' not in report()
+
+    def test_report_cache_lru(self, tmp_path):
+        path = str(tmp_path / 'reports.sqlite3')
+        cache = ReportCache(path, size=2)
+        cache.set('a', 'first')
+        cache.set('b', 'second')
+        assert cache.get('a') == 'first'
+        cache.set('c', 'third')
+        assert cache.get('b') is None
+        assert cache.get('c') == 'third'
+
+        # report made before generation is bumped is not stored
+        ReportCache(path, size=2).bump()
+        assert cache.get('a') is None
+        cache.set('d', 'fourth')
+        assert ReportCache(path, size=2).get('d') is None
+        cache.close()
+
+    ####################################################################################
+    # Analyze Weather Service
+    ####################################################################################
+
+    def test_analyze_weather(
+        self, seed_cities_to_database, session: orm.Session, store_measurements
+    ):
+        first, second = session.query(CityModel).order_by(CityModel.id).limit(2)
+        start = datetime(2022, 11, 1)
+        wide = BulkInsert(MeasurementModel)
+        narrow = BulkInsert(MeasurementModel, main=MainWeatherDataModel)
+        for hour, temp in enumerate([20, 22, 24, 22, 20]):
+            measure_at = start + timedelta(hours=hour)
+            wide.add({'city_id': first.id, 'measure_at': measure_at, 'temp': temp})
+            wide.add({'city_id': second.id, 'measure_at': measure_at, 'temp': 0})
+        narrow.add(
+            {'city_id': first.id, 'measure_at': start + timedelta(hours=5)},
+            main={'temp': 50},
+        )
+
+        store_measurements(wide, narrow)
+
+        analyze = AnalyzeWeather(
+            rolling=2,
+            percentiles=[50],
+            degree_hours=22,
+            anomalies=2,
+            city=[first.name],
+        )
+        analyze.output = io.StringIO()
+        analyze.execute()
+        rolling = ''.join(
+            f'\nRolling 2 h mean temperature at {first.name} is {mean:.2f} C. '
+            f'({start + timedelta(hours=hour)})'
+            for hour, mean in enumerate([20, 21, 23, 23, 21, 35])
+        )
+        assert analyze.output.getvalue() == (
+            f'{rolling}\n'
+            f'\nTemperature percentiles at {first.name}: p50 22.00 C.\n'
+            f'\nDegree-hours above 22 C at {first.name} is 16.0 C*h. '
+            '(5.0 hours measured)\n'
+            f'\nAnomaly temperature at {first.name} is 50.0 C, z-score 2.22. '
+            '(2022-11-01 05:00:00)\n'
+        )
+
+    def test_analyze_weather_no_methods_rises(self, seed_cities_to_database):
+        with pytest.raises(NoDataError):
+            AnalyzeWeather(city=['Moscow'])
+
+    ####################################################################################
+    # Wide-row Measurements
+    ####################################################################################
+
+    def test_fetch_weather_wide_measurements(
+        self,
+        cities_list: list,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(CONFIG, 'wide_measurements', True)
+        FetchWeather().execute()
+        ReportWeather(average=True, latest=True).execute()
+
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert len(measures) == len(cities_list)
+        assert not session.query(MainWeatherDataModel).count()
+        for measure in measures:
+            assert measure.temp
+            assert measure.main_data.temp == measure.temp
+            assert measure.extra.data
+
+    def test_migrate_main_data(self, seed_cities_to_database, session: orm.Session):
+        CollectScheduler(repeats=2).execute()
+        expected = {
+            measure.id: measure.main.temp
+            for measure in session.query(MeasurementModel).all()
+        }
+        session.commit()
+
+        MigrateMainData(chunk_size=3).execute()
+        session.expire_all()
+        assert not session.query(MainWeatherDataModel).count()
+        for measure in session.query(MeasurementModel).all():
+            assert measure.temp == expected[measure.id]
+            assert measure.main is None
+        session.commit()
+
+        MigrateMainData(reverse=True, chunk_size=3).execute()
+        session.expire_all()
+        for measure in session.query(MeasurementModel).all():
+            assert measure.temp is None
+            assert measure.main_data.temp == expected[measure.id]
+
+    ####################################################################################
+    # Partitioning and Retention
+    ####################################################################################
+
+    def insert_measurements(
+        self,
+        session: orm.Session,
+        store_measurements,
+        days_ago: list[int],
+        temps: list[float] | None = None,
+    ):
+        bulk = BulkInsert(
+            MeasurementModel, main=MainWeatherDataModel, extra=ExtraWeatherDataModel
+        )
+        for city in session.query(CityModel).all():
+            for days, temp in zip(days_ago, temps or days_ago):
+                bulk.add(
+                    {
+                        'city_id': city.id,
+                        'measure_at': datetime.utcnow() - timedelta(days=days),
+                    },
+                    main={'temp': temp},
+                    extra={'data': {}},
+                )
+
+        store_measurements(bulk)
+
+    def get_stats(self, session: orm.Session) -> list[tuple]:
+        session.expire_all()
+        return [
+            (
+                s.city_id,
+                s.temp_count,
+                pytest.approx(s.temp_sum),
+                pytest.approx(s.temp_sum_squares),
+                s.temp_min,
+                s.temp_max,
+                s.first_at,
+                s.last_at,
+                s.last_temp,
+            )
+            for s in session.query(CityWeatherStatsModel).order_by('city_id')
+        ]
+
+    @pytest.mark.parametrize(
+        'temps, aggregated',
+        [
+            ([0, 100, 400], True),  # maximum is dropped
+            ([5, -3, 1, 2], False),  # only count and sums are changed
+        ],
+    )
+    def test_retention(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        store_measurements,
+        temps: list[float],
+        aggregated: bool,
+    ):
+        self.insert_measurements(
+            session, store_measurements, [0, 100, 400, 500][: len(temps)], temps
+        )
+        RebuildStats().execute()
+
+        Retention(keep_months=6).execute()
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert {measure.main.temp for measure in measures} == set(temps[:2])
+        assert session.query(MainWeatherDataModel).count() == len(measures)
+        assert session.query(ExtraWeatherDataModel).count() == len(measures)
+
+        # dropped measurements are subtracted from rollup the same as it is rebuilt
+        stats = self.get_stats(session)
+        assert stats
+        assert [(s[1], s[2]) for s in stats] == [(2, sum(temps[:2]))] * len(stats)
+        RebuildStats().execute()
+        assert self.get_stats(session) == stats
+
+    def test_month_window_stats(
+        self, seed_cities_to_database, session: orm.Session, store_measurements
+    ):
+        self.insert_measurements(session, store_measurements, [0, 40, 400, 410])
+        month = month_start(datetime.utcnow() - timedelta(days=400))
+        since = datetime.combine(month, datetime.min.time())
+        until = datetime.combine(add_months(month, 1), datetime.min.time())
+
+        # main data filtered at join condition does not change aggregates
+        window = session.execute(group_stats(window=(month, add_months(month, 1))))
+        where = session.execute(
+            group_stats(
+                MeasurementModel.measure_at >= since,
+                MeasurementModel.measure_at < until,
+            )
+        )
+        rows = sorted(window.all())
+        assert rows
+        assert rows == sorted(where.all())
+
+    def test_partitioned_retention(
+        self,
+        partitioned_database,
+        seed_cities_to_database,
+        session: orm.Session,
+        store_measurements,
+        engine,
+    ):
+        self.insert_measurements(session, store_measurements, [0, 100, 400])
+        old = month_start(datetime.utcnow() - timedelta(days=400))
+        with engine.connect() as connection:
+            # partitions for months of inserted rows are created on insert
+            partitions = get_partitions(connection, 'extra_weather_data')
+            assert partitions[old] == partition_name('extra_weather_data', old)
+
+        RebuildStats().execute()
+        ReportWeather(latest=True).execute()
+        Retention(keep_months=6).execute()
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert {measure.main.temp for measure in measures} == {0, 100}
+        stats = self.get_stats(session)
+        RebuildStats().execute()
+        assert self.get_stats(session) == stats
+
+        with engine.connect() as connection:
+            for table in ['weather_measurement', 'extra_weather_data']:
+                assert old not in get_partitions(connection, table)
+
+    ####################################################################################
+    # Idempotent Measurements
+    ####################################################################################
+
+    def test_fetch_weather_stores_measurement_once(
+        self, cities_list: list, seed_cities_to_database, session: orm.Session
+    ):
+        FetchWeather().execute()
+        FetchWeather().execute()
+
+        measures: list[MeasurementModel] = session.query(MeasurementModel).all()
+        assert len(measures) == len(cities_list)
+        assert session.query(MainWeatherDataModel).count() == len(cities_list)
+        assert session.query(ExtraWeatherDataModel).count() == len(cities_list)
+
+    def test_bulk_create_skips_duplicates(
+        self, seed_cities_to_database, session: orm.Session, store_measurements
+    ):
+        city: CityModel = session.query(CityModel).first()
+        measure_at = datetime.utcnow()
+        bulk = BulkInsert(MeasurementModel, main=MainWeatherDataModel)
+        bulk.add({'city_id': city.id, 'measure_at': measure_at}, main={'temp': 1})
+        bulk.add({'city_id': city.id, 'measure_at': measure_at}, main={'temp': 2})
+        bulk.add(
+            {'city_id': city.id, 'measure_at': measure_at + timedelta(minutes=10)},
+            main={'temp': 3},
+        )
+
+        store_measurements(bulk)
+
+        assert [measure.main.temp for measure in city.measurements] == [1, 3]
+        assert session.query(MainWeatherDataModel).count() == 2
+
+    ####################################################################################
+    # Cities Weather Stats
+    ####################################################################################
+
+    def test_update_stats(self, seed_cities_to_database, session: orm.Session):
+        city: CityModel = session.query(CityModel).first()
+        start = datetime(2022, 11, 1)
+        update_stats(
+            session.connection(),
+            get_deltas([(city.id, start, 1.0), (city.id, start + timedelta(2), 3.0)]),
+        )
+        update_stats(
+            session.connection(),
+            get_deltas([(city.id, start + timedelta(1), 2.0), (city.id, start, None)]),
+        )
+        session.commit()
+
+        stats: CityWeatherStatsModel = session.query(CityWeatherStatsModel).one()
+        assert (stats.temp_count, stats.temp_sum, stats.temp_sum_squares) == (3, 6, 14)
+        assert (stats.temp_min, stats.temp_max) == (1, 3)
+        assert (stats.first_at, stats.last_at) == (start, start + timedelta(2))
+        assert stats.last_temp == 3
+
+    def test_fetch_weather_updates_stats(
+        self, cities_list: list, seed_cities_to_database, session: orm.Session
+    ):
+        FetchWeather().execute()
+        FetchWeather().execute()  # the same measurements are not counted twice
+
+        def get_stats():
+            return {
+                (s.city_id, s.temp_count, s.temp_sum, s.last_at, s.last_temp)
+                for s in session.query(CityWeatherStatsModel).all()
+            }
+
+        collected = get_stats()
+        assert len(collected) == len(cities_list)
+        assert {count for _, count, *_ in collected} == {1}
+        session.commit()
+
+        RebuildStats().execute()
+        assert get_stats() == collected
+
+    ####################################################################################
+    # Compact Extra Data
+    ####################################################################################
+
+    def test_fetch_weather_compact_extra(
+        self,
+        cities_list: list,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(CONFIG, 'compact_extra', True)
+        FetchWeather().execute()
+
+        extras: list[ExtraWeatherDataModel] = session.query(ExtraWeatherDataModel).all()
+        assert len(extras) == len(cities_list)
+        for extra in extras:
+            city = extra.measurement.city
+            assert extra.data is None
+            assert 'coord' not in extra.packed and 'country' not in extra.packed['sys']
+            assert city.weather_static['id'] == city.open_weather_id
+            assert extra.payload['id'] == city.open_weather_id
+            assert extra.payload['sys'].keys() > {'country', 'sunrise'}
+            assert extra.payload['wind']
+
+    def test_compact_extra_static_changed(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(CONFIG, 'compact_extra', True)
+        fetch = FetchWeather.fetch
+
+        def collect(timezone: int):
+            def fetch_at_timezone(self, city: CityModel):
+                measure, extra = fetch(self, city)
+                measure.dt = 1667260800 + timezone  # not the same measurement
+                return measure, extra | {'timezone': timezone}
+
+            monkeypatch.setattr(FetchWeather, 'fetch', fetch_at_timezone)
+            FetchWeather().execute()
+
+        collect(timezone=0)
+        collect(timezone=3600)  # DST is changed
+
+        def check():
+            extras = session.query(ExtraWeatherDataModel).all()
+            assert {extra.payload['timezone'] for extra in extras} == {0, 3600}
+            for extra in extras:
+                city = extra.measurement.city
+                assert city.weather_static['timezone'] == 0
+                offset = extra.measurement.measure_at - min(
+                    m.measure_at for m in city.measurements
+                )
+                assert extra.payload['timezone'] == offset.total_seconds()
+            session.commit()
+
+        check()
+
+        # migrated rows are packed against stored city static the same way
+        MigrateExtraData(reverse=True).execute()
+        session.query(CityModel).update({'weather_static': None})
+        session.commit()
+        MigrateExtraData().execute()
+        session.expire_all()
+        check()
+
+    def test_migrate_extra_data(self, seed_cities_to_database, session: orm.Session):
+        CollectScheduler(repeats=2).execute()
+        expected = {
+            extra.id: extra.data for extra in session.query(ExtraWeatherDataModel).all()
+        }
+        session.commit()
+
+        MigrateExtraData(chunk_size=3).execute()
+        session.expire_all()
+        for extra in session.query(ExtraWeatherDataModel).all():
+            assert extra.data is None
+            assert extra.payload == expected[extra.id]
+        session.commit()
+
+        MigrateExtraData(reverse=True, chunk_size=3).execute()
+        session.expire_all()
+        for extra in session.query(ExtraWeatherDataModel).all():
+            assert extra.packed is None
+            assert extra.data == expected[extra.id]
+
+    ####################################################################################
+    # Promoted Extra Fields
+    ####################################################################################
+
+    def test_fetch_weather_promoted_fields(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(CONFIG, 'compact_extra', True)
+        FetchWeather().execute()
+
+        for measure in session.query(MeasurementModel).all():
+            payload = measure.extra.payload
+            assert measure.wind_speed == payload['wind']['speed']
+            assert measure.clouds_all == payload['clouds']['all']
+            assert measure.visibility == payload['visibility']
+            assert measure.weather_main == payload['weather'][0]['main']
+
+    def test_promoted_fields_unknown_column_rises(self):
+        columns = [
+            name
+            for name, value in vars(PromotedFieldsMixin).items()
+            if isinstance(value, db.Column)
+        ]
+        assert list(CollectorConfig.__fields__['promoted_fields'].default) == columns
+
+        with pytest.raises(pydantic.ValidationError, match='wind_gust'):
+            CollectorConfig(
+                debug=True,
+                open_weather_key='test',
+                promoted_fields={'wind_speed': 'wind.speed', 'wind_gust': 'wind.gust'},
+            )
+
+    def test_backfill_promoted_fields(
+        self,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        promoted = {'wind_speed': 'wind.speed', 'weather_main': 'weather.0.main'}
+        monkeypatch.setattr(CONFIG, 'promoted_fields', {})
+        CollectScheduler(repeats=2).execute()
+        assert (
+            not session.query(MeasurementModel)
+            .filter(MeasurementModel.wind_speed.is_not(None))
+            .count()
+        )
+        session.commit()
+
+        monkeypatch.setattr(CONFIG, 'promoted_fields', promoted)
+        BackfillPromotedFields(chunk_size=3).execute()
+        session.expire_all()
+        for measure in session.query(MeasurementModel).all():
+            assert measure.wind_speed == measure.extra.data['wind']['speed']
+            assert measure.weather_main == measure.extra.data['weather'][0]['main']
+            assert measure.visibility is None
+
+    ####################################################################################
+    # Export Weather Service
+    ####################################################################################
+
+    @pytest.mark.parametrize('compact', [False, True])
+    def test_export_weather_csv(
+        self,
+        tmp_path,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+        compact: bool,
+    ):
+        monkeypatch.setattr(CONFIG, 'compact_extra', compact)
+        FetchWeather().execute()
+        path = tmp_path / 'weather.csv.gz'
+        ExportWeather(
+            output=str(path), extra_fields=['name', 'wind.speed'], chunk_size=3
+        ).execute()
+
+        with gzip.open(path, 'rt', newline='') as file:
+            rows = list(csv.DictReader(file))
+        measures: list[MeasurementModel] = (
+            session.query(MeasurementModel).order_by(MeasurementModel.id).all()
+        )
+        assert [int(row['id']) for row in rows] == [measure.id for measure in measures]
+        for row, measure in zip(rows, measures):
+            assert row['city'] == measure.city.name
+            assert float(row['temp']) == measure.main_data.temp
+            assert row['extra.name'] == measure.extra.payload['name']
+            assert (
+                float(row['extra.wind.speed']) == measure.extra.payload['wind']['speed']
+            )
+
+        with open(f'{path}.checkpoint') as file:
+            assert json.load(file)['last_id'] == measures[-1].id
+
+    def test_export_weather_copy_matches_rows(
+        self,
+        tmp_path,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        monkeypatch.setattr(CONFIG, 'compact_extra', True)
+        FetchWeather().execute()
+
+        # plain data without static field, city static has it
+        extras = session.query(ExtraWeatherDataModel).order_by('id').all()
+        for extra in extras[::2]:
+            extra.data = {k: v for k, v in extra.payload.items() if k != 'coord'}
+            extra.packed = None
+        session.commit()
+
+        exported = []
+        for bulk_copy in [False, True]:
+            if isinstance(CONFIG.db, DatabaseConfig):
+                monkeypatch.setattr(CONFIG.db, 'bulk_copy', bulk_copy)
+            path = tmp_path / f'weather-{bulk_copy}.csv.gz'
+            ExportWeather(
+                output=str(path), extra_fields=['coord.lat', 'name', 'wind.speed']
+            ).execute()
+            with gzip.open(path, 'rt', newline='') as file:
+                exported.append(list(csv.DictReader(file)))
+
+        rows, copied = exported
+        assert rows == copied
+        assert [bool(row['extra.coord.lat']) for row in rows] == [
+            extra.packed is not None for extra in extras
+        ]
+
+    def test_export_weather_resume(
+        self,
+        tmp_path,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        FetchWeather().execute()
+        path = tmp_path / 'weather.jsonl.gz'
+        get_query = ExportWeather.get_query
+
+        def fail_second_chunk(self, last_id: int, end: int, copy: bool = False):
+            if last_id:
+                raise RuntimeError('Connection is lost. ')
+            return get_query(self, last_id, end, copy)
+
+        monkeypatch.setattr(ExportWeather, 'get_query', fail_second_chunk)
+        with pytest.raises(RuntimeError):
+            ExportWeather(format='jsonl', output=str(path), chunk_size=2).execute()
+        with open(path, 'ab') as file:
+            file.write(b'partially written chunk')
+
+        monkeypatch.setattr(ExportWeather, 'get_query', get_query)
+        ExportWeather(
+            format='jsonl', output=str(path), chunk_size=2, resume=True
+        ).execute()
+
+        with gzip.open(path, 'rt') as file:
+            ids = [json.loads(line)['id'] for line in file]
+        assert ids == [
+            id for id, in session.query(MeasurementModel.id).order_by('id').all()
+        ]
+
+    def test_export_weather_parquet(
+        self,
+        tmp_path,
+        seed_cities_to_database,
+        session: orm.Session,
+        monkeypatch: pytest.MonkeyPatch,
+    ):
+        parquet = pytest.importorskip('pyarrow.parquet')
+        monkeypatch.setattr(ParquetWriter, 'part_rows', 3)
+        FetchWeather().execute()
+        path = tmp_path / 'weather.parquet'
+        ExportWeather(
+            format='parquet', output=str(path), extra_fields=['wind'], chunk_size=2
+        ).execute()
+
+        table = parquet.read_table(path)
+        measures: list[MeasurementModel] = (
+            session.query(MeasurementModel).order_by(MeasurementModel.id).all()
+        )
+        assert len(list(path.iterdir())) > 1
+        assert sorted(table.column('id').to_pylist()) == [m.id for m in measures]
+        assert {
+            json.loads(wind)['speed'] for wind in table.column('extra.wind').to_pylist()
+        } == {measure.extra.data['wind']['speed'] for measure in measures}
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from collector import throttling
+from collector.configurations import CONFIG, QuotaConfig, RetryConfig
+from collector.exceptions import QuotaExceededError
+from collector.throttling import RateLimiter, RetryBudget, TokenBucket, get_retry_delay
+
+
+class TestThrottling:
+    def test_token_bucket_reserves_tokens_in_advance(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        delays = [bucket.reserve() for _ in range(5)]
+        assert delays[:2] == [0, 0]
+        assert delays[2:] == pytest.approx([0.1, 0.2, 0.3], abs=0.01)
+
+    def test_rate_limiter_keeps_rate(self):
+        limiter = RateLimiter(QuotaConfig(calls=20, period=1))
+
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        assert time.monotonic() - start == pytest.approx(0.2, abs=0.05)
+        assert limiter.stats.calls == 5
+        assert limiter.stats.waits == 4
+
+    def test_rate_limiter_async(self):
+        limiter = RateLimiter(QuotaConfig(calls=20, period=1))
+
+        async def run():
+            await asyncio.gather(*[limiter.acquire_async() for _ in range(5)])
+
+        start = time.monotonic()
+        asyncio.run(run())
+        assert time.monotonic() - start == pytest.approx(0.2, abs=0.05)
+
+    def test_rate_limiter_monthly_budget_raises(self):
+        limiter = RateLimiter(QuotaConfig(calls=1000, period=1, monthly=3))
+        for _ in range(3):
+            limiter.acquire()
+        with pytest.raises(QuotaExceededError) as error:
+            limiter.acquire()
+
+        # budget is available again at the next month
+        reset_at = error.value.reset_at
+        assert reset_at > datetime.now(timezone.utc)
+        assert (reset_at.day, reset_at.hour, reset_at.minute) == (1, 0, 0)
+
+    def test_retry_delay_exponential_backoff(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(CONFIG, 'retry', RetryConfig(attempts=3, backoff=1))
+        monkeypatch.setattr(throttling, 'retry_budget', RetryBudget())
+
+        for attempt in range(3):
+            assert 0 <= get_retry_delay(attempt) <= 2**attempt
+        assert get_retry_delay(3) is None
+
+    def test_retry_delay_respects_retry_after(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(throttling, 'retry_budget', RetryBudget())
+        assert get_retry_delay(0, retry_after='7') == 7
+
+    def test_retry_delay_capped(self, monkeypatch: pytest.MonkeyPatch):
+        monkeypatch.setattr(CONFIG, 'retry', RetryConfig(backoff=10, max_backoff=5))
+        monkeypatch.setattr(throttling, 'retry_budget', RetryBudget())
+        assert get_retry_delay(0, retry_after='3600') == 5
+        assert 0 <= get_retry_delay(2) <= 5
+
+    def test_retry_budget(self, monkeypatch: pytest.MonkeyPatch):
+        config = RetryConfig(budget_ratio=0.5, budget_minimum=1)
+        budget = RetryBudget()
+        for _ in range(4):
+            budget.deposit()
+
+        # 1 + 0.5 * 4 = 3 retries allowed
+        assert [budget.withdraw(config) for _ in range(4)] == [True, True, True, False]
+
+    def test_retry_budget_expires(self, monkeypatch: pytest.MonkeyPatch):
+        config = RetryConfig(budget_ratio=0.5, budget_minimum=0, budget_window=0.1)
+        monkeypatch.setattr(CONFIG, 'retry', config)
+        budget = RetryBudget()
+        for _ in range(100):
+            budget.deposit()
+        assert budget.withdraw(config)
+
+        # long healthy period does not save up retries
+        time.sleep(0.15)
+        assert (budget.requests, budget.retries) == (0, 0)
+        budget.deposit()
+        assert [budget.withdraw(config) for _ in range(2)] == [True, False]